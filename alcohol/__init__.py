@@ -9,3 +9,16 @@ namespace = Namespace()
 
 user_id_changed = namespace.signal('user_id_changed')
 user_id_reset = namespace.signal('user_id_reset')
+
+password_rehashed = namespace.signal('password_rehashed')
+
+# sent by RBACs after modifications. receivers are passed a list of pairs as
+# passed to the modifying method and the new version of the RBAC
+role_assigned = namespace.signal('role_assigned')
+role_unassigned = namespace.signal('role_unassigned')
+permission_granted = namespace.signal('permission_granted')
+permission_revoked = namespace.signal('permission_revoked')
+
+# sent by hierarchical RBACs, with a list of (senior, junior) pairs
+role_inherited = namespace.signal('role_inherited')
+role_disinherited = namespace.signal('role_disinherited')
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# coding=utf8
+
+"""Measures password hashing cost on the current machine and calibrates
+round counts for a target latency.
+
+Can be run as a script, printing timings and a tuned context configuration
+suitable for :meth:`~passlib.context.CryptContext.from_string`::
+
+    python -m alcohol.benchmark --target 50 --processes 4 sha512_crypt
+"""
+
+from collections import namedtuple
+import math
+from multiprocessing import cpu_count
+import time
+
+import passlib.hash
+from passlib.context import CryptContext
+
+from .mixins import _encrypt_password, _verify_password
+
+DEFAULT_SCHEMES = ['pbkdf2_sha256', 'pbkdf2_sha512', 'sha256_crypt',
+                   'sha512_crypt']
+
+BENCHMARK_PASSWORD = 'correct horse battery staple'
+
+Timing = namedtuple('Timing', ['scheme', 'rounds', 'processes',
+                               'hash_latency', 'verify_latency',
+                               'verify_throughput'])
+"""Result of :func:`measure`. Latencies are medians in seconds,
+``verify_throughput`` is in verifications per second across all
+processes."""
+
+
+def _has_rounds(scheme):
+    return 'rounds' in getattr(getattr(passlib.hash, scheme),
+                               'setting_kwds', ())
+
+
+def create_context(scheme_rounds, min_rounds_factor=None):
+    """Creates a :class:`~passlib.context.CryptContext`.
+
+    :param scheme_rounds: A list of ``(scheme, rounds)`` tuples. The first
+                          scheme is the default, all others are deprecated.
+                          ``rounds`` is ignored for schemes without a
+                          variable cost.
+    :param min_rounds_factor: If not ``None``, hashes with fewer than
+                              ``rounds * min_rounds_factor`` rounds are
+                              considered outdated, causing them to be
+                              upgraded on login.
+    """
+    schemes = [scheme for scheme, _ in scheme_rounds]
+    kwargs = {'schemes': schemes, 'deprecated': schemes[1:]}
+
+    for scheme, rounds in scheme_rounds:
+        if rounds is None or not _has_rounds(scheme):
+            continue
+
+        kwargs[scheme + '__default_rounds'] = rounds
+        if min_rounds_factor is not None:
+            handler = getattr(passlib.hash, scheme)
+            kwargs[scheme + '__min_rounds'] = max(
+                handler.min_rounds, int(rounds * min_rounds_factor))
+
+    return CryptContext(**kwargs)
+
+
+def _median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
+def _timed(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+def measure(scheme, rounds=None, samples=5, processes=1,
+            password=BENCHMARK_PASSWORD):
+    """Times hashing and verification of a password.
+
+    Latencies are measured single-threaded. If ``processes`` is larger than
+    one, throughput is measured by verifying ``samples`` passwords on each of
+    ``processes`` worker processes at once.
+
+    :param scheme: Name of a :mod:`passlib.hash` scheme.
+    :param rounds: Round count to use. ``None`` uses passlib's default.
+    :param samples: Number of operations timed per measurement.
+    :param processes: Number of processes used to measure throughput.
+    :return: A :class:`Timing` instance.
+    """
+    config = create_context([(scheme, rounds)]).to_string()
+    pwhash = _encrypt_password(config, password)
+
+    hash_latency = _median([_timed(_encrypt_password, config, password)
+                            for _ in range(samples)])
+    verify_latency = _median([_timed(_verify_password, config, password,
+                                     pwhash)
+                              for _ in range(samples)])
+
+    if processes > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        jobs = samples * processes
+        with ProcessPoolExecutor(processes) as executor:
+            # warm up the workers, so startup is not measured
+            list(executor.map(_verify_password, [config] * processes,
+                              [password] * processes, [pwhash] * processes))
+
+            start = time.time()
+            list(executor.map(_verify_password, [config] * jobs,
+                              [password] * jobs, [pwhash] * jobs))
+            throughput = jobs / (time.time() - start)
+    else:
+        throughput = 1.0 / verify_latency if verify_latency else float('inf')
+
+    if rounds is None and _has_rounds(scheme):
+        rounds = getattr(passlib.hash, scheme).default_rounds
+
+    return Timing(scheme, rounds if _has_rounds(scheme) else None, processes,
+                  hash_latency, verify_latency, throughput)
+
+
+def calibrate(scheme, target=0.05, samples=5, iterations=3):
+    """Finds the round count at which verifying a password takes about
+    ``target`` seconds.
+
+    Starting at passlib's default, the round count is extrapolated from the
+    measured latency, then refined using another ``iterations - 1``
+    measurements.
+
+    :param scheme: Name of a :mod:`passlib.hash` scheme.
+    :param target: Desired verification latency in seconds.
+    :param samples: Number of operations timed per measurement.
+    :param iterations: Maximum number of measurements.
+    :return: A :class:`Timing` measured at the calibrated round count.
+             ``rounds`` is ``None`` if the scheme has no variable cost.
+    """
+    if not _has_rounds(scheme):
+        return measure(scheme, samples=samples)
+
+    handler = getattr(passlib.hash, scheme)
+    log_cost = getattr(handler, 'rounds_cost', 'linear') == 'log2'
+
+    rounds = handler.default_rounds
+    timing = measure(scheme, rounds, samples)
+    for _ in range(iterations - 1):
+        ratio = target / max(timing.verify_latency, 1e-6)
+        if log_cost:
+            new_rounds = rounds + int(round(math.log(ratio, 2)))
+        else:
+            new_rounds = int(rounds * ratio)
+        new_rounds = max(handler.min_rounds,
+                         min(handler.max_rounds, new_rounds))
+
+        if new_rounds == rounds:
+            break
+        rounds = new_rounds
+        timing = measure(scheme, rounds, samples)
+
+    return timing
+
+
+def tuned_context(target=0.05, schemes=DEFAULT_SCHEMES[-1:], samples=5,
+                  min_rounds_factor=None):
+    """Calibrates each scheme for ``target`` and returns a matching
+    :class:`~passlib.context.CryptContext`, suitable for
+    :attr:`~alcohol.mixins.PasswordMixin.crypt_context`.
+
+    :param target: Desired verification latency in seconds.
+    :param schemes: Schemes to include, the first one is the default.
+    :param samples: Number of operations timed per measurement.
+    :param min_rounds_factor: See :func:`create_context`.
+    """
+    return create_context([(scheme, calibrate(scheme, target, samples).rounds)
+                           for scheme in schemes], min_rounds_factor)
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('schemes', nargs='*', default=DEFAULT_SCHEMES,
+                        help='Schemes to calibrate, the first is the default '
+                             'in the resulting context.')
+    parser.add_argument('-t', '--target', type=float, default=50,
+                        help='Target verification latency in milliseconds.')
+    parser.add_argument('-p', '--processes', type=int, default=cpu_count(),
+                        help='Number of processes for throughput.')
+    parser.add_argument('-s', '--samples', type=int, default=5,
+                        help='Operations timed per measurement.')
+    parser.add_argument('--min-rounds-factor', type=float, default=None,
+                        help='Consider hashes below this fraction of the '
+                             'calibrated rounds outdated.')
+    args = parser.parse_args(argv)
+
+    fmt = '{:<16} {:>10} {:>10} {:>10} {:>14}'
+    print(fmt.format('scheme', 'rounds', 'hash ms', 'verify ms',
+                     'verify/s ({})'.format(args.processes)))
+
+    scheme_rounds = []
+    for scheme in args.schemes:
+        rounds = calibrate(scheme, args.target / 1000.0, args.samples).rounds
+        timing = measure(scheme, rounds, args.samples, args.processes)
+        scheme_rounds.append((scheme, rounds))
+
+        print(fmt.format(scheme, '-' if rounds is None else rounds,
+                         '{:.1f}'.format(timing.hash_latency * 1000),
+                         '{:.1f}'.format(timing.verify_latency * 1000),
+                         '{:.0f}'.format(timing.verify_throughput)))
+
+    print('')
+    print(create_context(scheme_rounds, args.min_rounds_factor).to_string())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# coding=utf8
+
+from collections import namedtuple, OrderedDict
+import threading
+import time
+
+
+CacheInfo = namedtuple('CacheInfo',
+                       ['hits', 'misses', 'evictions', 'maxsize', 'currsize'])
+
+
+class LRUCache(object):
+    """A thread-safe mapping of bounded size that evicts the least recently
+    used entries first.
+
+    :param maxsize: Maximum number of entries.
+    :param ttl: If not ``None``, entries expire after this many seconds.
+    :param on_evict: A callable that is passed the key of every entry that is
+                     evicted or expires.
+    :param clock: Function returning the current time in seconds.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, on_evict=None,
+                 clock=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.clock = clock
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._data = OrderedDict()  # key -> (value, expires)
+        self._lock = threading.RLock()
+
+    def _evict(self, key):
+        del self._data[key]
+        if self.on_evict is not None:
+            self.on_evict(key)
+
+    def get(self, key, default=None):
+        """Returns the value for ``key`` or ``default``, counting a hit or a
+        miss."""
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires is not None and expires <= self.clock():
+                self.misses += 1
+                if self.on_evict is not None:
+                    self.on_evict(key)
+                return default
+
+            # reinserting marks as most recently used
+            self._data[key] = value, expires
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            expires = None if self.ttl is None else self.clock() + self.ttl
+            self._data.pop(key, None)
+            self._data[key] = value, expires
+
+            while len(self._data) > self.maxsize:
+                self.evictions += 1
+                self._evict(next(iter(self._data)))
+
+    def pop(self, key, default=None):
+        """Removes ``key`` without calling ``on_evict``."""
+        with self._lock:
+            item = self._data.pop(key, None)
+            return default if item is None else item[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def cache_info(self):
+        """Returns a :class:`CacheInfo` tuple, like
+        :func:`functools.lru_cache` does."""
+        return CacheInfo(self.hits, self.misses, self.evictions, self.maxsize,
+                         len(self._data))
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
@@ -2,50 +2,447 @@
 # coding=utf8
 
 from binascii import hexlify
+import hashlib
+from heapq import heappop, heappush
+from multiprocessing import cpu_count
 import os
+import threading
+import time
 
-from itsdangerous import TimestampSigner, BadData, URLSafeTimedSerializer
+from itsdangerous import (TimestampSigner, BadData, URLSafeTimedSerializer,
+                          want_bytes)
 import passlib.apps
+from passlib.context import CryptContext
+from six import integer_types, string_types
+
+from .. import password_rehashed
 
 
 DAY = 60 * 60 * 24
 
+# crypt contexts are passed to workers in serialized form, so process pools
+# can be used. each worker keeps the deserialized contexts around
+_worker_contexts = {}
+_executor_lock = threading.Lock()
+
+
+def _get_worker_context(config):
+    ctx = _worker_contexts.get(config)
+    if ctx is None:
+        ctx = _worker_contexts[config] = CryptContext.from_string(config)
+    return ctx
+
+
+def _verify_password(config, password, pwhash):
+    return _get_worker_context(config).verify(password, pwhash)
+
+
+def _verify_and_update_password(config, password, pwhash):
+    return _get_worker_context(config).verify_and_update(password, pwhash)
+
+
+def _encrypt_password(config, password):
+    return _get_worker_context(config).encrypt(password)
+
+
+class _CachingTimestampSigner(TimestampSigner):
+    """A :class:`~itsdangerous.TimestampSigner` that looks up derived keys
+    in a cache passed as ``key_cache``.
+
+    Keys are derived from the secret key and the salt (the password hash or
+    email address), which are both part of the cache key. Once either
+    changes, stale keys are no longer found and eventually evicted."""
+
+    def __init__(self, *args, **kwargs):
+        self.key_cache = kwargs.pop('key_cache', None)
+        super(_CachingTimestampSigner, self).__init__(*args, **kwargs)
+
+    def derive_key(self, *args):
+        if self.key_cache is None:
+            return super(_CachingTimestampSigner, self).derive_key(*args)
+
+        # itsdangerous < 2.0 has a single secret key and takes no argument
+        if args and args[0] is not None:
+            secret_key = args[0]
+        elif hasattr(self, 'secret_keys'):
+            secret_key = self.secret_keys[-1]
+        else:
+            secret_key = self.secret_key
+
+        cache_key = (want_bytes(secret_key), self.salt, self.key_derivation,
+                     self.digest_method)
+        key = self.key_cache.get(cache_key)
+        if key is None:
+            key = super(_CachingTimestampSigner, self).derive_key(*args)
+            self.key_cache.set(cache_key, key)
+        return key
+
+
+def _token_nonce(token):
+    # fixed length, regardless of token size
+    return hashlib.sha256(want_bytes(token)).hexdigest()
+
+
+class MemoryNonceStore(object):
+    """Remembers used tokens in memory, until they would have expired anyway.
+
+    Expiry times are kept in a heap, so expired entries are dropped in
+    ``O(log n)`` each whenever the store is accessed.
+
+    :param clock: Function returning the current time in seconds.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._nonces = set()
+        self._heap = []  # (expires, nonce)
+        self._lock = threading.Lock()
+
+    def _purge(self, now):
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            self._nonces.discard(heappop(heap)[1])
+
+    def purge(self):
+        """Drops all expired nonces."""
+        with self._lock:
+            self._purge(self.clock())
+
+    def use(self, nonce, ttl):
+        """Marks ``nonce`` as used for ``ttl`` seconds.
+
+        :return: ``True`` if the nonce was unused, ``False`` otherwise.
+        """
+        return self.use_many([nonce], ttl)[0]
+
+    def use_many(self, nonces, ttl):
+        """Like :meth:`use`, but for a list of nonces. Returns a list of
+        results."""
+        with self._lock:
+            now = self.clock()
+            self._purge(now)
+
+            results = []
+            for nonce in nonces:
+                if nonce in self._nonces:
+                    results.append(False)
+                    continue
+
+                self._nonces.add(nonce)
+                heappush(self._heap, (now + ttl, nonce))
+                results.append(True)
+            return results
+
+    def is_used(self, nonce):
+        with self._lock:
+            self._purge(self.clock())
+            return nonce in self._nonces
+
+    def __len__(self):
+        return len(self._nonces)
+
+
+def _create_token_serializer(secret_key, salt, key_cache):
+    # the signer is configured like the one used for plain reset tokens, so
+    # either kind of token passes check_password_reset_token
+    return URLSafeTimedSerializer(
+        secret_key, salt, signer=_CachingTimestampSigner,
+        signer_kwargs={'key_derivation': 'hmac', 'key_cache': key_cache}
+    )
+
+
+def _verify_user_tokens(secret_key, tokens, fetch_salts, max_age_sec,
+                        key_cache, nonce_store):
+    reader = URLSafeTimedSerializer(secret_key)
+
+    payloads = []
+    for token in tokens:
+        # signatures are checked below, once the salt is known
+        _, payload = reader.loads_unsafe(token)
+        if (not isinstance(payload, list) or len(payload) != 2 or
+                not isinstance(payload[0], integer_types + string_types)):
+            payload = None
+        payloads.append(payload)
+
+    salts = fetch_salts(set(p[0] for p in payloads if p is not None))
+    serializers = {}
+
+    results = []
+    for token, payload in zip(tokens, payloads):
+        salt = None if payload is None else salts.get(payload[0])
+        if salt is None:
+            results.append(None)
+            continue
+
+        serializer = serializers.get(salt)
+        if serializer is None:
+            serializer = serializers[salt] = _create_token_serializer(
+                secret_key, salt, key_cache)
+
+        try:
+            results.append(serializer.loads(token, max_age=max_age_sec))
+        except BadData:
+            results.append(None)
+
+    if nonce_store is not None:
+        valid = [i for i, r in enumerate(results) if r is not None]
+        unused = nonce_store.use_many([_token_nonce(tokens[i]) for i in valid],
+                                      max_age_sec)
+        for i, first_use in zip(valid, unused):
+            if not first_use:
+                results[i] = None
+
+    return results
+
+
+def verify_password_reset_tokens(secret_key, tokens, fetch_salts,
+                                 max_age_sec=DAY,
+                                 key_cache=None,
+                                 nonce_store=None):
+    """Checks many password reset tokens at once, without loading users.
+
+    Only tokens created with a ``user_id`` (see
+    :meth:`PasswordMixin.create_reset_password_token`) can be checked this
+    way.
+
+    :param secret_key: The application's own secret key.
+    :param tokens: A list of tokens.
+    :param fetch_salts: A callable that is passed a set of user ids and
+                        returns a dictionary mapping those ids to password
+                        hashes. Missing ids are treated as invalid. See
+                        ``password_salt_loader()`` of
+                        :class:`~alcohol.mixins.sqlalchemy.SQLAlchemyPasswordMixin`
+                        for a database-backed version.
+    :param max_age_sec: The maximum age in seconds of a valid token.
+    :param key_cache: An optional cache for derived signing keys.
+    :param nonce_store: If given, valid tokens are marked as used and tokens
+                        used before are considered invalid, see
+                        :attr:`PasswordMixin.nonce_store`.
+    :return: A list containing the user id for every valid token and
+             ``None`` for every invalid one, in the order of ``tokens``.
+    """
+    return [None if r is None else r[0] for r in _verify_user_tokens(
+        secret_key, tokens, fetch_salts, max_age_sec, key_cache,
+        nonce_store)]
+
+
+def verify_email_activation_tokens(secret_key, tokens, fetch_salts,
+                                   max_age_sec=DAY,
+                                   key_cache=None,
+                                   nonce_store=None):
+    """Checks many email activation tokens at once, without loading users.
+
+    Only tokens created with a ``user_id`` (see
+    :meth:`EmailMixin.create_email_activation_token`) can be checked this
+    way. Unlike :meth:`EmailMixin.activate_email`, no email address is
+    changed.
+
+    :param secret_key: The application's own secret key.
+    :param tokens: A list of tokens.
+    :param fetch_salts: A callable that is passed a set of user ids and
+                        returns a dictionary mapping those ids to current
+                        email addresses. See ``email_salt_loader()`` of
+                        :class:`~alcohol.mixins.sqlalchemy.SQLAlchemyEmailMixin`.
+    :param max_age_sec: The maximum age in seconds of a valid token.
+    :param key_cache: An optional cache for derived signing keys.
+    :param nonce_store: If given, valid tokens are marked as used and tokens
+                        used before are considered invalid.
+    :return: A list containing a ``(user_id, new_email)`` tuple for every
+             valid token and ``None`` for every invalid one, in the order of
+             ``tokens``.
+    """
+    return [None if r is None else tuple(r) for r in _verify_user_tokens(
+        secret_key, tokens, fetch_salts, max_age_sec, key_cache,
+        nonce_store)]
+
 
 class PasswordMixin(object):
     """A mixin that stores a key based on a password. An attribute named
     `_pwhash` will be used to store the password hash."""
     crypt_context = passlib.apps.custom_app_context  # overridable default
 
+    rehash_on_login = False
+    """If ``True``, a successful :meth:`check_password` replaces hashes that
+    :attr:`crypt_context` considers outdated (deprecated schemes, too few or
+    too many rounds) with a fresh one. Disabled by default, because this
+    invalidates outstanding password reset tokens, just like changing the
+    password does."""
+
+    password_executor = None
+    """The :class:`~concurrent.futures.Executor` used by
+    :meth:`check_password_async` and :meth:`set_password_async`. Shared by
+    all subclasses unless overridden. If ``None``, a
+    :class:`~concurrent.futures.ThreadPoolExecutor` with one worker per CPU
+    is created on first use. Jobs beyond the number of workers are queued.
+
+    Since most hash implementations hold the GIL, a
+    :class:`~concurrent.futures.ProcessPoolExecutor` is usually the better
+    choice for pure-Python schemes."""
+
     def check_password(self, password):
         """Check if a supplied password is the same as the user's password.
 
+        If :attr:`rehash_on_login` is set and the password is valid, an
+        outdated hash is upgraded in place, see :meth:`_password_rehashed`.
+
         :param password: Password to be checked.
         :return: ``True`` if valid, ``False`` otherwise.
         """
-        return self.crypt_context.verify(password, self._pwhash)
+        if not self.rehash_on_login:
+            return self.crypt_context.verify(password, self._pwhash)
+
+        valid, new_hash = self.crypt_context.verify_and_update(password,
+                                                               self._pwhash)
+        if valid and new_hash is not None:
+            self._password_rehashed(new_hash)
+        return valid
+
+    def _password_rehashed(self, new_hash):
+        """Called when a valid password's hash has been found outdated.
+        Stores ``new_hash`` and sends the
+        :data:`~alcohol.password_rehashed` signal."""
+        old_hash = self._pwhash
+        self._pwhash = new_hash
+        password_rehashed.send(self, old_hash=old_hash)
+
+    @classmethod
+    def count_password_schemes(cls, hashes):
+        """Tallies password hashes by scheme and cost, to see how many users
+        are still on an old policy.
+
+        :param hashes: An iterable of password hashes. ``None`` values
+                       (users without a password) are skipped.
+        :return: A dictionary mapping ``(scheme, rounds)`` tuples to the
+                 number of hashes. ``rounds`` is ``None`` for schemes without
+                 a variable cost. Hashes not recognized by
+                 :attr:`crypt_context` are counted as ``(None, None)``.
+        """
+        ctx = cls.crypt_context
+        counts = {}
+
+        for pwhash in hashes:
+            if pwhash is None:
+                continue
+
+            scheme = ctx.identify(pwhash)
+            rounds = None
+            if scheme is not None:
+                handler = ctx.handler(scheme)
+                if 'rounds' in getattr(handler, 'setting_kwds', ()):
+                    rounds = handler.from_string(pwhash).rounds
+
+            key = scheme, rounds
+            counts[key] = counts.get(key, 0) + 1
+
+        return counts
+
+    def _run_password_job(self, func, *args):
+        import asyncio
+
+        executor = self.password_executor
+        if executor is None:
+            with _executor_lock:
+                if PasswordMixin.password_executor is None:
+                    from concurrent.futures import ThreadPoolExecutor
+                    PasswordMixin.password_executor = ThreadPoolExecutor(
+                        cpu_count())
+            executor = self.password_executor
+
+        return asyncio.get_event_loop().run_in_executor(
+            executor, func, self.crypt_context.to_string(), *args)
+
+    def check_password_async(self, password):
+        """Like :meth:`check_password`, but runs in :attr:`password_executor`
+        instead of blocking.
+
+        :return: An :mod:`asyncio` future resolving to ``True`` or
+                 ``False``.
+        """
+        if not self.rehash_on_login:
+            return self._run_password_job(_verify_password, password,
+                                          self._pwhash)
+
+        import asyncio
+
+        job = self._run_password_job(_verify_and_update_password, password,
+                                     self._pwhash)
+        future = asyncio.get_event_loop().create_future()
+
+        def done(f):
+            if f.cancelled():
+                future.cancel()
+            elif f.exception() is not None:
+                future.set_exception(f.exception())
+            else:
+                valid, new_hash = f.result()
+                if valid and new_hash is not None:
+                    self._password_rehashed(new_hash)
+                future.set_result(valid)
+
+        job.add_done_callback(done)
+        return future
+
+    def set_password_async(self, password):
+        """Sets the password hash like setting :attr:`password`, but hashes
+        in :attr:`password_executor` instead of blocking.
+
+        :return: An :mod:`asyncio` future that resolves once the new hash has
+                 been set.
+        """
+        future = self._run_password_job(_encrypt_password, password)
+
+        # callbacks run in the order they were added, so the hash is set
+        # before anyone awaiting the future is resumed
+        def set_hash(f):
+            if not f.cancelled() and f.exception() is None:
+                self._pwhash = f.result()
+
+        future.add_done_callback(set_hash)
+        return future
+
+    signing_key_cache = None
+    """If not ``None``, a :class:`~alcohol.cache.LRUCache` holding keys
+    derived for password reset tokens, saving the key derivation when tokens
+    are checked repeatedly. Cached keys stay in memory until evicted."""
 
     def _create_signer(self, secret_key):
-        return TimestampSigner(secret_key, self._pwhash, key_derivation='hmac')
+        return _CachingTimestampSigner(secret_key, self._pwhash,
+                                       key_derivation='hmac',
+                                       key_cache=self.signing_key_cache)
 
-    def check_password_reset_token(self, secret_key, token, max_age_sec=DAY):
+    nonce_store = None
+    """If not ``None``, a store like :class:`MemoryNonceStore` that makes
+    password reset tokens single-use. Used tokens are remembered until they
+    expire."""
+
+    def check_password_reset_token(self, secret_key, token, max_age_sec=DAY,
+                                   consume=True):
         """Checks if a supplied password-reset token is valid.
 
         :param secret_key: Your applications secret key.
         :param password: Password-reset token to be checked.
         :param max_age_sec: The maximum age in seconds this token may be old
                             before its considered expired. Default is 24 hours.
+        :param consume: If :attr:`nonce_store` is set, marks the token as
+                        used. Pass ``False`` to check a token without using
+                        it up, e.g. before displaying a form.
         :return: ``True`` if valid, ``False`` otherwise.
         """
 
         signer = self._create_signer(secret_key)
         try:
             signer.unsign(token, max_age=max_age_sec)
-            return True
         except BadData:
             return False
 
+        if self.nonce_store is None:
+            return True
+        if not consume:
+            return not self.nonce_store.is_used(_token_nonce(token))
+        return self.nonce_store.use(_token_nonce(token), max_age_sec)
+
     def create_reset_password_token(self, secret_key, random_source=os.urandom,
-                                    nonce_size=5):
+                                    nonce_size=5, user_id=None):
         """Create a signed password reset token.
 
         A pasword reset token using a key derived from ``secret_key`` and
@@ -60,12 +457,22 @@ class PasswordMixin(object):
                               Defaults to :func:`os.urandom`.
         :param nonce_size: Number of bytes in the nonce. Each additional byte
                            will increase the resulting tokens length by 2.
+        :param user_id: If given, the user's id is embedded in the token,
+                        allowing it to be checked using
+                        :func:`verify_password_reset_tokens`. Must be an
+                        integer or a string.
         :return: An urlsafe string.
         """
 
         # sign a few random bytes to hide repetitions
+        nonce = hexlify(random_source(nonce_size))
+        if user_id is not None:
+            return _create_token_serializer(
+                secret_key, self._pwhash, self.signing_key_cache
+            ).dumps([user_id, nonce.decode('ascii')])
+
         signer = self._create_signer(secret_key)
-        return signer.sign(hexlify(random_source(nonce_size)))
+        return signer.sign(nonce)
 
     @property
     def password(self):
@@ -87,10 +494,17 @@ class EmailMixin(object):
     email = None
     """An email address. Not validated in any form."""
 
+    signing_key_cache = None
+    """If not ``None``, a :class:`~alcohol.cache.LRUCache` holding keys
+    derived for email activation tokens."""
+
+    nonce_store = None
+    """If not ``None``, a store like :class:`MemoryNonceStore` that makes
+    activation tokens single-use."""
+
     def _create_serializer(self, secret_key):
-        return URLSafeTimedSerializer(
-            secret_key, self.email, signer_kwargs={'key_derivation': 'hmac'}
-        )
+        return _create_token_serializer(secret_key, self.email,
+                                        self.signing_key_cache)
 
     def activate_email(self, secret_key, token, max_age_sec=DAY):
         """Checks if the email activation token is valid. If it is, updates the
@@ -106,12 +520,21 @@ class EmailMixin(object):
 
         serializer = self._create_serializer(secret_key)
         try:
-            self.email = serializer.loads(token, max_age=max_age_sec)
-            return True
+            email = serializer.loads(token, max_age=max_age_sec)
         except BadData:
             return False
 
-    def create_email_activation_token(self, secret_key, email):
+        if (self.nonce_store is not None and
+                not self.nonce_store.use(_token_nonce(token), max_age_sec)):
+            return False
+
+        # tokens with a user id contain a [user_id, email] list
+        if isinstance(email, list):
+            email = email[1]
+        self.email = email
+        return True
+
+    def create_email_activation_token(self, secret_key, email, user_id=None):
         """Creates a new activation token that allows changing the email
         address. The token will tied to the old email address and works only
         if the address has not changed in the meantime.
@@ -119,7 +542,13 @@ class EmailMixin(object):
         :param secret_key: The application's own secret key.
         :param email: The desired new email address. Will be encoded inside
                       the token.
+        :param user_id: If given, the user's id is embedded in the token,
+                        allowing it to be checked using
+                        :func:`verify_email_activation_tokens`. Must be an
+                        integer or a string.
         :return: An urlsafe string.
         """
 
+        if user_id is not None:
+            return self._create_serializer(secret_key).dumps([user_id, email])
         return self._create_serializer(secret_key).dumps(email)
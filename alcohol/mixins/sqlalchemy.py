@@ -2,11 +2,38 @@
 # coding=utf8
 
 from __future__ import absolute_import
+from collections import OrderedDict
 from datetime import datetime
-from sqlalchemy import Column, String, Unicode, DateTime
+from itertools import islice
+from multiprocessing import cpu_count
+import threading
+import time
+
+from sqlalchemy import (Column, String, Unicode, DateTime, Index, Table, event,
+                        func, inspect, select)
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.sql.expression import case
+from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.ext.hybrid import hybrid_property
-from . import PasswordMixin, EmailMixin
+from sqlalchemy.orm import object_session
+from . import PasswordMixin, EmailMixin, _encrypt_password
+
+
+def _salt_loader(cls, session, column, batch_size):
+    pkey = inspect(cls).primary_key
+    if len(pkey) != 1:
+        raise TypeError('Loading token salts requires a single-column '
+                        'primary key.')
+
+    def fetch_salts(ids):
+        ids = list(ids)
+        salts = {}
+        for i in range(0, len(ids), batch_size):
+            salts.update(session.query(pkey[0], column)
+                                .filter(pkey[0].in_(ids[i:i + batch_size])))
+        return salts
+
+    return fetch_salts
 
 
 class SQLAlchemyPasswordMixin(PasswordMixin):
@@ -17,29 +44,255 @@ class SQLAlchemyPasswordMixin(PasswordMixin):
     HASH_FIELD_LEN = 511
     _pwhash = Column(String(HASH_FIELD_LEN))
 
+    flush_on_rehash = False
+    """Hashes upgraded by :meth:`check_password` are written along with the
+    next flush of the instance's session. If ``True``, the session is flushed
+    right away instead, inside the current transaction."""
+
+    def _password_rehashed(self, new_hash):
+        super(SQLAlchemyPasswordMixin, self)._password_rehashed(new_hash)
+
+        if self.flush_on_rehash:
+            session = object_session(self)
+            if session is not None:
+                session.flush()
+
+    @classmethod
+    def count_stored_password_schemes(cls, session, batch_size=1000):
+        """Like :meth:`~alcohol.mixins.PasswordMixin.count_password_schemes`,
+        but tallies all hashes stored in the database. Only the hash column
+        is loaded, ``batch_size`` rows at a time.
+
+        :param session: The session to query.
+        :param batch_size: Number of rows fetched per round trip.
+        """
+        query = session.query(cls._pwhash).yield_per(batch_size)
+        return cls.count_password_schemes(row[0] for row in query)
+
+    @classmethod
+    def password_salt_loader(cls, session, batch_size=1000):
+        """Returns a callable for
+        :func:`~alcohol.mixins.verify_password_reset_tokens` that fetches the
+        password hashes of many users in one query, without loading any other
+        columns.
+
+        :param session: The session to query.
+        :param batch_size: Maximum number of ids per query.
+        """
+        return _salt_loader(cls, session, cls._pwhash, batch_size)
+
+    @classmethod
+    def bulk_create(cls, session, rows, executor=None, chunk_size=1000):
+        """Inserts many new users at once.
+
+        Passwords are hashed in parallel on ``executor`` and rows are
+        inserted using a single ``executemany`` per chunk, bypassing the ORM.
+        Column defaults, like the ``created`` timestamp of
+        :class:`TimestampMixin`, are filled in by SQLAlchemy. While one chunk
+        is being inserted, the next one is hashed. At most two chunks are
+        held in memory, so ``rows`` can be a generator of any length.
+
+        No instances are created and no primary keys are returned. Does not
+        commit.
+
+        :param session: A session or connection to insert through.
+        :param rows: An iterable of ``(attrs, password)`` tuples. ``attrs``
+                     is a dictionary of attribute names and values, while
+                     ``password`` is a plaintext password or ``None`` for
+                     users without one.
+        :param executor: An :class:`~concurrent.futures.Executor` used for
+                         hashing. If ``None``, a
+                         :class:`~concurrent.futures.ProcessPoolExecutor`
+                         with one process per CPU is used for the duration
+                         of the call.
+        :param chunk_size: Number of rows per ``executemany``.
+        :return: The number of rows inserted.
+        """
+        if executor is None:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(cpu_count()) as executor:
+                return cls.bulk_create(session, rows, executor, chunk_size)
+
+        mapper = inspect(cls)
+        columns = {}  # attribute name -> column key
+        for prop in mapper.column_attrs:
+            columns[prop.key] = prop.columns[0].key
+        pwhash_col = columns['_pwhash']
+
+        config = cls.crypt_context.to_string()
+        rows = iter(rows)
+
+        def submit_chunk():
+            chunk = list(islice(rows, chunk_size))
+            futures = [None if password is None else
+                       executor.submit(_encrypt_password, config, password)
+                       for _, password in chunk]
+            return chunk, futures
+
+        total = 0
+        chunk, futures = submit_chunk()
+        while chunk:
+            next_chunk, next_futures = submit_chunk()
+
+            # executemany requires the same keys for every row
+            params = {}
+            for (attrs, _), future in zip(chunk, futures):
+                values = dict((columns[key], value)
+                              for key, value in attrs.items())
+                values[pwhash_col] = (None if future is None else
+                                      future.result())
+                params.setdefault(frozenset(values), []).append(values)
+
+            for group in params.values():
+                session.execute(cls.__table__.insert(), group)
+            total += len(chunk)
+
+            chunk, futures = next_chunk, next_futures
+
+        return total
+
 
 class SQLAlchemyEmailMixin(EmailMixin):
     """Adds a :class:`~sqlalchemy.types.Unicode`
     :class:`~sqlalchemy.schema.Column` named ``email`` for storing a users
     email address.
 
-    Supports the same interface as :class:`~alcohol.mixins.EmailMixin`."""
+    Supports the same interface as :class:`~alcohol.mixins.EmailMixin`.
+
+    The column is not indexed by default. Set any of :attr:`email_index`,
+    :attr:`email_unique` or :attr:`email_case_insensitive` in the class
+    body of a subclass to add one."""
     MAX_EMAIL_LENGTH = 1023
-    email = Column(Unicode(MAX_EMAIL_LENGTH))
+
+    email_index = False
+    """If ``True``, ``email`` is indexed."""
+
+    email_unique = False
+    """If ``True``, ``email`` gets a unique index."""
+
+    email_case_insensitive = False
+    """If ``True``, the index covers ``lower(email)`` instead, making
+    :meth:`email_matches` fast and uniqueness case-insensitive."""
+
+    @declared_attr
+    def email(cls):
+        if cls.email_case_insensitive:
+            # indexed by _add_index, once the table exists
+            return Column(Unicode(cls.MAX_EMAIL_LENGTH))
+        return Column(Unicode(cls.MAX_EMAIL_LENGTH), index=cls.email_index,
+                      unique=cls.email_unique)
+
+    @classmethod
+    def email_matches(cls, email):
+        """Returns a clause matching users with the email address ``email``,
+        ignoring case if :attr:`email_case_insensitive` is set. The clause
+        can use the index on ``email``."""
+        if cls.email_case_insensitive:
+            return func.lower(cls.email) == func.lower(email)
+        return cls.email == email
+
+    @classmethod
+    def email_salt_loader(cls, session, batch_size=1000):
+        """Returns a callable for
+        :func:`~alcohol.mixins.verify_email_activation_tokens` that fetches
+        the email addresses of many users in one query.
+
+        :param session: The session to query.
+        :param batch_size: Maximum number of ids per query.
+        """
+        return _salt_loader(cls, session, cls.email, batch_size)
+
+
+def _add_index(table, suffix, expression, unique=False):
+    name = 'ix_%s_%s' % (table.name, suffix)
+
+    # subclasses using single table inheritance share the table
+    if not any(index.name == name for index in table.indexes):
+        Index(name, expression, unique=unique)
+
+
+@event.listens_for(SQLAlchemyEmailMixin, 'instrument_class', propagate=True)
+def _add_email_index(mapper, cls):
+    if cls.email_case_insensitive and (cls.email_index or cls.email_unique):
+        _add_index(cls.__table__, 'email_lower',
+                   func.lower(cls.__table__.c.email), cls.email_unique)
+
+
+def _last_modified_expression(created, modified):
+    return case(
+        [
+            (created <= modified, modified),
+            (created > modified, created),
+
+            # at least one must be NULL
+            (created != None, created),
+            (modified != None, modified),
+
+            # fallthrough to NULL
+        ],
+        else_=None)
+
+
+def _copy_created(context):
+    created = context.get_current_parameters().get('created')
+    return datetime.utcnow() if created is None else created
 
 
 class TimestampMixin(object):
     """A mixin that adds two timestamp fields, `created` and `modified`. The
     `created` timestamp is updated only on creation, while every SQL UPDATE
-    will trigger a refresh of the `modified` timestamp."""
+    will trigger a refresh of the `modified` timestamp.
+
+    Set :attr:`timestamp_indexes`, :attr:`timestamp_server_default` or
+    :attr:`timestamp_sargable` in the class body of a subclass to enable
+    indexes, database-side defaults or a faster :attr:`last_modified`."""
 
-    created = Column(DateTime, default=datetime.utcnow, nullable=False)
-    """A :py:class:`datetime.datetime` instance containing the time this record
-    was created."""
+    timestamp_indexes = False
+    """If ``True``, ``created`` and ``modified`` are indexed, as well as the
+    expression behind :attr:`last_modified`. Queries like "all records
+    changed since X" no longer need to scan the whole table."""
 
-    modified = Column(DateTime, onupdate=datetime.utcnow)
-    """A :py:class:`datetime.datetime` instance containing the time this record
-    was last modified."""
+    timestamp_server_default = False
+    """If ``True``, timestamps are set by the database using ``now()``
+    instead of :meth:`datetime.datetime.utcnow`, which also works for inserts
+    that bypass the ORM. Note that the database server's clock is used, which
+    should be set to UTC. ``created`` is loaded again when accessed after an
+    insert."""
+
+    timestamp_sargable = False
+    """If ``True``, ``modified`` is set on insert as well, to the same value
+    as ``created``, and is never ``NULL``. :attr:`last_modified` then
+    compiles to plain ``modified`` in SQL, so comparisons and ``ORDER BY``
+    can use the index on ``modified``. Rows inserted before enabling this
+    need to be updated using :meth:`backfill_modified`."""
+
+    @declared_attr
+    def created(cls):
+        """A :py:class:`datetime.datetime` instance containing the time this
+        record was created."""
+        if cls.timestamp_server_default:
+            default = {'server_default': func.now()}
+        else:
+            default = {'default': datetime.utcnow}
+        return Column(DateTime, nullable=False, index=cls.timestamp_indexes,
+                      **default)
+
+    @declared_attr
+    def modified(cls):
+        """A :py:class:`datetime.datetime` instance containing the time this
+        record was last modified."""
+        kwargs = {}
+        if cls.timestamp_sargable:
+            kwargs['nullable'] = False
+            if cls.timestamp_server_default:
+                kwargs['server_default'] = func.now()
+            else:
+                kwargs['default'] = _copy_created
+
+        return Column(DateTime,
+                      onupdate=(func.now() if cls.timestamp_server_default
+                                else datetime.utcnow),
+                      index=cls.timestamp_indexes, **kwargs)
 
     @hybrid_property
     def last_modified(self):
@@ -60,15 +313,170 @@ class TimestampMixin(object):
 
     @last_modified.expression
     def last_modified(cls):
-        return case(
-            [
-                (cls.created <= cls.modified, cls.modified),
-                (cls.created > cls.modified, cls.created),
-
-                # at least one must be NULL
-                (cls.created != None, cls.created),
-                (cls.modified != None, cls.modified),
-
-                # fallthrough to NULL
-            ],
-            else_=None)
+        if cls.timestamp_sargable:
+            return cls.modified
+        return _last_modified_expression(cls.created, cls.modified)
+
+    @classmethod
+    def backfill_modified(cls, session, batch_size=10000):
+        """Sets ``modified`` to ``created`` for all rows where it is
+        ``NULL``, as required by :attr:`timestamp_sargable`. Rows are updated
+        ``batch_size`` at a time, each batch in its own statement, to keep
+        locks short on large tables. Does not commit.
+
+        :param session: A session or connection to issue queries through.
+        :param batch_size: Number of rows per ``UPDATE``.
+        :return: The number of rows updated.
+        """
+        table = cls.__table__
+        pkey = list(table.primary_key.columns)
+        if len(pkey) != 1:
+            raise TypeError('Backfilling requires a single-column primary '
+                            'key.')
+        pkey = pkey[0]
+
+        total = 0
+        while True:
+            ids = [row[0] for row in session.execute(
+                select([pkey]).where(table.c.modified == None)
+                              .limit(batch_size))]
+            if not ids:
+                return total
+
+            session.execute(table.update()
+                                 .where(pkey.in_(ids))
+                                 .values(modified=table.c.created))
+            total += len(ids)
+
+
+@event.listens_for(TimestampMixin, 'instrument_class', propagate=True)
+def _add_last_modified_index(mapper, cls):
+    # in sargable mode, the index on modified is used instead
+    if cls.timestamp_indexes and not cls.timestamp_sargable:
+        table = cls.__table__
+        _add_index(table, 'last_modified',
+                   _last_modified_expression(table.c.created,
+                                             table.c.modified))
+
+
+class SQLAlchemyNonceStore(object):
+    """Remembers used tokens in a database table, see
+    :attr:`~alcohol.mixins.PasswordMixin.nonce_store`.
+
+    The table has an indexed expiry column. Every ``purge_interval`` uses,
+    all expired rows are deleted in a single statement, keeping the table
+    from growing indefinitely. Nonces are inserted right away and rejected by
+    the primary key if they were used before, so a token used concurrently
+    in two transactions is only accepted by one of them. Conflicts are
+    caught using savepoints, which the database must support.
+
+    The table is added to ``metadata``, so the store must be created before
+    calling :meth:`~sqlalchemy.schema.MetaData.create_all`.
+
+    :param metadata: The :class:`~sqlalchemy.schema.MetaData` to add the
+                     table to.
+    :param session: A session, connection or engine to issue queries
+                    through. Can be set later as :attr:`session`.
+    :param table_name: Name of the table.
+    :param purge_interval: Number of uses between purges. ``None`` disables
+                           automatic purging, see :meth:`purge`.
+    :param clock: Function returning the current time in seconds.
+    """
+
+    batch_size = 1000
+
+    def __init__(self, metadata, session=None, table_name='nonce',
+                 purge_interval=1000, clock=time.time):
+        self.session = session
+        self.purge_interval = purge_interval
+        self.clock = clock
+
+        self.nonces = Table(table_name,
+                            metadata,
+                            Column('nonce', String(64), primary_key=True),
+                            Column('expires', DateTime, nullable=False,
+                                   index=True), )
+
+        self._uses = 0
+        self._lock = threading.Lock()
+
+    def _db(self):
+        if self.session is None:
+            raise TypeError('SQLAlchemyNonceStore requires a session.')
+        return self.session
+
+    def _now(self):
+        return datetime.utcfromtimestamp(self.clock())
+
+    def _insert(self, db, rows):
+        # inside a savepoint, so a conflict does not abort the transaction.
+        # engines have none, but run every statement in its own transaction
+        try:
+            if hasattr(db, 'begin_nested'):
+                with db.begin_nested():
+                    db.execute(self.nonces.insert(), rows)
+            else:
+                db.execute(self.nonces.insert(), rows)
+        except IntegrityError:
+            return False
+        return True
+
+    def purge(self):
+        """Deletes all expired nonces."""
+        self._db().execute(self.nonces.delete().where(
+            self.nonces.c.expires <= self._now()))
+
+    def use(self, nonce, ttl):
+        """Marks ``nonce`` as used for ``ttl`` seconds.
+
+        :return: ``True`` if the nonce was unused, ``False`` otherwise.
+        """
+        return self.use_many([nonce], ttl)[0]
+
+    def use_many(self, nonces, ttl):
+        """Like :meth:`use`, but for a list of nonces, using one query per
+        :attr:`batch_size` nonces."""
+        db = self._db()
+        now = self._now()
+        expires = datetime.utcfromtimestamp(self.clock() + ttl)
+        col = self.nonces.c.nonce
+
+        results = []
+        for i in range(0, len(nonces), self.batch_size):
+            batch = nonces[i:i + self.batch_size]
+            unique = list(OrderedDict.fromkeys(batch))
+
+            # expired rows that have not been purged yet
+            db.execute(self.nonces.delete().where(col.in_(unique))
+                       .where(self.nonces.c.expires <= now))
+
+            # the primary key decides which nonces are unused: try all of
+            # them at once, then one by one if any of them was taken
+            rows = [{'nonce': nonce, 'expires': expires} for nonce in unique]
+            if self._insert(db, rows):
+                fresh = set(unique)
+            else:
+                fresh = set(row['nonce'] for row in rows
+                            if self._insert(db, [row]))
+
+            for nonce in batch:
+                results.append(nonce in fresh)
+                fresh.discard(nonce)
+
+        if self.purge_interval is not None:
+            with self._lock:
+                self._uses += len(nonces)
+                purge = self._uses >= self.purge_interval
+                if purge:
+                    self._uses = 0
+            if purge:
+                self.purge()
+
+        return results
+
+    def is_used(self, nonce):
+        return self._db().execute(
+            select([self.nonces.c.nonce])
+            .where(self.nonces.c.nonce == nonce)
+            .where(self.nonces.c.expires > self._now())
+        ).first() is not None
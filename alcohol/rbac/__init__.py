@@ -1,7 +1,19 @@
+import threading
+import uuid
+
+from .. import (permission_granted, permission_revoked, role_assigned,
+                role_disinherited, role_inherited, role_unassigned)
+
+_version_lock = threading.Lock()
+
+
 class FlatRBAC(object):
     """Basic interface for the simplest possible role-based access control
     implementation."""
 
+    version = 0
+    """Incremented for every change signal sent, see :meth:`_notify`."""
+
     # user:role
     def assign(self, user, role):
         raise NotImplementedError()
@@ -16,6 +28,28 @@ class FlatRBAC(object):
     def revoke(self, role, permission):
         raise NotImplementedError()
 
+    # bulk modification, takes iterables of pairs
+    def assign_many(self, pairs):
+        """Assigns roles to users for every ``(user, role)`` tuple in
+        ``pairs``."""
+        for user, role in pairs:
+            self.assign(user, role)
+
+    def unassign_many(self, pairs):
+        """Unassigns roles for every ``(user, role)`` tuple in ``pairs``."""
+        for user, role in pairs:
+            self.unassign(user, role)
+
+    def permit_many(self, pairs):
+        """Permits every ``(role, permission)`` tuple in ``pairs``."""
+        for role, permission in pairs:
+            self.permit(role, permission)
+
+    def revoke_many(self, pairs):
+        """Revokes every ``(role, permission)`` tuple in ``pairs``."""
+        for role, permission in pairs:
+            self.revoke(role, permission)
+
     # checking
     def allows(self, role, permission):
         raise NotImplementedError()
@@ -27,46 +61,635 @@ class FlatRBAC(object):
 
         return False
 
+    # batch checking
+    def allowed_many(self, user, permissions):
+        """Returns the set of all ``permissions`` ``user`` is allowed."""
+        return set(permission for permission in permissions
+                   if self.allowed(user, permission))
+
+    def filter_allowed(self, users, permission):
+        """Returns a list of all ``users`` that are allowed ``permission``, in
+        the order they were passed in."""
+        return [user for user in users if self.allowed(user, permission)]
+
+    def allowed_matrix(self, users, permissions):
+        """Returns a dictionary mapping each of ``users`` onto the set of
+        ``permissions`` it is allowed."""
+        permissions = list(permissions)
+        return dict((user, self.allowed_many(user, permissions))
+                    for user in users)
+
     # reflection
     def get_assigned_roles(self, user):
         raise NotImplementedError()
 
+    def get_authorized_roles(self, user):
+        """Returns all roles whose permissions ``user`` has. Without a role
+        hierarchy, these are the assigned roles."""
+        return self.get_assigned_roles(user)
 
-class SessionMixin(object):
-    def create_session(self, user):
+    def get_role_permissions(self, role):
+        """Returns all permissions ``role`` allows."""
         raise NotImplementedError()
 
-    # modification of session
-    def activate(self, session, permissions=None):
+    # reverse lookups. these return iterators, which should not be expected
+    # to stay valid when the RBAC is modified while iterating
+    def get_users_with_role(self, role):
+        """Iterates over all users assigned ``role``."""
+        role = self._role_key(role)
+        for user, r in self.iter_assignments():
+            if r == role:
+                yield user
+
+    def get_roles_with_permission(self, permission):
+        """Iterates over all roles that allow ``permission``."""
+        permission = self._permission_key(permission)
+        for role, p in self.iter_permissions():
+            if p == permission:
+                yield role
+
+    def get_users_with_permission(self, permission):
+        """Iterates over all users allowed ``permission``."""
+        roles = set(self.get_roles_with_permission(permission))
+        seen = set()
+        for user, role in self.iter_assignments():
+            if role in roles and user not in seen:
+                seen.add(user)
+                yield user
+
+    def get_permissions(self, user):
+        """Iterates over all permissions ``user`` is allowed."""
+        seen = set()
+        for role in self.get_assigned_roles(user):
+            for permission in self.get_role_permissions(role):
+                if permission not in seen:
+                    seen.add(permission)
+                    yield permission
+
+    def iter_assignments(self):
+        """Iterates over all ``(user, role)`` assignments."""
         raise NotImplementedError()
 
-    def deactivate(self, session, permissions=None):
+    def iter_permissions(self):
+        """Iterates over all ``(role, permission)`` tuples for which
+        :meth:`allows` is true."""
+        raise NotImplementedError()
+
+    def _notify(self, signal, pairs):
+        """Increments :attr:`version` and sends ``signal`` for a completed
+        modification, with ``pairs`` and the new version as the ``pairs`` and
+        ``version`` keyword arguments. Nothing is sent for empty ``pairs``."""
+        if not pairs:
+            return
+
+        with _version_lock:
+            self.version += 1
+            version = self.version
+
+        signal.send(self, pairs=pairs, version=version)
+
+    # users, roles and permissions as they are stored by a backend, which may
+    # differ from what is passed in (e.g. primary keys instead of instances)
+    def _user_key(self, user):
+        return user
+
+    def _role_key(self, role):
+        return role
+
+    def _permission_key(self, permission):
+        return permission
+
+    def freeze(self):
+        """Creates a :class:`~alcohol.rbac.FrozenRBAC` snapshot of the
+        current state."""
+        return FrozenRBAC(self)
+
+
+class HierarchicalRBAC(FlatRBAC):
+    """Interface for hierarchical RBAC, in which senior roles inherit all
+    permissions of their junior roles.
+
+    Inheritance is transitive; :meth:`allows` and :meth:`allowed` take
+    inherited permissions into account. Implementations keep the transitive
+    closure of the hierarchy up to date on every change, so checks do not
+    depend on how deep the hierarchy is."""
+
+    # role:role
+    def add_inheritance(self, senior, junior):
+        """Makes ``senior`` inherit all permissions of ``junior``.
+
+        :raises ValueError: If this would create a cycle.
+        """
+        raise NotImplementedError()
+
+    def remove_inheritance(self, senior, junior):
+        raise NotImplementedError()
+
+    # reflection
+    def get_junior_roles(self, role):
+        """Returns all roles ``role`` inherits from, directly or
+        indirectly."""
         raise NotImplementedError()
 
+    def get_authorized_roles(self, user):
+        """Returns all roles assigned to ``user`` and their juniors."""
+        roles = set(self.get_assigned_roles(user))
+        for role in list(roles):
+            roles.update(self.get_junior_roles(role))
+        return roles
+
+
+class SessionMixin(object):
+    """Adds sessions to an RBAC.
+
+    A session belongs to a single user and has a subset of the roles of that
+    user activated; only permissions of activated roles are available through
+    the session. Sessions are kept in :attr:`session_store`.
+
+    The permissions of a session are materialized whenever roles are
+    activated or deactivated, making :meth:`authorized` a single subset test.
+    Changes to the permissions of roles are not picked up by existing sessions
+    until they (de)activate roles again."""
+
+    session_store = None
+    """The session store, see :class:`~alcohol.rbac.DictSessionStore`."""
+
+    def create_session(self, user, roles=()):
+        """Creates a new session for ``user``, activating ``roles``.
+
+        :return: A session identifier.
+        """
+        session = self.session_store.create(self._user_key(user))
+        if roles:
+            self.activate(session, roles)
+        return session
+
+    def delete_session(self, session):
+        self.session_store.delete(session)
+
+    def _available_roles(self, user):
+        return set(self._role_key(role)
+                   for role in self.get_authorized_roles(user))
+
+    def _get_permission_keys(self, roles):
+        permissions = set()
+        for role in roles:
+            permissions.update(self._permission_key(permission)
+                               for permission in
+                               self.get_role_permissions(role))
+        return permissions
+
+    def _set_active_roles(self, session, roles):
+        self.session_store.set_roles(session, roles,
+                                     self._get_permission_keys(roles))
+
+    # modification of session
+    def activate(self, session, roles=None):
+        """Activates ``roles`` in ``session``.
+
+        :param roles: Roles to activate. If ``None``, all roles available to
+                      the user are activated.
+        :raises ValueError: If any of the roles is not assigned to the user of
+                            the session.
+        """
+        available = self._available_roles(
+            self.session_store.get_user(session))
+
+        if roles is None:
+            roles = available
+        else:
+            roles = set(self._role_key(role) for role in roles)
+            if not roles <= available:
+                raise ValueError('Only roles assigned to the user of a '
+                                 'session can be activated.')
+
+        self._set_active_roles(session,
+                               self.session_store.get_roles(session) | roles)
+
+    def deactivate(self, session, roles=None):
+        """Deactivates ``roles``, or all roles if ``roles`` is ``None``."""
+        if roles is None:
+            active = set()
+        else:
+            active = self.session_store.get_roles(session) - set(
+                self._role_key(role) for role in roles)
+
+        self._set_active_roles(session, active)
+
     # checking
     def authorized(self, session, permissions):
-        raise NotImplementedError()
+        """Checks if all ``permissions`` are available in ``session``.
+
+        :param permissions: An iterable of permissions.
+        """
+        return self.session_store.has_permissions(
+            session, set(self._permission_key(permission)
+                         for permission in permissions))
+
+    # reflection
+    def get_active_roles(self, session):
+        return self.session_store.get_roles(session)
+
+
+class DictSessionStore(object):
+    """Keeps sessions in memory.
+
+    Session stores only deal with users, roles and permissions as stored by
+    the RBAC (e.g. primary keys for
+    :class:`~alcohol.rbac.sqlalchemy.SQLAlchemyRBAC`)."""
 
+    def __init__(self):
+        self._sessions = {}  # session -> (user, roles, permissions)
+
+    def create(self, user):
+        session = uuid.uuid4().hex
+        self._sessions[session] = user, frozenset(), frozenset()
+        return session
+
+    def delete(self, session):
+        self._sessions.pop(session, None)
+
+    def get_user(self, session):
+        return self._sessions[session][0]
+
+    def get_roles(self, session):
+        return set(self._sessions[session][1])
 
-class DictRBAC(FlatRBAC):
+    def set_roles(self, session, roles, permissions):
+        """Replaces active roles and the permissions they grant."""
+        self._sessions[session] = (self._sessions[session][0],
+                                   frozenset(roles), frozenset(permissions))
+
+    def has_permissions(self, session, permissions):
+        return self._sessions[session][2].issuperset(permissions)
+
+
+class DictRBAC(FlatRBAC, SessionMixin):
     def __init__(self):
         self._role_map = {}
         self._permission_map = {}
+        self.session_store = DictSessionStore()
+
+        # inverse indexes
+        self._user_map = {}  # role -> users
+        self._permission_role_map = {}  # permission -> roles
 
+    # all modifications go through the bulk methods, which send one signal
+    # once the change is complete
     def assign(self, user, role):
-        self._role_map.setdefault(user, set()).add(role)
+        self.assign_many([(user, role)])
 
     def unassign(self, user, role):
-        self._role_map.get(user, set()).discard(role)
+        self.unassign_many([(user, role)])
 
     def permit(self, role, permission):
-        self._permission_map.setdefault(role, set()).add(permission)
+        self.permit_many([(role, permission)])
 
     def revoke(self, role, permission):
-        self._permission_map.get(role, set()).discard(permission)
+        self.revoke_many([(role, permission)])
+
+    def assign_many(self, pairs):
+        pairs = list(pairs)
+        self._add_assignments(pairs)
+        self._notify(role_assigned, pairs)
+
+    def unassign_many(self, pairs):
+        pairs = list(pairs)
+        self._remove_assignments(pairs)
+        self._notify(role_unassigned, pairs)
+
+    def permit_many(self, pairs):
+        pairs = list(pairs)
+        self._add_permissions(pairs)
+        self._notify(permission_granted, pairs)
+
+    def revoke_many(self, pairs):
+        pairs = list(pairs)
+        self._remove_permissions(pairs)
+        self._notify(permission_revoked, pairs)
+
+    def _add_assignments(self, pairs):
+        role_map = self._role_map
+        user_map = self._user_map
+        for user, role in pairs:
+            role_map.setdefault(user, set()).add(role)
+            user_map.setdefault(role, set()).add(user)
+
+    def _remove_assignments(self, pairs):
+        role_map = self._role_map
+        user_map = self._user_map
+        for user, role in pairs:
+            if user in role_map:
+                role_map[user].discard(role)
+                user_map.get(role, set()).discard(user)
+
+    def _add_permissions(self, pairs):
+        permission_map = self._permission_map
+        permission_role_map = self._permission_role_map
+        for role, permission in pairs:
+            permission_map.setdefault(role, set()).add(permission)
+            permission_role_map.setdefault(permission, set()).add(role)
+
+    def _remove_permissions(self, pairs):
+        permission_map = self._permission_map
+        permission_role_map = self._permission_role_map
+        for role, permission in pairs:
+            if role in permission_map:
+                permission_map[role].discard(permission)
+                permission_role_map.get(permission, set()).discard(role)
 
     def allows(self, role, permission):
         return permission in self._permission_map.get(role, set())
 
+    def allowed_many(self, user, permissions):
+        permissions = set(permissions)
+        granted = set()
+        for role in self._role_map.get(user, ()):
+            granted.update(permissions.intersection(
+                self.get_role_permissions(role)))
+        return granted
+
+    def filter_allowed(self, users, permission):
+        roles = set(self.get_roles_with_permission(permission))
+        role_map = self._role_map
+        return [user for user in users
+                if not roles.isdisjoint(role_map.get(user, ()))]
+
     def get_assigned_roles(self, user):
         return self._role_map.get(user, set())
+
+    def get_users_with_role(self, role):
+        return iter(self._user_map.get(role, ()))
+
+    def get_roles_with_permission(self, permission):
+        return iter(self._permission_role_map.get(permission, ()))
+
+    def get_users_with_permission(self, permission):
+        seen = set()
+        for role in self.get_roles_with_permission(permission):
+            for user in self._user_map.get(role, ()):
+                if user not in seen:
+                    seen.add(user)
+                    yield user
+
+    def get_permissions(self, user):
+        seen = set()
+        for role in self._role_map.get(user, ()):
+            for permission in self.get_role_permissions(role):
+                if permission not in seen:
+                    seen.add(permission)
+                    yield permission
+
+    def get_role_permissions(self, role):
+        return self._permission_map.get(role, set())
+
+    def iter_assignments(self):
+        for user, roles in self._role_map.items():
+            for role in roles:
+                yield user, role
+
+    def iter_permissions(self):
+        for role, permissions in self._permission_map.items():
+            for permission in permissions:
+                yield role, permission
+
+    def dump(self, path, version=None):
+        """Writes a snapshot that can be opened using
+        :class:`~alcohol.rbac.snapshot.MappedRBAC`, see
+        :func:`alcohol.rbac.snapshot.dump`."""
+        from .snapshot import dump
+        dump(self, path, version)
+
+
+class DictHierarchicalRBAC(DictRBAC, HierarchicalRBAC):
+    """In-memory :class:`~alcohol.rbac.HierarchicalRBAC`.
+
+    Besides the transitive closure, the effective permissions of every role
+    are kept, making :meth:`allows` a single set lookup."""
+
+    def __init__(self):
+        super(DictHierarchicalRBAC, self).__init__()
+        self._juniors = {}  # direct inheritance
+        self._closure = {}  # role -> all juniors
+        self._seniors = {}  # role -> all seniors
+        self._effective = {}  # role -> all permissions, including inherited
+
+    def _has_permission(self, role, permission):
+        if permission in self._permission_map.get(role, ()):
+            return True
+        return any(permission in self._permission_map.get(junior, ())
+                   for junior in self._closure.get(role, ()))
+
+    def add_inheritance(self, senior, junior):
+        if senior == junior or senior in self._closure.get(junior, ()):
+            raise ValueError('Inheritance of {!r} from {!r} would create a '
+                             'cycle.'.format(senior, junior))
+
+        self._juniors.setdefault(senior, set()).add(junior)
+
+        seniors = self._seniors.get(senior, set()) | set([senior])
+        juniors = self._closure.get(junior, set()) | set([junior])
+        inherited = self._effective.get(junior, set())
+
+        for role in seniors:
+            self._closure.setdefault(role, set()).update(juniors)
+            if inherited:
+                self._effective.setdefault(role, set()).update(inherited)
+        for role in juniors:
+            self._seniors.setdefault(role, set()).update(seniors)
+
+        self._notify(role_inherited, [(senior, junior)])
+
+    def remove_inheritance(self, senior, junior):
+        if junior in self._juniors.get(senior, ()):
+            self._remove_inheritance(senior, junior)
+        self._notify(role_disinherited, [(senior, junior)])
+
+    def _remove_inheritance(self, senior, junior):
+        self._juniors[senior].discard(junior)
+
+        # recompute everything that was reachable from the removed edge
+        for role in self._seniors.get(senior, set()) | set([senior]):
+            closure = set()
+            stack = list(self._juniors.get(role, ()))
+            while stack:
+                r = stack.pop()
+                if r not in closure:
+                    closure.add(r)
+                    stack.extend(self._juniors.get(r, ()))
+
+            for r in self._closure.get(role, set()) - closure:
+                self._seniors[r].discard(role)
+            self._closure[role] = closure
+
+            effective = set(self._permission_map.get(role, ()))
+            for r in closure:
+                effective.update(self._permission_map.get(r, ()))
+            self._effective[role] = effective
+
+    def _add_permissions(self, pairs):
+        super(DictHierarchicalRBAC, self)._add_permissions(pairs)
+        for role, permission in pairs:
+            for r in self._seniors.get(role, set()) | set([role]):
+                self._effective.setdefault(r, set()).add(permission)
+
+    def _remove_permissions(self, pairs):
+        super(DictHierarchicalRBAC, self)._remove_permissions(pairs)
+        for role, permission in pairs:
+            for r in self._seniors.get(role, set()) | set([role]):
+                if not self._has_permission(r, permission):
+                    self._effective.get(r, set()).discard(permission)
+
+    def allows(self, role, permission):
+        return permission in self._effective.get(role, ())
+
+    def get_roles_with_permission(self, permission):
+        roles = set()
+        for role in self._permission_role_map.get(permission, ()):
+            roles.add(role)
+            roles.update(self._seniors.get(role, ()))
+        return iter(roles)
+
+    def get_junior_roles(self, role):
+        return self._closure.get(role, set())
+
+    def get_role_permissions(self, role):
+        return self._effective.get(role, set())
+
+    def iter_permissions(self):
+        for role, permissions in self._effective.items():
+            for permission in permissions:
+                yield role, permission
+
+
+class _Interner(object):
+    """Maps objects onto consecutive integers and back. Ids are never
+    reused."""
+
+    def __init__(self):
+        self.ids = {}
+        self.objects = []
+
+    def intern(self, obj):
+        oid = self.ids.get(obj)
+        if oid is None:
+            oid = self.ids[obj] = len(self.objects)
+            self.objects.append(obj)
+        return oid
+
+
+class FrozenRBAC(FlatRBAC):
+    """A compiled, read-only snapshot of another
+    :class:`~alcohol.rbac.FlatRBAC`.
+
+    Users, roles and permissions are interned to integers. The permissions of
+    every role and the effective permissions of every user are precomputed
+    as integer bitsets indexed by permission id, turning :meth:`allowed`
+    into two dictionary lookups and a bit test. Users with the same set of
+    roles share their role set and bitset.
+
+    Since a snapshot never changes after creation, it can be shared between
+    threads without locking. To update, create a new snapshot and replace the
+    reference to the old one, which is atomic.
+
+    Any attempt at modification raises a :class:`TypeError`.
+
+    Checks accept whatever the source accepts, but users, roles and
+    permissions are stored as the source stores them. Reflection therefore
+    returns those, which are primary keys instead of instances for a
+    :class:`~alcohol.rbac.sqlalchemy.SQLAlchemyRBAC`.
+
+    :param rbac: The RBAC to take a snapshot of. Must support
+                 :meth:`~alcohol.rbac.FlatRBAC.iter_assignments` and
+                 :meth:`~alcohol.rbac.FlatRBAC.iter_permissions`.
+    """
+
+    def __init__(self, rbac):
+        # users, roles and permissions are normalized the same way as the
+        # source does it
+        self._user_key = rbac._user_key
+        self._role_key = rbac._role_key
+        self._permission_key = rbac._permission_key
+
+        users = self._users = _Interner()
+        roles = self._roles = _Interner()
+        perms = self._permissions = _Interner()
+
+        role_bits = []  # role id -> permission bitset
+        for role, permission in rbac.iter_permissions():
+            rid = roles.intern(role)
+            if rid == len(role_bits):
+                role_bits.append(0)
+            role_bits[rid] |= 1 << perms.intern(permission)
+
+        user_rids = []  # user id -> set of role ids
+        for user, role in rbac.iter_assignments():
+            uid = users.intern(user)
+            if uid == len(user_rids):
+                user_rids.append(set())
+            user_rids[uid].add(roles.intern(role))
+        role_bits.extend([0] * (len(roles.objects) - len(role_bits)))
+
+        shared = {}
+        user_roles = []  # user id -> frozenset of roles
+        user_bits = []  # user id -> effective permission bitset
+        for rids in user_rids:
+            rids = frozenset(rids)
+            if rids not in shared:
+                bits = 0
+                for rid in rids:
+                    bits |= role_bits[rid]
+                shared[rids] = (frozenset(roles.objects[rid] for rid in rids),
+                                bits)
+            user_roles.append(shared[rids][0])
+            user_bits.append(shared[rids][1])
+
+        self._role_bits = role_bits
+        self._user_roles = user_roles
+        self._user_bits = user_bits
+
+    def _read_only(self, *args):
+        raise TypeError('FrozenRBAC instances cannot be modified.')
+
+    assign = unassign = permit = revoke = _read_only
+
+    def _decode_bits(self, bits):
+        objects = self._permissions.objects
+        return frozenset(objects[pid] for pid in range(bits.bit_length())
+                         if bits >> pid & 1)
+
+    def allows(self, role, permission):
+        rid = self._roles.ids.get(self._role_key(role))
+        pid = self._permissions.ids.get(self._permission_key(permission))
+        if rid is None or pid is None:
+            return False
+        return bool(self._role_bits[rid] >> pid & 1)
+
+    def allowed(self, user, permission):
+        uid = self._users.ids.get(self._user_key(user))
+        pid = self._permissions.ids.get(self._permission_key(permission))
+        if uid is None or pid is None:
+            return False
+        return bool(self._user_bits[uid] >> pid & 1)
+
+    def get_assigned_roles(self, user):
+        uid = self._users.ids.get(self._user_key(user))
+        if uid is None:
+            return frozenset()
+        return self._user_roles[uid]
+
+    def get_role_permissions(self, role):
+        rid = self._roles.ids.get(self._role_key(role))
+        if rid is None:
+            return frozenset()
+        return self._decode_bits(self._role_bits[rid])
+
+    def iter_assignments(self):
+        for user, roles in zip(self._users.objects, self._user_roles):
+            for role in roles:
+                yield user, role
+
+    def iter_permissions(self):
+        for role, bits in zip(self._roles.objects, self._role_bits):
+            for permission in self._decode_bits(bits):
+                yield role, permission
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# coding=utf8
+
+"""Counts the queries and result rows caused by loading users of a
+:class:`~alcohol.rbac.sqlalchemy.SQLAlchemyRBAC`, for various relationship
+loading strategies.
+
+Can be run as a script, printing a table of counts::
+
+    python -m alcohol.rbac.benchmark --users 100 --roles 10 --permissions 50
+"""
+
+from __future__ import absolute_import
+
+from collections import namedtuple
+from contextlib import contextmanager
+import random
+import weakref
+
+from sqlalchemy import Column, Integer, create_engine, event
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+from .sqlalchemy import SQLAlchemyRBAC
+
+STRATEGIES = ['joined', 'selectin', 'select', 'dynamic', 'raise']
+
+LoadCount = namedtuple('LoadCount', ['strategy', 'with_rbac', 'checks',
+                                     'queries', 'rows'])
+"""Result of :func:`count_loading`."""
+
+
+class _Proxy(object):
+    # passes attribute access on to a wrapped DBAPI object
+
+    def __init__(self, wrapped, counters):
+        object.__setattr__(self, '_wrapped', wrapped)
+        object.__setattr__(self, '_counters', counters)
+
+    def __getattr__(self, name):
+        return getattr(self._wrapped, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._wrapped, name, value)
+
+
+class _CountingCursor(_Proxy):
+    # adds the rows fetched to all active counters
+
+    def _count(self, n):
+        for counter in self._counters:
+            counter.rows += n
+
+    def fetchone(self):
+        row = self._wrapped.fetchone()
+        if row is not None:
+            self._count(1)
+        return row
+
+    def fetchmany(self, *args):
+        rows = self._wrapped.fetchmany(*args)
+        self._count(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._wrapped.fetchall()
+        self._count(len(rows))
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+
+class _CountingConnection(_Proxy):
+    def cursor(self, *args, **kwargs):
+        return _CountingCursor(self._wrapped.cursor(*args, **kwargs),
+                               self._counters)
+
+
+# engine -> list of active counters
+_row_counters = weakref.WeakKeyDictionary()
+
+
+def enable_row_counting(engine):
+    """Makes the rows returned through ``engine`` countable using
+    :func:`count_rows`, by wrapping every DBAPI connection it opens. Must be
+    called before the engine connects for the first time, rows fetched using
+    connections opened earlier are not counted."""
+    if engine in _row_counters:
+        return
+    counters = _row_counters[engine] = []
+
+    def connect(dialect, conn_rec, cargs, cparams):
+        return _CountingConnection(dialect.connect(*cargs, **cparams),
+                                   counters)
+
+    event.listen(engine, 'do_connect', connect)
+
+
+class RowCounter(object):
+    """Counts the statements executed on an engine and the rows returned by
+    them, see :func:`count_rows`."""
+
+    def __init__(self):
+        self.queries = 0
+        self.rows = 0
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        self.queries += 1
+
+
+@contextmanager
+def count_rows(engine):
+    """Counts all statements executed on ``engine`` inside the ``with``
+    block, and the rows they return::
+
+        enable_row_counting(engine)  # before connecting
+        with count_rows(engine) as counter:
+            session.query(User).all()
+        print(counter.queries, counter.rows)
+
+    Rows are counted as they are fetched from the cursor, so rows that are
+    never fetched (e.g. when using :meth:`~sqlalchemy.orm.Query.first`) are
+    not included.
+
+    :raises TypeError: If :func:`enable_row_counting` has not been called
+                       for ``engine``.
+    """
+    counters = _row_counters.get(engine)
+    if counters is None:
+        raise TypeError('Call enable_row_counting() before the engine '
+                        'connects to count rows.')
+
+    counter = RowCounter()
+    counters.append(counter)
+    event.listen(engine, 'after_cursor_execute',
+                 counter._after_cursor_execute)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, 'after_cursor_execute',
+                     counter._after_cursor_execute)
+        counters.remove(counter)
+
+
+def create_database(strategy, users=100, roles=10, permissions=50,
+                    roles_per_user=3, permissions_per_role=10,
+                    url='sqlite://', seed=0):
+    """Creates a database with random assignments and permissions.
+
+    :param strategy: The ``lazy`` argument for both relationships of the
+                     RBAC.
+    :return: A tuple of ``(acl, session)``. The models are available as
+             ``acl.user_type`` etc.
+    """
+    Base = declarative_base()
+
+    class User(Base):
+        __tablename__ = 'users'
+        id = Column(Integer, primary_key=True)
+
+    class Role(Base):
+        __tablename__ = 'roles'
+        id = Column(Integer, primary_key=True)
+
+    class Permission(Base):
+        __tablename__ = 'permissions'
+        id = Column(Integer, primary_key=True)
+
+    acl = SQLAlchemyRBAC(User, Role, Permission, roles_lazy=strategy,
+                         permissions_lazy=strategy)
+
+    engine = create_engine(url)
+    enable_row_counting(engine)
+    Base.metadata.create_all(engine)
+    session = acl.session = sessionmaker(bind=engine)()
+
+    for model, count in ((User, users), (Role, roles),
+                         (Permission, permissions)):
+        session.execute(model.__table__.insert(),
+                        [{'id': i} for i in range(count)])
+
+    rnd = random.Random(seed)
+    acl.assign_many((u, r) for u in range(users)
+                    for r in rnd.sample(range(roles), roles_per_user))
+    acl.permit_many((r, p) for r in range(roles)
+                    for p in rnd.sample(range(permissions),
+                                        permissions_per_role))
+    session.commit()
+
+    return acl, session
+
+
+def count_loading(acl, session, strategy=None, with_rbac=False, checks=0):
+    """Loads all users and counts the queries and rows needed.
+
+    :param strategy: Only used to label the result.
+    :param with_rbac: Whether to use
+                      :meth:`~alcohol.rbac.sqlalchemy.SQLAlchemyRBAC.with_rbac`
+                      when loading.
+    :param checks: Number of permissions checked for every user using
+                   :meth:`~alcohol.rbac.sqlalchemy.SQLAlchemyRBAC.allowed`.
+    :return: A :class:`LoadCount` instance.
+    """
+    session.expunge_all()
+    permissions = session.query(acl.permission_type).order_by(
+        acl.permission_type.id).limit(checks).all() if checks else []
+
+    with count_rows(session.get_bind()) as counter:
+        query = session.query(acl.user_type)
+        if with_rbac:
+            query = query.options(acl.with_rbac())
+
+        for user in query.all():
+            for perm in permissions:
+                acl.allowed(user, perm)
+
+    return LoadCount(strategy, with_rbac, checks, counter.queries,
+                     counter.rows)
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('strategies', nargs='*', default=STRATEGIES,
+                        help='Relationship loading strategies to compare.')
+    parser.add_argument('-u', '--users', type=int, default=100)
+    parser.add_argument('-r', '--roles', type=int, default=10)
+    parser.add_argument('-p', '--permissions', type=int, default=50)
+    parser.add_argument('--roles-per-user', type=int, default=3)
+    parser.add_argument('--permissions-per-role', type=int, default=10)
+    parser.add_argument('-c', '--checks', type=int, default=5,
+                        help='Permissions checked per user.')
+    parser.add_argument('--url', default='sqlite://',
+                        help='Database to create the tables in.')
+    args = parser.parse_args(argv)
+
+    fmt = '{:<10} {:<10} {:>7} {:>8} {:>10}'
+    print(fmt.format('strategy', 'with_rbac', 'checks', 'queries', 'rows'))
+
+    for strategy in args.strategies:
+        acl, session = create_database(
+            strategy, args.users, args.roles, args.permissions,
+            args.roles_per_user, args.permissions_per_role, args.url)
+
+        # dynamic relationships cannot be loaded eagerly
+        options = [(False, 0), (False, args.checks)]
+        if strategy != 'dynamic':
+            options.append((True, args.checks))
+
+        for with_rbac, checks in options:
+            result = count_loading(acl, session, strategy, with_rbac, checks)
+            print(fmt.format(strategy, str(with_rbac), checks,
+                             result.queries, result.rows))
+
+        session.close()
+        acl.user_type.metadata.drop_all(session.get_bind())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+from __future__ import absolute_import
+
+import threading
+import time
+
+from ..cache import LRUCache
+from . import DictSessionStore, FlatRBAC, SessionMixin
+
+_missing = object()
+
+
+class CachedRBAC(FlatRBAC, SessionMixin):
+    """Memoizes :meth:`allowed`, :meth:`allows` and :meth:`get_assigned_roles`
+    of another :class:`~alcohol.rbac.FlatRBAC`.
+
+    Modifications made through the cache are passed on to the wrapped RBAC
+    and invalidate exactly the affected entries: Changing a user's roles drops
+    the cached results for that user, changing a role's permissions drops
+    the cached results involving that permission. Modifications made to the
+    wrapped RBAC directly are not noticed; use :meth:`invalidate` or
+    :meth:`clear` in that case.
+
+    :param rbac: The RBAC to wrap.
+    :param maxsize: Maximum number of cached results.
+    :param ttl: If not ``None``, results expire after this many seconds.
+    :param clock: Function returning the current time in seconds.
+    """
+
+    def __init__(self, rbac, maxsize=4096, ttl=None, clock=time.time):
+        self.rbac = rbac
+
+        self._user_key = rbac._user_key
+        self._role_key = rbac._role_key
+        self._permission_key = rbac._permission_key
+
+        self.session_store = DictSessionStore()
+
+        self._cache = LRUCache(maxsize, ttl, on_evict=self._forget,
+                               clock=clock)
+
+        # cache keys by user, role and permission, for invalidation. cache
+        # keys are tuples of a type and the references ('u', user),
+        # ('r', role) and ('p', permission) these are indexed by
+        self._index = {}
+
+        # checked before storing results, to avoid storing results computed
+        # concurrently with an invalidation
+        self._version = 0
+
+        # guards the index. always acquired before the lock of the cache
+        # itself, since evictions call back into _forget
+        self._lock = threading.RLock()
+
+    def _forget(self, key):
+        for ref in key[1:]:
+            keys = self._index.get(ref)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._index[ref]
+
+    def _cached(self, key, compute):
+        with self._lock:
+            value = self._cache.get(key, _missing)
+        if value is not _missing:
+            return value
+
+        version = self._version
+        value = compute()
+
+        with self._lock:
+            if version == self._version:
+                self._cache.set(key, value)
+                for ref in key[1:]:
+                    self._index.setdefault(ref, set()).add(key)
+
+        return value
+
+    def _invalidate(self, refs):
+        with self._lock:
+            self._version += 1
+            for ref in refs:
+                for key in list(self._index.get(ref, ())):
+                    self._cache.pop(key)
+                    self._forget(key)
+
+    def invalidate(self, users=(), roles=(), permissions=()):
+        """Drops the cached results involving any of ``users``, ``roles``
+        or ``permissions``, e.g. after the wrapped RBAC was modified by
+        another process. Note that results of :meth:`allowed` are not
+        associated with roles, invalidate the permissions of a role instead.
+        """
+        refs = set(('u', self._user_key(u)) for u in users)
+        refs.update(('r', self._role_key(r)) for r in roles)
+        refs.update(('p', self._permission_key(p)) for p in permissions)
+        self._invalidate(refs)
+
+    def clear(self):
+        """Drops all cached results."""
+        with self._lock:
+            self._version += 1
+            self._cache.clear()
+            self._index.clear()
+
+    def cache_info(self):
+        """Returns hit, miss and eviction counters, see
+        :meth:`~alcohol.cache.LRUCache.cache_info`."""
+        return self._cache.cache_info()
+
+    # modification
+    def assign_many(self, pairs):
+        pairs = list(pairs)
+        self.rbac.assign_many(pairs)
+        self._invalidate(set(('u', self._user_key(u)) for u, _ in pairs))
+
+    def unassign_many(self, pairs):
+        pairs = list(pairs)
+        self.rbac.unassign_many(pairs)
+        self._invalidate(set(('u', self._user_key(u)) for u, _ in pairs))
+
+    def permit_many(self, pairs):
+        pairs = list(pairs)
+        self.rbac.permit_many(pairs)
+        self._invalidate(set(('p', self._permission_key(p))
+                             for _, p in pairs))
+
+    def revoke_many(self, pairs):
+        pairs = list(pairs)
+        self.rbac.revoke_many(pairs)
+        self._invalidate(set(('p', self._permission_key(p))
+                             for _, p in pairs))
+
+    def assign(self, user, role):
+        self.assign_many([(user, role)])
+
+    def unassign(self, user, role):
+        self.unassign_many([(user, role)])
+
+    def permit(self, role, permission):
+        self.permit_many([(role, permission)])
+
+    def revoke(self, role, permission):
+        self.revoke_many([(role, permission)])
+
+    # checking
+    def allows(self, role, permission):
+        key = ('allows', ('r', self._role_key(role)),
+               ('p', self._permission_key(permission)))
+        return self._cached(key, lambda: self.rbac.allows(role, permission))
+
+    def allowed(self, user, permission):
+        key = ('allowed', ('u', self._user_key(user)),
+               ('p', self._permission_key(permission)))
+        return self._cached(key, lambda: self.rbac.allowed(user, permission))
+
+    # reflection
+    def get_assigned_roles(self, user):
+        key = ('roles', ('u', self._user_key(user)))
+        return self._cached(
+            key, lambda: frozenset(self.rbac.get_assigned_roles(user)))
+
+    def get_authorized_roles(self, user):
+        return self.rbac.get_authorized_roles(user)
+
+    def get_role_permissions(self, role):
+        return self.rbac.get_role_permissions(role)
+
+    def get_users_with_role(self, role):
+        return self.rbac.get_users_with_role(role)
+
+    def get_roles_with_permission(self, permission):
+        return self.rbac.get_roles_with_permission(permission)
+
+    def get_users_with_permission(self, permission):
+        return self.rbac.get_users_with_permission(permission)
+
+    def get_permissions(self, user):
+        return self.rbac.get_permissions(user)
+
+    def iter_assignments(self):
+        return self.rbac.iter_assignments()
+
+    def iter_permissions(self):
+        return self.rbac.iter_permissions()
@@ -0,0 +1,241 @@
+from __future__ import absolute_import
+
+from array import array
+from bisect import bisect_left
+
+from .. import (permission_granted, permission_revoked, role_assigned,
+                role_unassigned)
+from . import DictSessionStore, FlatRBAC, SessionMixin, _Interner
+
+
+class CompactRBAC(FlatRBAC, SessionMixin):
+    """An in-memory RBAC like :class:`~alcohol.rbac.DictRBAC` that stores
+    integer ids instead of sets of objects.
+
+    Users, roles and permissions are interned to integers. The roles of each
+    user are stored as a sorted :class:`array.array` of role ids, the
+    permissions of each role as an integer bitset. :meth:`allows` is a single
+    bit test, while :meth:`allowed` tests the bitsets of the user's roles one
+    by one until a role grants the permission. Every user, role and
+    permission is still kept once in the interning tables, so savings depend
+    on how many assignments there are per user. Since all state consists of
+    lists, arrays and integers, pickling is cheap as well.
+
+    Interned ids are kept when roles are unassigned or permissions revoked,
+    so memory is not reclaimed until the RBAC is rebuilt.
+    """
+
+    def __init__(self):
+        self._users = _Interner()
+        self._roles = _Interner()
+        self._permissions = _Interner()
+
+        self._user_roles = []  # user id -> array of role ids, or None
+        self._role_bits = []  # role id -> permission bitset
+
+        self.session_store = DictSessionStore()
+
+    def _user_id(self, user):
+        uid = self._users.intern(user)
+        if uid == len(self._user_roles):
+            self._user_roles.append(None)
+        return uid
+
+    def _role_id(self, role):
+        rid = self._roles.intern(role)
+        if rid == len(self._role_bits):
+            self._role_bits.append(0)
+        return rid
+
+    # modification. like DictRBAC, everything goes through the bulk methods,
+    # which send one signal each
+    def assign(self, user, role):
+        self.assign_many([(user, role)])
+
+    def unassign(self, user, role):
+        self.unassign_many([(user, role)])
+
+    def permit(self, role, permission):
+        self.permit_many([(role, permission)])
+
+    def revoke(self, role, permission):
+        self.revoke_many([(role, permission)])
+
+    def _assign(self, user, role):
+        uid = self._user_id(user)
+        rid = self._role_id(role)
+
+        roles = self._user_roles[uid]
+        if roles is None:
+            self._user_roles[uid] = array('I', [rid])
+            return
+
+        i = bisect_left(roles, rid)
+        if i == len(roles) or roles[i] != rid:
+            roles.insert(i, rid)
+
+    def _unassign(self, user, role):
+        uid = self._users.ids.get(user)
+        rid = self._roles.ids.get(role)
+        if uid is None or rid is None:
+            return
+
+        roles = self._user_roles[uid]
+        if roles is None:
+            return
+
+        i = bisect_left(roles, rid)
+        if i < len(roles) and roles[i] == rid:
+            del roles[i]
+
+    def _permit(self, role, permission):
+        rid = self._role_id(role)
+        pid = self._permissions.intern(permission)
+        self._role_bits[rid] |= 1 << pid
+
+    def _revoke(self, role, permission):
+        rid = self._roles.ids.get(role)
+        pid = self._permissions.ids.get(permission)
+        if rid is not None and pid is not None:
+            self._role_bits[rid] &= ~(1 << pid)
+
+    def assign_many(self, pairs):
+        pairs = list(pairs)
+        if len(pairs) == 1:
+            self._assign(*pairs[0])
+            self._notify(role_assigned, pairs)
+            return
+
+        # merging once per user is cheaper than inserting one by one
+        added = {}
+        for user, role in pairs:
+            added.setdefault(self._user_id(user), set()).add(
+                self._role_id(role))
+
+        user_roles = self._user_roles
+        for uid, rids in added.items():
+            if user_roles[uid] is not None:
+                rids.update(user_roles[uid])
+            user_roles[uid] = array('I', sorted(rids))
+
+        self._notify(role_assigned, pairs)
+
+    def unassign_many(self, pairs):
+        pairs = list(pairs)
+        for user, role in pairs:
+            self._unassign(user, role)
+        self._notify(role_unassigned, pairs)
+
+    def permit_many(self, pairs):
+        pairs = list(pairs)
+        for role, permission in pairs:
+            self._permit(role, permission)
+        self._notify(permission_granted, pairs)
+
+    def revoke_many(self, pairs):
+        pairs = list(pairs)
+        for role, permission in pairs:
+            self._revoke(role, permission)
+        self._notify(permission_revoked, pairs)
+
+    # checking
+    def _user_bits(self, uid):
+        roles = self._user_roles[uid]
+        if roles is None:
+            return 0
+
+        bits = 0
+        role_bits = self._role_bits
+        for rid in roles:
+            bits |= role_bits[rid]
+        return bits
+
+    def allows(self, role, permission):
+        rid = self._roles.ids.get(role)
+        pid = self._permissions.ids.get(permission)
+        if rid is None or pid is None:
+            return False
+        return bool(self._role_bits[rid] >> pid & 1)
+
+    def allowed(self, user, permission):
+        uid = self._users.ids.get(user)
+        pid = self._permissions.ids.get(permission)
+        if uid is None or pid is None:
+            return False
+
+        roles = self._user_roles[uid]
+        if roles is None:
+            return False
+
+        role_bits = self._role_bits
+        for rid in roles:
+            if role_bits[rid] >> pid & 1:
+                return True
+        return False
+
+    def allowed_many(self, user, permissions):
+        uid = self._users.ids.get(user)
+        if uid is None:
+            return set()
+
+        bits = self._user_bits(uid)
+        perm_ids = self._permissions.ids
+        return set(permission for permission in permissions
+                   if permission in perm_ids and
+                   bits >> perm_ids[permission] & 1)
+
+    def filter_allowed(self, users, permission):
+        pid = self._permissions.ids.get(permission)
+        if pid is None:
+            return []
+
+        allowed_rids = set(rid for rid, bits in enumerate(self._role_bits)
+                           if bits >> pid & 1)
+        user_ids = self._users.ids
+        user_roles = self._user_roles
+        return [user for user in users
+                if user in user_ids and
+                user_roles[user_ids[user]] is not None and
+                not allowed_rids.isdisjoint(user_roles[user_ids[user]])]
+
+    # reflection
+    def _decode_bits(self, bits):
+        objects = self._permissions.objects
+        permissions = set()
+        pid = 0
+        while bits:
+            if bits & 1:
+                permissions.add(objects[pid])
+            bits >>= 1
+            pid += 1
+        return permissions
+
+    def get_assigned_roles(self, user):
+        uid = self._users.ids.get(user)
+        if uid is None or self._user_roles[uid] is None:
+            return set()
+        objects = self._roles.objects
+        return set(objects[rid] for rid in self._user_roles[uid])
+
+    def get_role_permissions(self, role):
+        rid = self._roles.ids.get(role)
+        if rid is None:
+            return set()
+        return self._decode_bits(self._role_bits[rid])
+
+    def get_permissions(self, user):
+        uid = self._users.ids.get(user)
+        if uid is None:
+            return iter(())
+        return iter(self._decode_bits(self._user_bits(uid)))
+
+    def iter_assignments(self):
+        roles = self._roles.objects
+        for user, rids in zip(self._users.objects, self._user_roles):
+            for rid in rids or ():
+                yield user, roles[rid]
+
+    def iter_permissions(self):
+        for role, bits in zip(self._roles.objects, self._role_bits):
+            for permission in self._decode_bits(bits):
+                yield role, permission
@@ -0,0 +1,344 @@
+"""Binary RBAC snapshots that are used in place through :mod:`mmap`.
+
+A snapshot file starts with a header containing a format version and a
+snapshot version, followed by three tables of users, roles and permissions
+and two lists of ids connecting them. Each table is sorted by the encoded
+form of its entries, so lookups are binary searches on the mapped file
+instead of requiring a dictionary in every process. Forked processes that
+open the same file share its pages.
+
+Users, roles and permissions must be ``None``, booleans, integers, strings,
+byte strings or tuples of these.
+"""
+
+from __future__ import absolute_import
+
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+from six import binary_type, integer_types, text_type
+
+from . import FlatRBAC
+
+MAGIC = b'ALCRBAC\x00'
+FORMAT_VERSION = 1
+
+_header = struct.Struct('<8sIQIII')  # magic, format, version, counts
+_u32 = struct.Struct('<I')
+_u64 = struct.Struct('<Q')
+
+
+def _encode(obj):
+    # equal objects must encode equally, hence bools are stored as integers
+    if obj is None:
+        return b'n'
+    if isinstance(obj, integer_types):  # includes bool
+        return b'i' + str(int(obj)).encode('ascii')
+    if isinstance(obj, text_type):
+        return b's' + obj.encode('utf8')
+    if isinstance(obj, binary_type):
+        return b'b' + obj
+    if isinstance(obj, tuple):
+        parts = [b't', _u32.pack(len(obj))]
+        for item in obj:
+            item = _encode(item)
+            parts.append(_u32.pack(len(item)))
+            parts.append(item)
+        return b''.join(parts)
+    raise TypeError('Cannot store {!r} in a snapshot.'.format(obj))
+
+
+def _decode(buf):
+    tag, data = buf[:1], buf[1:]
+    if tag == b'n':
+        return None
+    if tag == b'i':
+        return int(data)
+    if tag == b's':
+        return data.decode('utf8')
+    if tag == b'b':
+        return data
+    if tag == b't':
+        count, = _u32.unpack_from(data, 0)
+        items = []
+        pos = _u32.size
+        for _ in range(count):
+            size, = _u32.unpack_from(data, pos)
+            pos += _u32.size
+            items.append(_decode(data[pos:pos + size]))
+            pos += size
+        return tuple(items)
+    raise ValueError('Corrupt snapshot entry.')
+
+
+def _pack_table(encoded):
+    offsets = [0]
+    for buf in encoded:
+        offsets.append(offsets[-1] + len(buf))
+    return (struct.pack('<{}Q'.format(len(offsets)), *offsets) +
+            b''.join(encoded))
+
+
+def _pack_lists(lists):
+    starts = [0]
+    for ids in lists:
+        starts.append(starts[-1] + len(ids))
+    flat = [i for ids in lists for i in ids]
+    return (struct.pack('<{}I'.format(len(starts)), *starts) +
+            struct.pack('<{}I'.format(len(flat)), *flat))
+
+
+def dump(rbac, path, version=None):
+    """Writes a snapshot of ``rbac`` to ``path``.
+
+    The file is written to a uniquely named temporary file next to ``path``
+    first, then renamed, so readers never see a partially written snapshot.
+    Like all files created by :func:`tempfile.mkstemp`, the snapshot is only
+    accessible by its owner. Processes that still have the old file mapped
+    keep using it until they reopen.
+
+    :param rbac: The RBAC to store. Must support
+                 :meth:`~alcohol.rbac.FlatRBAC.iter_assignments` and
+                 :meth:`~alcohol.rbac.FlatRBAC.iter_permissions`.
+    :param path: Name of the file to write.
+    :param version: The snapshot version, an unsigned 64-bit integer that
+                    should increase with every snapshot. Defaults to the
+                    current time in microseconds.
+    """
+    if version is None:
+        version = int(time.time() * 1000000)
+
+    assignments = list(rbac.iter_assignments())
+    permissions = list(rbac.iter_permissions())
+
+    def index(objs):
+        encoded = sorted(set(_encode(obj) for obj in objs))
+        return encoded, dict((buf, i) for i, buf in enumerate(encoded))
+
+    users, user_ids = index(u for u, _ in assignments)
+    roles, role_ids = index([r for _, r in assignments] +
+                            [r for r, _ in permissions])
+    perms, perm_ids = index(p for _, p in permissions)
+
+    user_roles = [set() for _ in users]
+    for user, role in assignments:
+        user_roles[user_ids[_encode(user)]].add(role_ids[_encode(role)])
+
+    role_perms = [set() for _ in roles]
+    for role, perm in permissions:
+        role_perms[role_ids[_encode(role)]].add(perm_ids[_encode(perm)])
+
+    # a unique name, so concurrent writers do not clobber each other's files
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                    prefix=os.path.basename(path) + '.',
+                                    suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_header.pack(MAGIC, FORMAT_VERSION, version, len(users),
+                                 len(roles), len(perms)))
+            for table in users, roles, perms:
+                f.write(_pack_table(table))
+            f.write(_pack_lists([sorted(ids) for ids in user_roles]))
+            f.write(_pack_lists([sorted(ids) for ids in role_perms]))
+
+        # os.rename does not replace existing files on windows
+        getattr(os, 'replace', os.rename)(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _read_header(buf):
+    magic, fmt, version, n_users, n_roles, n_perms = _header.unpack_from(
+        buf, 0)
+    if magic != MAGIC:
+        raise ValueError('Not an RBAC snapshot.')
+    if fmt != FORMAT_VERSION:
+        raise ValueError('Unsupported snapshot format {}.'.format(fmt))
+    return version, n_users, n_roles, n_perms
+
+
+def read_version(path):
+    """Returns the version of the snapshot stored in ``path``, reading only
+    its header."""
+    with open(path, 'rb') as f:
+        return _read_header(f.read(_header.size))[0]
+
+
+class _Table(object):
+    # a sorted table of encoded objects inside the mapped file
+
+    def __init__(self, buf, pos, count):
+        self.buf = buf
+        self.count = count
+        self.offsets = pos
+        self.data = pos + (count + 1) * _u64.size
+        self.end = self.data + self._offset(count)
+
+    def _offset(self, i):
+        return _u64.unpack_from(self.buf, self.offsets + i * _u64.size)[0]
+
+    def encoded(self, i):
+        return self.buf[self.data + self._offset(i):
+                        self.data + self._offset(i + 1)]
+
+    def __getitem__(self, i):
+        return _decode(self.encoded(i))
+
+    def find(self, obj):
+        try:
+            key = _encode(obj)
+        except TypeError:
+            return None
+
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.encoded(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self.encoded(lo) == key:
+            return lo
+
+
+class _Lists(object):
+    # one sorted list of ids for every entry of a table
+
+    def __init__(self, buf, pos, count):
+        self.buf = buf
+        self.starts = pos
+        self.ids = pos + (count + 1) * _u32.size
+        self.end = self.ids + self._start(count) * _u32.size
+
+    def _start(self, i):
+        return _u32.unpack_from(self.buf, self.starts + i * _u32.size)[0]
+
+    def _id(self, i):
+        return _u32.unpack_from(self.buf, self.ids + i * _u32.size)[0]
+
+    def __getitem__(self, i):
+        start, end = self._start(i), self._start(i + 1)
+        return struct.unpack_from('<{}I'.format(end - start), self.buf,
+                                  self.ids + start * _u32.size)
+
+    def contains(self, i, value):
+        lo, hi = self._start(i), self._start(i + 1)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._id(mid) < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo < self._start(i + 1) and self._id(lo) == value
+
+
+class MappedRBAC(FlatRBAC):
+    """A read-only RBAC backed by a memory-mapped snapshot file, see
+    :func:`dump`.
+
+    Opening a snapshot only reads its header; everything else is looked up
+    in the mapped file on demand. Like :class:`~alcohol.rbac.FrozenRBAC`, any
+    attempt at modification raises a :class:`TypeError`.
+
+    :param path: Name of the snapshot file.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # the version is public, for comparing snapshots
+        self.version, n_users, n_roles, n_perms = _read_header(self._mmap)
+
+        self._users = _Table(self._mmap, _header.size, n_users)
+        self._roles = _Table(self._mmap, self._users.end, n_roles)
+        self._perms = _Table(self._mmap, self._roles.end, n_perms)
+        self._user_roles = _Lists(self._mmap, self._perms.end, n_users)
+        self._role_perms = _Lists(self._mmap, self._user_roles.end, n_roles)
+
+    def close(self):
+        """Unmaps the file. The instance cannot be used afterwards."""
+        self._mmap.close()
+
+    def _read_only(self, *args):
+        raise TypeError('MappedRBAC instances cannot be modified.')
+
+    assign = unassign = permit = revoke = _read_only
+    assign_many = unassign_many = permit_many = revoke_many = _read_only
+
+    def allows(self, role, permission):
+        rid = self._roles.find(role)
+        pid = self._perms.find(permission)
+        if rid is None or pid is None:
+            return False
+        return self._role_perms.contains(rid, pid)
+
+    def allowed(self, user, permission):
+        uid = self._users.find(user)
+        pid = self._perms.find(permission)
+        if uid is None or pid is None:
+            return False
+
+        for rid in self._user_roles[uid]:
+            if self._role_perms.contains(rid, pid):
+                return True
+        return False
+
+    def get_assigned_roles(self, user):
+        uid = self._users.find(user)
+        if uid is None:
+            return frozenset()
+        return frozenset(self._roles[rid] for rid in self._user_roles[uid])
+
+    def get_role_permissions(self, role):
+        rid = self._roles.find(role)
+        if rid is None:
+            return frozenset()
+        return frozenset(self._perms[pid] for pid in self._role_perms[rid])
+
+    def iter_assignments(self):
+        for uid in range(self._users.count):
+            user = self._users[uid]
+            for rid in self._user_roles[uid]:
+                yield user, self._roles[rid]
+
+    def iter_permissions(self):
+        for rid in range(self._roles.count):
+            role = self._roles[rid]
+            for pid in self._role_perms[rid]:
+                yield role, self._perms[pid]
+
+
+class SnapshotWatcher(object):
+    """Keeps a :class:`MappedRBAC` of the newest snapshot written to
+    ``path``.
+
+    Call :meth:`refresh` periodically (e.g. once per request or from a
+    timer) and use :attr:`rbac` for checks. Replacing the snapshot is a
+    single attribute assignment, so readers in other threads always see
+    either the old or the new snapshot.
+
+    :param path: Name of the snapshot file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.rbac = MappedRBAC(path)
+
+    def refresh(self):
+        """Switches to the snapshot in :attr:`path` if its version is newer
+        than the current one.
+
+        :return: ``True`` if a newer snapshot was loaded.
+        """
+        if read_version(self.path) <= self.rbac.version:
+            return False
+
+        # the old mapping is released once no longer referenced, instead of
+        # being closed while other threads might still use it
+        self.rbac = MappedRBAC(self.path)
+        return True
@@ -1,26 +1,178 @@
 from __future__ import absolute_import
 
-from sqlalchemy import Column, ForeignKey, Table
-from sqlalchemy.orm import relationship
+from itertools import islice
+import select as _select
+import uuid
 
-from . import FlatRBAC
+from sqlalchemy import (Column, DateTime, ForeignKey, ForeignKeyConstraint,
+                        Index, Integer, String, Table, and_, bindparam, event,
+                        exists, func, inspect, or_, select, tuple_, union)
+from sqlalchemy.orm import (joinedload, lazyload, object_session,
+                            relationship, selectinload, subqueryload)
+from sqlalchemy.orm.util import identity_key
+
+from .. import (permission_granted, permission_revoked, role_assigned,
+                role_disinherited, role_inherited, role_unassigned)
+from . import DictSessionStore, FlatRBAC, HierarchicalRBAC, SessionMixin
 
 
 def _pkey_cols(decl_type):
     return decl_type.__table__.primary_key.columns.values()
 
 
-def _pkey_1col(decl_type):
+def _key_columns(name, decl_type, **kwargs):
+    # columns holding a primary key of decl_type. single column keys are
+    # stored in a column called ``name``, composite keys in one column per
+    # key column, called ``name_<column>``
     cols = _pkey_cols(decl_type)
+    if len(cols) == 1:
+        return [Column(name, cols[0].type, **kwargs)]
+    return [Column('{}_{}'.format(name, col.name), col.type, **kwargs)
+            for col in cols]
+
+
+def _foreign_key(cols, decl_type):
+    return ForeignKeyConstraint([col.name for col in cols],
+                                _pkey_cols(decl_type))
+
+
+def _key_values(cols, key):
+    # composite keys are tuples (or other sequences), single column keys
+    # plain values
+    return (key, ) if len(cols) == 1 else tuple(key)
+
+
+def _key_params(cols, key):
+    values = (None, ) * len(cols) if key is None else _key_values(cols, key)
+    return dict((col.name, value) for col, value in zip(cols, values))
+
+
+def _match(cols, key):
+    return and_(*[col == value
+                  for col, value in zip(cols, _key_values(cols, key))])
+
+
+def _join(left_cols, right_cols):
+    return and_(*[l == r for l, r in zip(left_cols, right_cols)])
+
+
+def _in(cols, keys):
+    # keys is either a list of keys or a selectable of matching columns
+    if len(cols) == 1:
+        return cols[0].in_(keys)
+    if isinstance(keys, list):
+        keys = [tuple(key) for key in keys]
+    return tuple_(*cols).in_(keys)
+
+
+def _row_keys(row, *widths):
+    # splits a result row into keys of the given numbers of columns. NULL
+    # composite keys become None
+    keys = []
+    pos = 0
+    for width in widths:
+        if width == 1:
+            keys.append(row[pos])
+        else:
+            key = tuple(row[pos:pos + width])
+            keys.append(None if key == (None, ) * width else key)
+        pos += width
+    return keys
+
+
+def _mapping_table(name, metadata, left_name, left_type, right_name,
+                   right_type):
+    # the primary key prevents duplicate rows and doubles as the index for
+    # lookups by left keys; lookups by right keys get an index covering all
+    # columns, so neither needs to touch the table itself
+    left_cols = _key_columns(left_name, left_type, primary_key=True)
+    right_cols = _key_columns(right_name, right_type, primary_key=True)
+
+    return Table(name, metadata, *(left_cols + right_cols + [
+        _foreign_key(left_cols, left_type),
+        _foreign_key(right_cols, right_type),
+        Index('ix_{}_reverse'.format(name),
+              *[col.name for col in right_cols + left_cols]),
+    ]))
+
+
+_loaders = {
+    'selectin': selectinload,
+    'joined': joinedload,
+    'subquery': subqueryload,
+}
+
+
+# key of the list of modifications made through relationships that have not
+# been recorded in a changelog yet, kept in ``Session.info``
+_UNRECORDED = 'alcohol_rbac_unrecorded'
+
+
+def _record_flushed(session, flush_context):
+    # modifications of unsaved instances are recorded once they have been
+    # written by a flush. anything still unsaved waits for the next one
+    unrecorded = session.info[_UNRECORDED]
+    changes = {}
+    remaining = []
+    for rbac, table, left, right in unrecorded:
+        if rbac.changelog is None:
+            continue
+        if rbac._unsaved(left) or rbac._unsaved(right):
+            remaining.append((rbac, table, left, right))
+            continue
+
+        left_type, right_type = rbac._link_types[table]
+        keys = rbac._pkey(left, left_type), rbac._pkey(right, right_type)
+        if table is rbac.user_role_map:
+            change = keys + (None, )
+        else:
+            change = (None, ) + keys
+        changes.setdefault(rbac.changelog, []).append(change)
+
+    unrecorded[:] = remaining
+    for changelog, chunk in changes.items():
+        changelog.record(session, chunk)
+
+
+def _forget_unrecorded(session):
+    del session.info[_UNRECORDED][:]
+
+
+class _Link(object):
+    # an insert and a delete statement for a mapping table between the keys
+    # stored in the ``left`` and ``right`` columns. INSERT ... SELECT ...
+    # WHERE NOT EXISTS skips rows that exist already. it is not race-safe:
+    # two transactions inserting the same row can both pass the check, and
+    # the later one fails with an IntegrityError on the primary key
+
+    def __init__(self, table, left, right):
+        self.table = table
+        self.left = left
+        self.right = right
 
-    if len(cols) != 1:
-        raise TypeError('SQLAlchemyRBAC only supports models with a single '
-                        'primary key column.')
+        cols = left + right
+        params = [bindparam('link_' + col.name, type_=col.type)
+                  for col in cols]
+        match = and_(*[col == param for col, param in zip(cols, params)])
 
-    return cols[0]
+        self.insert = table.insert().from_select(
+            [col.name for col in cols],
+            select(params).where(~exists().where(match)))
+        self.delete = table.delete().where(match)
 
+    def params(self, left, right):
+        values = (_key_values(self.left, left) +
+                  _key_values(self.right, right))
+        return dict(('link_' + col.name, value)
+                    for col, value in zip(self.left + self.right, values))
 
-class SQLAlchemyRBAC(FlatRBAC):
+    @classmethod
+    def of(cls, table, left_width):
+        cols = list(table.columns)
+        return cls(table, cols[:left_width], cols[left_width:])
+
+
+class SQLAlchemyRBAC(FlatRBAC, SessionMixin):
     """An declarative SQLAlchemy-based RBAC implementation.
 
     The SQLAlchemyRBAC is part of the schema and is passed three other
@@ -34,8 +186,9 @@ class SQLAlchemyRBAC(FlatRBAC):
     the :class:`~alcohol.rbac.sqlalchemy.SQLAlchemyRBAC` instance is created
     first.
 
-    :note: Currently, SQLAlchemyRBAC only supports declarative models for
-           user, role and permissions that have a single column primary key.
+    Models with composite primary keys are supported; their primary keys
+    are passed as tuples and stored in one column per key column (e.g.
+    ``user_pkey_tenant_id`` and ``user_pkey_id`` instead of ``user_pkey``).
 
     :param user_type: A declarative SQLAlchemy model that will act as users.
     :param role_type: A declarative SQLAlchemy model that will act as roles.
@@ -44,19 +197,36 @@ class SQLAlchemyRBAC(FlatRBAC):
     :param prefix: A prefix for all tables generated by this RBAC.
     :param roles_lazy: The ``lazy`` argument for the
                        :func:`~sqlalchemy.orm.relationship` between users and
-                       roles.
+                       roles. The default joins the roles into every query
+                       for users, ``'select'``, ``'raise'`` or ``'dynamic'``
+                       avoid that. Checks query the database directly
+                       unless the relationship has been loaded already (see
+                       :meth:`with_rbac`), so they work with any of these.
     :param permissions_lazy: The ``lazy`` argument for the
                              :func:`~sqlalchemy.orm.relationship` between
                              roles and permissions.
+    :param session: A :class:`~sqlalchemy.orm.session.Session` (or
+                    :func:`~sqlalchemy.orm.scoped_session`) used for queries
+                    that are passed primary keys instead of instances. If
+                    instances are passed, their own session is used instead.
     """
 
+    batch_size = 1000
+    """Maximum number of rows written per statement by the ``*_many``
+    methods, and of keys bound per query by the batch checks."""
+
+    changelog = None
+    """A :class:`~alcohol.rbac.sqlalchemy.SQLAlchemyChangeLog` that records
+    all modifications, or ``None``."""
+
     def __init__(self,
                  user_type,
                  role_type,
                  permission_type,
                  prefix='rbac_',
                  roles_lazy='joined',
-                 permissions_lazy='joined', ):
+                 permissions_lazy='joined',
+                 session=None, ):
         if not (role_type.metadata == permission_type.metadata ==
                 user_type.metadata):
             raise TypeError('All three models must be part of the same '
@@ -64,28 +234,40 @@ class SQLAlchemyRBAC(FlatRBAC):
 
         metadata = user_type.metadata
 
+        self.user_type = user_type
+        self.role_type = role_type
+        self.permission_type = permission_type
+        self.session = session
+        self.session_store = DictSessionStore()
+
         self.prefix = prefix
         self._roles_rel = '_' + self.prefix + 'roles'
         self._perms_rel = '_' + self.prefix + 'permissions'
 
-        user_key_col = _pkey_1col(user_type)
-        role_key_col = _pkey_1col(role_type)
-        permission_key_col = _pkey_1col(permission_type)
+        self._user_key_cols = _pkey_cols(user_type)
+        self._role_key_cols = _pkey_cols(role_type)
+        self._permission_key_cols = _pkey_cols(permission_type)
 
-        user_role_map = Table(self.prefix + 'user_role_map',
-                              metadata,
-                              Column('user_pkey', user_key_col.type,
-                                     ForeignKey(user_key_col)),
-                              Column('role_pkey', role_key_col.type,
-                                     ForeignKey(role_key_col)), )
-
-        role_permissions_map = Table(self.prefix + 'role_permission_map',
-                                     metadata,
-                                     Column('role_pkey', role_key_col.type,
-                                            ForeignKey(role_key_col)),
-                                     Column('permission_pkey',
-                                            permission_key_col.type,
-                                            ForeignKey(permission_key_col)), )
+        user_role_map = _mapping_table(self.prefix + 'user_role_map',
+                                       metadata, 'user_pkey', user_type,
+                                       'role_pkey', role_type)
+        self.user_role_map = user_role_map
+
+        role_permissions_map = _mapping_table(
+            self.prefix + 'role_permission_map', metadata, 'role_pkey',
+            role_type, 'permission_pkey', permission_type)
+        self.role_permission_map = role_permissions_map
+
+        self._link_types = {
+            user_role_map: (user_type, role_type),
+            role_permissions_map: (role_type, permission_type),
+        }
+        self._links = {
+            user_role_map: _Link.of(user_role_map,
+                                    len(self._user_key_cols)),
+            role_permissions_map: _Link.of(role_permissions_map,
+                                           len(self._role_key_cols)),
+        }
 
         # add orm relationships
         setattr(user_type,
@@ -99,27 +281,1054 @@ class SQLAlchemyRBAC(FlatRBAC):
                              secondary=role_permissions_map,
                              lazy=permissions_lazy, ))
 
+    def _get_session(self, *objs):
+        for obj in objs:
+            session = object_session(obj)
+            if session is not None:
+                return session
+        return self.session
+
+    def _cols(self, table):
+        # the key columns of both sides of a mapping table
+        link = self._links[table]
+        return link.left, link.right
+
+    def _pkey(self, obj, model):
+        # anything that is not an instance of model is assumed to be a
+        # primary key already. composite keys are always tuples
+        mapper = inspect(model)
+        if isinstance(obj, model):
+            obj = mapper.primary_key_from_instance(obj)
+            if len(obj) == 1:
+                return obj[0]
+        return tuple(obj) if len(mapper.primary_key) > 1 else obj
+
+    def _user_key(self, user):
+        return self._pkey(user, self.user_type)
+
+    def _role_key(self, role):
+        return self._pkey(role, self.role_type)
+
+    def _permission_key(self, permission):
+        return self._pkey(permission, self.permission_type)
+
+    def _autoflush(self, session):
+        # core statements do not trigger an autoflush, but pending changes
+        # (including those to the relationships) must be visible. checking
+        # for them first keeps clean sessions from flushing on every check
+        if session.autoflush and (session.new or session.dirty or
+                                  session.deleted):
+            session.flush()
+
+    def _unsaved(self, obj):
+        # without autoflush, pending instances have no primary key yet and
+        # transient ones are not in the database at all
+        state = inspect(obj)
+        return state.transient or state.pending
+
+    def _query_session(self, *args):
+        """Returns a session suitable for querying on behalf of ``args`` (a
+        sequence of ``(obj, model)`` tuples) or ``None`` if the relationships
+        must be used instead."""
+        instances = [obj for obj, model in args if isinstance(obj, model)]
+        session = self._get_session(*instances)
+
+        if session is None:
+            if len(instances) != len(args):
+                raise TypeError('Primary keys can only be passed to a '
+                                'SQLAlchemyRBAC that has a session.')
+            return None
+
+        self._autoflush(session)
+
+        if any(self._unsaved(obj) for obj in instances):
+            return None
+        return session
+
+    def _expire(self, session, model, pkey, rel):
+        # collections that have been loaded are stale after writing to the
+        # mapping tables directly
+        obj = session.identity_map.get(identity_key(model, pkey))
+        if obj is not None:
+            session.expire(obj, [rel])
+
+    def _split(self, session, chunk, types):
+        # pairs involving objects that are not in the database yet have to go
+        # through the relationships, all others are written directly
+        direct, related = [], []
+        for pair in chunk:
+            instances = [isinstance(obj, model)
+                         for obj, model in zip(pair, types)]
+            unsaved = [is_instance and (session is None or self._unsaved(obj))
+                       for obj, is_instance in zip(pair, instances)]
+
+            if not any(unsaved):
+                direct.append(pair)
+            elif all(instances):
+                related.append(pair)
+            else:
+                raise TypeError('{!r} has not been persisted and can only be '
+                                'paired with instances.'.format(pair))
+
+        if direct and session is None:
+            raise TypeError('Primary keys can only be passed to a '
+                            'SQLAlchemyRBAC that has a session.')
+        return direct, related
+
+    def _record_later(self, table, pairs):
+        # pairs modified through the relationships are written by the next
+        # flush of the session of their left side, which records them
+        sessions = []
+        for left, right in pairs:
+            session = object_session(left)
+            if session is None:
+                raise TypeError('{!r} must be added to a session before its '
+                                'changes can be recorded in the changelog.'
+                                .format(left))
+            sessions.append(session)
+
+        for session, (left, right) in zip(sessions, pairs):
+            if _UNRECORDED not in session.info:
+                session.info[_UNRECORDED] = []
+                event.listen(session, 'after_flush_postexec',
+                             _record_flushed)
+                event.listen(session, 'after_rollback', _forget_unrecorded)
+            session.info[_UNRECORDED].append((self, table, left, right))
+
+    def _modify_many(self, pairs, table, rel, delete, signal):
+        # one signal is sent per batch, keeping memory use bounded
+        left_type, right_type = types = self._link_types[table]
+        link = self._links[table]
+
+        pairs = iter(pairs)
+        while True:
+            chunk = list(islice(pairs, self.batch_size))
+            if not chunk:
+                break
+
+            session = self._get_session(*[
+                obj for pair in chunk
+                for obj, model in zip(pair, types) if isinstance(obj, model)
+            ])
+            if session is not None:
+                self._autoflush(session)
+
+            direct, related = self._split(session, chunk, types)
+            if related and self.changelog is not None:
+                self._record_later(table, related)
+
+            if direct:
+                keys = set((self._pkey(left, left_type),
+                            self._pkey(right, right_type))
+                           for left, right in direct)
+
+                session.execute(link.delete if delete else link.insert,
+                                [link.params(l, r) for l, r in keys])
+
+                if self.changelog is not None:
+                    if table is self.user_role_map:
+                        changes = [(l, r, None) for l, r in keys]
+                    else:
+                        changes = [(None, l, r) for l, r in keys]
+                    self.changelog.record(session, changes)
+
+                # expiring discards unflushed changes to the collections, so
+                # this happens before the relationships are modified
+                for left_pkey in set(l for l, r in keys):
+                    self._expire(session, left_type, left_pkey, rel)
+
+            for left, right in related:
+                coll = getattr(left, rel)
+                if delete and right in coll:
+                    coll.remove(right)
+                elif not delete and right not in coll:
+                    coll.append(right)
+
+            self._notify(signal, chunk)
+
     # RBAC api:
     def assign(self, user, role):
-        getattr(user, self._roles_rel).append(role)
+        self.assign_many([(user, role)])
 
     def unassign(self, user, role):
-        try:
-            getattr(user, self._roles_rel).remove(role)
-        except ValueError:
-            pass  # not in list, ignore
+        self.unassign_many([(user, role)])
 
     def permit(self, role, permission):
-        getattr(role, self._perms_rel).append(permission)
+        self.permit_many([(role, permission)])
 
     def revoke(self, role, permission):
+        self.revoke_many([(role, permission)])
+
+    def assign_many(self, pairs):
+        """Assigns roles by writing to the mapping table directly, using
+        one ``executemany`` per :attr:`batch_size` pairs. Existing
+        assignments are left untouched.
+
+        A :data:`~alcohol.role_assigned` signal is sent for every batch, when
+        the batch has been written to the session (not when it is
+        committed)."""
+        self._modify_many(pairs, self.user_role_map, self._roles_rel, False,
+                          role_assigned)
+
+    def unassign_many(self, pairs):
+        self._modify_many(pairs, self.user_role_map, self._roles_rel, True,
+                          role_unassigned)
+
+    def permit_many(self, pairs):
+        """Like :meth:`assign_many`, but for role permissions."""
+        self._modify_many(pairs, self.role_permission_map, self._perms_rel,
+                          False, permission_granted)
+
+    def revoke_many(self, pairs):
+        self._modify_many(pairs, self.role_permission_map, self._perms_rel,
+                          True, permission_revoked)
+
+    def _loaded(self, obj, rel):
+        # collections that have been loaded already are used instead of
+        # querying. dynamic relationships are never loaded
+        return rel in inspect(obj).dict
+
+    def _collections_loaded(self, user, permission):
+        # whether allowed() can be answered from loaded collections alone
+        if not (isinstance(user, self.user_type) and
+                isinstance(permission, self.permission_type) and
+                self._loaded(user, self._roles_rel)):
+            return False
+
+        return all(self._loaded(role, self._perms_rel)
+                   for role in getattr(user, self._roles_rel))
+
+    def with_rbac(self, permissions=True, strategy='selectin'):
+        """Returns a loader option that eagerly loads the roles of users
+        (and optionally the permissions of those roles), for queries that
+        are followed by checks::
+
+            session.query(User).options(acl.with_rbac())
+
+        Checks on users loaded this way use the loaded collections instead
+        of querying the database.
+
+        :param permissions: Whether to load the permissions of the roles as
+                            well.
+        :param strategy: One of ``'selectin'``, ``'joined'`` or
+                         ``'subquery'``.
+        """
         try:
-            getattr(role, self._perms_rel).remove(permission)
-        except ValueError:
-            pass  # not in list, ignore
+            loader = _loaders[strategy]
+        except KeyError:
+            raise ValueError('Unknown loading strategy {!r}.'.format(strategy))
+
+        option = loader(getattr(self.user_type, self._roles_rel))
+        if permissions:
+            option = option.options(
+                loader(getattr(self.role_type, self._perms_rel)))
+        return option
 
     def allows(self, role, permission):
-        return permission in getattr(role, self._perms_rel)
+        """Checks if ``role`` allows ``permission``. If the permissions of
+        ``role`` have not been loaded, a single ``EXISTS`` query is run
+        instead of loading them."""
+        if (isinstance(role, self.role_type) and
+                isinstance(permission, self.permission_type) and
+                self._loaded(role, self._perms_rel)):
+            return permission in getattr(role, self._perms_rel)
+
+        session = self._query_session((role, self.role_type),
+                                      (permission, self.permission_type))
+        if session is None:
+            return permission in getattr(role, self._perms_rel)
+
+        return bool(session.execute(self._allows_query(
+            self._role_key(role), self._permission_key(permission))).scalar())
+
+    def _allows_query(self, role_pkey, permission_pkey):
+        rp_role, rp_perm = self._cols(self.role_permission_map)
+        return select([exists().where(and_(
+            _match(rp_role, role_pkey),
+            _match(rp_perm, permission_pkey)))])
+
+    def _allowed_clause(self, user_pkey, permission_pkey):
+        ur_user, ur_role = self._cols(self.user_role_map)
+        rp_role, rp_perm = self._cols(self.role_permission_map)
+
+        return exists().where(and_(
+            _match(ur_user, user_pkey),
+            _join(ur_role, rp_role),
+            _match(rp_perm, permission_pkey),
+        ))
+
+    def allowed(self, user, permission):
+        """Checks if ``user`` is allowed ``permission`` using a single
+        ``EXISTS`` query on the mapping tables.
+
+        Both ``user`` and ``permission`` may be instances or primary keys, in
+        the latter case no ORM objects need to be loaded at all. If the roles
+        of ``user`` and their permissions have been loaded (see
+        :meth:`with_rbac`), no query is run."""
+        if self._collections_loaded(user, permission):
+            return super(SQLAlchemyRBAC, self).allowed(user, permission)
+
+        session = self._query_session((user, self.user_type),
+                                      (permission, self.permission_type))
+
+        if session is None:
+            return super(SQLAlchemyRBAC, self).allowed(user, permission)
+
+        query = select([self._allowed_clause(
+            self._user_key(user), self._permission_key(permission))])
+
+        return bool(session.execute(query).scalar())
+
+    def _user_permissions_query(self, user_pkeys, permission_pkeys):
+        ur_user, ur_role = self._cols(self.user_role_map)
+        rp_role, rp_perm = self._cols(self.role_permission_map)
+
+        return select(ur_user + rp_perm).where(and_(
+            _join(ur_role, rp_role),
+            _in(ur_user, user_pkeys),
+            _in(rp_perm, permission_pkeys),
+        ))
+
+    def _key_batches(self, user_pkeys, permission_pkeys):
+        # pairs of user and permission chunks, binding at most batch_size
+        # keys per query. permissions are usually few, users get the rest
+        perm_size = min(len(permission_pkeys), max(1, self.batch_size // 2))
+        user_size = max(1, self.batch_size - perm_size)
+
+        for i in range(0, len(user_pkeys), user_size):
+            for j in range(0, len(permission_pkeys), perm_size):
+                yield (user_pkeys[i:i + user_size],
+                       permission_pkeys[j:j + perm_size])
+
+    def allowed_matrix(self, users, permissions):
+        """Like :meth:`~alcohol.rbac.FlatRBAC.allowed_matrix`, but answered
+        by queries using ``IN``, each binding at most :attr:`batch_size`
+        users and permissions. Users and permissions may be instances or
+        primary keys."""
+        users = list(users)
+        permissions = list(permissions)
+
+        session = self._query_session(
+            *([(user, self.user_type) for user in users] +
+              [(perm, self.permission_type) for perm in permissions]))
+
+        if session is None:
+            return super(SQLAlchemyRBAC, self).allowed_matrix(users,
+                                                              permissions)
+
+        # map the results back onto whatever was passed in
+        user_objs = {}
+        for user in users:
+            user_objs.setdefault(self._user_key(user), []).append(user)
+        perm_objs = {}
+        for perm in permissions:
+            perm_objs.setdefault(self._permission_key(perm), []).append(perm)
+
+        matrix = dict((user, set()) for user in users)
+        if not perm_objs:
+            return matrix
+
+        widths = len(self._user_key_cols), len(self._permission_key_cols)
+        for user_pkeys, perm_pkeys in self._key_batches(list(user_objs),
+                                                        list(perm_objs)):
+            query = self._user_permissions_query(user_pkeys, perm_pkeys)
+            for row in session.execute(query):
+                user_pkey, perm_pkey = _row_keys(row, *widths)
+                for user in user_objs[user_pkey]:
+                    matrix[user].update(perm_objs[perm_pkey])
+
+        return matrix
+
+    def allowed_many(self, user, permissions):
+        return self.allowed_matrix([user], permissions)[user]
+
+    def filter_allowed(self, users, permission):
+        users = list(users)
+        matrix = self.allowed_matrix(users, [permission])
+        return [user for user in users if matrix[user]]
 
     def get_assigned_roles(self, user):
-        return list(getattr(user, self._roles_rel))
+        if (isinstance(user, self.user_type) and
+                self._loaded(user, self._roles_rel)):
+            return list(getattr(user, self._roles_rel))
+
+        session = self._query_session((user, self.user_type))
+        if session is None:
+            return list(getattr(user, self._roles_rel))
+
+        ur_user, ur_role = self._cols(self.user_role_map)
+        return session.query(self.role_type).join(
+            self.user_role_map, _join(ur_role, self._role_key_cols)).filter(
+                _match(ur_user, self._user_key(user))).all()
+
+    def _permission_keys_query(self, role_pkeys):
+        rp_role, rp_perm = self._cols(self.role_permission_map)
+        return select(rp_perm).where(_in(rp_role, role_pkeys))
+
+    def get_role_permissions(self, role):
+        session = self._query_session((role, self.role_type))
+
+        if session is None:
+            return list(getattr(role, self._perms_rel))
+
+        return session.query(self.permission_type).filter(
+            _in(self._permission_key_cols,
+                self._permission_keys_query([self._role_key(role)]))).all()
+
+    def _stream(self, query):
+        # joined eager loads of collections cannot be combined with yield_per
+        query = query.options(lazyload('*')).yield_per(self.batch_size)
+        for obj in query:
+            yield obj
+
+    def _roles_with_permission_query(self, permission_pkey):
+        rp_role, rp_perm = self._cols(self.role_permission_map)
+        return select(rp_role).where(_match(rp_perm, permission_pkey))
+
+    def get_users_with_role(self, role):
+        session = self._query_session((role, self.role_type))
+        if session is None:
+            return super(SQLAlchemyRBAC, self).get_users_with_role(role)
+
+        ur_user, ur_role = self._cols(self.user_role_map)
+        return self._stream(session.query(self.user_type).join(
+            self.user_role_map, _join(ur_user, self._user_key_cols)).filter(
+                _match(ur_role, self._role_key(role))))
+
+    def get_roles_with_permission(self, permission):
+        session = self._query_session((permission, self.permission_type))
+        if session is None:
+            return super(SQLAlchemyRBAC, self).get_roles_with_permission(
+                permission)
+
+        return self._stream(session.query(self.role_type).filter(
+            _in(self._role_key_cols, self._roles_with_permission_query(
+                self._permission_key(permission)))))
+
+    def get_users_with_permission(self, permission):
+        session = self._query_session((permission, self.permission_type))
+        if session is None:
+            return super(SQLAlchemyRBAC, self).get_users_with_permission(
+                permission)
+
+        ur_user, ur_role = self._cols(self.user_role_map)
+        return self._stream(session.query(self.user_type).filter(
+            _in(self._user_key_cols, select(ur_user).where(
+                _in(ur_role, self._roles_with_permission_query(
+                    self._permission_key(permission)))))))
+
+    def get_permissions(self, user):
+        session = self._query_session((user, self.user_type))
+        if session is None:
+            return super(SQLAlchemyRBAC, self).get_permissions(user)
+
+        ur_user, ur_role = self._cols(self.user_role_map)
+        return self._stream(session.query(self.permission_type).filter(
+            _in(self._permission_key_cols, self._permission_keys_query(
+                select(ur_role).where(
+                    _match(ur_user, self._user_key(user)))))))
+
+    def _get_permission_keys(self, roles):
+        session = self._query_session()
+
+        if session is None:
+            return super(SQLAlchemyRBAC, self)._get_permission_keys(roles)
+        if not roles:
+            return set()
+
+        width = len(self._permission_key_cols)
+        return set(_row_keys(row, width)[0] for row in session.execute(
+            self._permission_keys_query(list(roles))))
+
+    def _iter_rows(self, query, *widths):
+        session = self._query_session()
+        if session is None:
+            raise TypeError('Iterating requires a SQLAlchemyRBAC that has '
+                            'a session.')
+
+        for row in session.execute(query):
+            yield tuple(_row_keys(row, *widths))
+
+    def _iter_table(self, table):
+        left, right = self._cols(table)
+        return self._iter_rows(select(left + right), len(left), len(right))
+
+    def iter_assignments(self):
+        """Iterates over all assignments as ``(user_pkey, role_pkey)``
+        tuples. Requires :attr:`session` to be set."""
+        return self._iter_table(self.user_role_map)
+
+    def iter_permissions(self):
+        """Iterates over all permissions as ``(role_pkey, permission_pkey)``
+        tuples. Requires :attr:`session` to be set."""
+        return self._iter_table(self.role_permission_map)
+
+
+class SQLAlchemyHierarchicalRBAC(SQLAlchemyRBAC, HierarchicalRBAC):
+    """A :class:`~alcohol.rbac.HierarchicalRBAC` based on
+    :class:`~alcohol.rbac.sqlalchemy.SQLAlchemyRBAC`.
+
+    Two additional tables are created: ``role_inheritance`` holds the direct
+    inheritance relations, while ``role_closure`` holds its transitive
+    closure, which is updated incrementally whenever inheritance changes.
+    Removing inheritance reads only the part of the hierarchy below the
+    seniors of the removed relation. Checks join the closure table instead
+    of recursing through the hierarchy.
+
+    Unlike the flat backend, this class has no relationship-based fallback,
+    all methods dealing with the hierarchy require a session (see
+    :class:`~alcohol.rbac.sqlalchemy.SQLAlchemyRBAC`).
+
+    Accepts the same arguments as
+    :class:`~alcohol.rbac.sqlalchemy.SQLAlchemyRBAC`.
+    """
+
+    def __init__(self, user_type, role_type, permission_type, prefix='rbac_',
+                 **kwargs):
+        super(SQLAlchemyHierarchicalRBAC, self).__init__(
+            user_type, role_type, permission_type, prefix, **kwargs)
+
+        def role_table(name):
+            table = _mapping_table(self.prefix + name, user_type.metadata,
+                                   'senior_pkey', role_type, 'junior_pkey',
+                                   role_type)
+            self._links[table] = _Link.of(table, len(self._role_key_cols))
+            return table
+
+        self.role_inheritance = role_table('role_inheritance')
+        self.role_closure = role_table('role_closure')
+
+    def _hierarchy_session(self, *args):
+        session = self._query_session(*args)
+        if session is None:
+            raise TypeError('SQLAlchemyHierarchicalRBAC requires a session '
+                            'and persisted instances.')
+        return session
+
+    def _keys(self, session, query):
+        # all rows of a query for a single key
+        return [_row_keys(row, len(row))[0] for row in session.execute(query)]
+
+    def add_inheritance(self, senior, junior):
+        session = self._hierarchy_session((senior, self.role_type),
+                                          (junior, self.role_type))
+        senior_pkey = self._role_key(senior)
+        junior_pkey = self._role_key(junior)
+        cl_senior, cl_junior = self._cols(self.role_closure)
+
+        if senior_pkey == junior_pkey or session.execute(select([
+                exists().where(and_(_match(cl_senior, junior_pkey),
+                                    _match(cl_junior, senior_pkey)))
+        ])).scalar():
+            raise ValueError('Inheritance of {!r} from {!r} would create a '
+                             'cycle.'.format(senior, junior))
+
+        seniors = [senior_pkey] + self._keys(session, select(
+            cl_senior).where(_match(cl_junior, senior_pkey)))
+        juniors = [junior_pkey] + self._keys(session, select(
+            cl_junior).where(_match(cl_senior, junior_pkey)))
+
+        ri = self._links[self.role_inheritance]
+        cl = self._links[self.role_closure]
+        session.execute(ri.insert, [ri.params(senior_pkey, junior_pkey)])
+        session.execute(cl.insert, [cl.params(s, j)
+                                    for s in seniors for j in juniors])
+
+        if self.changelog is not None:
+            self.changelog.record(session, [(None, senior_pkey, None)])
+
+        self._notify(role_inherited, [(senior, junior)])
+
+    def remove_inheritance(self, senior, junior):
+        session = self._hierarchy_session((senior, self.role_type),
+                                          (junior, self.role_type))
+        senior_pkey = self._role_key(senior)
+        ri = self._links[self.role_inheritance]
+
+        result = session.execute(ri.delete, ri.params(
+            senior_pkey, self._role_key(junior)))
+        if result.rowcount:
+            self._shrink_closure(session, senior_pkey)
+
+            if self.changelog is not None:
+                self.changelog.record(session, [(None, senior_pkey, None)])
+
+        self._notify(role_disinherited, [(senior, junior)])
+
+    def _shrink_closure(self, session, senior_pkey):
+        ri = self._links[self.role_inheritance]
+        cl = self._links[self.role_closure]
+        width = len(self._role_key_cols)
+
+        # the closure of the senior and all of its seniors may have changed.
+        # they are rebuilt from the edges reachable from them, read one
+        # level of the hierarchy at a time
+        affected = [senior_pkey] + self._keys(session, select(
+            cl.left).where(_match(cl.right, senior_pkey)))
+
+        edges = {}
+        frontier = affected
+        while frontier:
+            edges.update((role, []) for role in frontier)
+            reached = set()
+            for i in range(0, len(frontier), self.batch_size):
+                for row in session.execute(select(ri.left + ri.right).where(
+                        _in(ri.left, frontier[i:i + self.batch_size]))):
+                    s, j = _row_keys(row, width, width)
+                    edges[s].append(j)
+                    if j not in edges:
+                        reached.add(j)
+            frontier = list(reached)
+
+        stale = []
+        for role in affected:
+            closure = set()
+            stack = list(edges.get(role, ()))
+            while stack:
+                r = stack.pop()
+                if r not in closure:
+                    closure.add(r)
+                    stack.extend(edges.get(r, ()))
+
+            stale.extend(cl.params(role, r) for r in self._keys(
+                session, select(cl.right).where(_match(cl.left, role)))
+                if r not in closure)
+
+        if stale:
+            session.execute(cl.delete, stale)
+
+    def _allows_query(self, role_pkey, permission_pkey):
+        rp_role, rp_perm = self._cols(self.role_permission_map)
+        cl_senior, cl_junior = self._cols(self.role_closure)
+
+        return select([or_(
+            exists().where(and_(_match(rp_role, role_pkey),
+                                _match(rp_perm, permission_pkey))),
+            exists().where(and_(_match(cl_senior, role_pkey),
+                                _join(cl_junior, rp_role),
+                                _match(rp_perm, permission_pkey))),
+        )])
+
+    def allows(self, role, permission):
+        session = self._hierarchy_session((role, self.role_type),
+                                          (permission, self.permission_type))
+        query = self._allows_query(self._role_key(role),
+                                   self._permission_key(permission))
+
+        return bool(session.execute(query).scalar())
+
+    def _allowed_clause(self, user_pkey, permission_pkey):
+        ur_user, ur_role = self._cols(self.user_role_map)
+        rp_role, rp_perm = self._cols(self.role_permission_map)
+        cl_senior, cl_junior = self._cols(self.role_closure)
+
+        inherited = exists().where(and_(
+            _match(ur_user, user_pkey),
+            _join(cl_senior, ur_role),
+            _join(rp_role, cl_junior),
+            _match(rp_perm, permission_pkey),
+        ))
+
+        return or_(super(SQLAlchemyHierarchicalRBAC, self)._allowed_clause(
+            user_pkey, permission_pkey), inherited)
+
+    def _permission_keys_query(self, role_pkeys):
+        rp_role, rp_perm = self._cols(self.role_permission_map)
+        cl_senior, cl_junior = self._cols(self.role_closure)
+
+        return union(
+            super(SQLAlchemyHierarchicalRBAC,
+                  self)._permission_keys_query(role_pkeys),
+            select(rp_perm).where(and_(
+                _in(cl_senior, role_pkeys),
+                _join(cl_junior, rp_role))))
+
+    def _roles_with_permission_query(self, permission_pkey):
+        cl_senior, cl_junior = self._cols(self.role_closure)
+        direct = super(SQLAlchemyHierarchicalRBAC,
+                       self)._roles_with_permission_query(permission_pkey)
+
+        return union(direct, select(cl_senior).where(_in(cl_junior, direct)))
+
+    def _collections_loaded(self, user, permission):
+        # the relationships do not include inherited permissions
+        return False
+
+    def get_role_permissions(self, role):
+        # the relationship does not include inherited permissions
+        self._hierarchy_session((role, self.role_type))
+        return super(SQLAlchemyHierarchicalRBAC,
+                     self).get_role_permissions(role)
+
+    def _user_permissions_query(self, user_pkeys, permission_pkeys):
+        ur_user, ur_role = self._cols(self.user_role_map)
+        rp_role, rp_perm = self._cols(self.role_permission_map)
+        cl_senior, cl_junior = self._cols(self.role_closure)
+
+        return union(
+            super(SQLAlchemyHierarchicalRBAC, self)._user_permissions_query(
+                user_pkeys, permission_pkeys),
+            select(ur_user + rp_perm).where(and_(
+                _join(cl_senior, ur_role),
+                _join(rp_role, cl_junior),
+                _in(ur_user, user_pkeys),
+                _in(rp_perm, permission_pkeys),
+            )))
+
+    def get_junior_roles(self, role):
+        session = self._hierarchy_session((role, self.role_type))
+        cl_senior, cl_junior = self._cols(self.role_closure)
+
+        return session.query(self.role_type).join(
+            self.role_closure, _join(cl_junior, self._role_key_cols)).filter(
+                _match(cl_senior, self._role_key(role))).all()
+
+    def iter_permissions(self):
+        rp_role, rp_perm = self._cols(self.role_permission_map)
+        cl_senior, cl_junior = self._cols(self.role_closure)
+
+        return self._iter_rows(union(
+            select(rp_role + rp_perm),
+            select(cl_senior + rp_perm).where(_join(cl_junior, rp_role)),
+        ), len(rp_role), len(rp_perm))
+
+
+class SQLAlchemySessionStore(object):
+    """Keeps the sessions of a
+    :class:`~alcohol.rbac.sqlalchemy.SQLAlchemyRBAC` in the database, see
+    :class:`~alcohol.rbac.SessionMixin`.
+
+    Three tables are added to the metadata of the RBAC, so the store must be
+    created before calling :meth:`~sqlalchemy.schema.MetaData.create_all`.
+    The materialized permissions of every session are stored in their own
+    table, checking any number of permissions takes a single query. All
+    queries are issued through :attr:`SQLAlchemyRBAC.session
+    <alcohol.rbac.sqlalchemy.SQLAlchemyRBAC>`, which must be set.
+
+    :param rbac: The :class:`~alcohol.rbac.sqlalchemy.SQLAlchemyRBAC` to
+                 store sessions for.
+    """
+
+    def __init__(self, rbac):
+        self.rbac = rbac
+        metadata = rbac.user_type.metadata
+
+        self._user_cols = _key_columns('user_pkey', rbac.user_type,
+                                       nullable=False)
+        self.sessions = Table(rbac.prefix + 'session',
+                              metadata,
+                              Column('id', String(32), primary_key=True),
+                              *(self._user_cols + [
+                                  _foreign_key(self._user_cols,
+                                               rbac.user_type),
+                                  Index('ix_{}session_user'.format(
+                                      rbac.prefix),
+                                      *[c.name for c in self._user_cols]),
+                              ]))
+
+        self._links = {}
+
+        def session_table(name, key_name, key_type):
+            key_cols = _key_columns(key_name, key_type, primary_key=True)
+            table = Table(rbac.prefix + name,
+                          metadata,
+                          Column('session_id', String(32),
+                                 ForeignKey(self.sessions.c.id),
+                                 primary_key=True),
+                          *(key_cols + [_foreign_key(key_cols, key_type)]))
+            self._links[table] = _Link.of(table, 1)
+            return table
+
+        self.session_roles = session_table('session_role', 'role_pkey',
+                                           rbac.role_type)
+        self.session_permissions = session_table('session_permission',
+                                                 'permission_pkey',
+                                                 rbac.permission_type)
+
+    def _db(self):
+        db = self.rbac._query_session()
+        if db is None:
+            raise TypeError('SQLAlchemySessionStore requires a '
+                            'SQLAlchemyRBAC that has a session.')
+        return db
+
+    def _get_column(self, db, table, session):
+        cols = self._links[table].right
+        return set(_row_keys(row, len(cols))[0] for row in db.execute(
+            select(cols).where(table.c.session_id == session)))
+
+    def _replace(self, db, table, session, values):
+        current = self._get_column(db, table, session)
+        link = self._links[table]
+
+        removed = current - values
+        if removed:
+            db.execute(link.delete, [link.params(session, value)
+                                     for value in removed])
+
+        added = values - current
+        if added:
+            db.execute(link.insert, [link.params(session, value)
+                                     for value in added])
+
+    def create(self, user):
+        session = uuid.uuid4().hex
+        params = _key_params(self._user_cols, user)
+        params['id'] = session
+        self._db().execute(self.sessions.insert(), params)
+        return session
+
+    def delete(self, session):
+        db = self._db()
+        for table in (self.session_roles, self.session_permissions):
+            db.execute(table.delete().where(table.c.session_id == session))
+        db.execute(self.sessions.delete().where(
+            self.sessions.c.id == session))
+
+    def get_user(self, session):
+        row = self._db().execute(select(self._user_cols).where(
+            self.sessions.c.id == session)).first()
+
+        if row is None:
+            raise KeyError(session)
+        return _row_keys(row, len(self._user_cols))[0]
+
+    def get_roles(self, session):
+        return self._get_column(self._db(), self.session_roles, session)
+
+    def set_roles(self, session, roles, permissions):
+        db = self._db()
+        self._replace(db, self.session_roles, session, set(roles))
+        self._replace(db, self.session_permissions, session, set(permissions))
+
+    def has_permissions(self, session, permissions):
+        permissions = set(permissions)
+        if not permissions:
+            return True
+
+        sp = self.session_permissions
+        count = self._db().execute(
+            select([func.count()]).select_from(sp).where(and_(
+                sp.c.session_id == session,
+                _in(self._links[sp].right, list(permissions))))).scalar()
+
+        return count == len(permissions)
+
+
+class SQLAlchemyChangeLog(object):
+    """Records modifications of a
+    :class:`~alcohol.rbac.sqlalchemy.SQLAlchemyRBAC` in a table, allowing
+    other processes to invalidate their caches, see
+    :class:`~alcohol.rbac.sqlalchemy.ChangeLogPoller`.
+
+    Every modified assignment is stored as a row of ``(generation,
+    user_pkey, role_pkey, None)``, every modified permission as
+    ``(generation, None, role_pkey, permission_pkey)``, where ``generation``
+    is an increasing integer. Changes to the role hierarchy only carry a
+    ``role_pkey``. The rows are written in the same session (and thus
+    transaction) as the modification itself.
+
+    Modifications of instances that have not been flushed yet are recorded
+    after the flush that writes them; such instances must be part of a
+    session. The table must be created before calling
+    :meth:`~sqlalchemy.schema.MetaData.create_all`, it is not pruned
+    automatically (see :meth:`prune`). To start recording, assign the
+    instance to :attr:`SQLAlchemyRBAC.changelog
+    <alcohol.rbac.sqlalchemy.SQLAlchemyRBAC.changelog>`.
+
+    :param rbac: The :class:`~alcohol.rbac.sqlalchemy.SQLAlchemyRBAC` whose
+                 modifications are recorded.
+    :param notify: If not ``None``, the name of a PostgreSQL channel that is
+                   notified (using ``pg_notify``) whenever changes are
+                   recorded. Ignored on other databases.
+    """
+
+    def __init__(self, rbac, notify=None):
+        self.rbac = rbac
+        self.notify = notify
+
+        # the referenced rows may be deleted later, hence no foreign keys
+        self._key_cols = (_key_columns('user_pkey', rbac.user_type),
+                          _key_columns('role_pkey', rbac.role_type),
+                          _key_columns('permission_pkey',
+                                       rbac.permission_type))
+
+        # sqlite reuses the largest rowid once it has been deleted, unless
+        # AUTOINCREMENT is used. generations must never repeat
+        self.changes = Table(rbac.prefix + 'change',
+                             rbac.user_type.metadata,
+                             Column('generation', Integer, primary_key=True),
+                             *[col for cols in self._key_cols for col in cols]
+                             + [Column('changed', DateTime,
+                                       nullable=False,
+                                       default=func.now(),
+                                       index=True)],
+                             sqlite_autoincrement=True)
+
+    def record(self, db, changes):
+        """Inserts ``changes``, a list of ``(user_pkey, role_pkey,
+        permission_pkey)`` tuples, using a single ``executemany``.
+
+        :param db: A session or connection.
+        """
+        for stmt, params in self._statements(db.get_bind(), changes):
+            db.execute(stmt, params)
+
+    def _statements(self, bind, changes):
+        if not changes:
+            return
+
+        params = []
+        for change in changes:
+            row = {}
+            for cols, key in zip(self._key_cols, change):
+                row.update(_key_params(cols, key))
+            params.append(row)
+
+        yield self.changes.insert(), params
+
+        if self.notify is not None and bind.dialect.name == 'postgresql':
+            # notifications are delivered on commit
+            yield select([func.pg_notify(self.notify, '')]), {}
+
+    def generation(self, db):
+        """Returns the newest generation or ``0`` if nothing has been
+        recorded."""
+        return db.execute(select([func.max(
+            self.changes.c.generation)])).scalar() or 0
+
+    def prune(self, db, before):
+        """Deletes changes older than ``before``.
+
+        Pollers miss pruned changes they have not seen yet, so ``before``
+        should lie well behind the polling interval.
+
+        :param db: A session or connection.
+        :param before: A :class:`~datetime.datetime`, compared to the time
+                       of the database server when the change was recorded.
+        :return: The number of deleted changes.
+        """
+        return db.execute(self.changes.delete().where(
+            self.changes.c.changed < before)).rowcount
+
+
+class ChangeLogPoller(object):
+    """Applies changes recorded in a
+    :class:`~alcohol.rbac.sqlalchemy.SQLAlchemyChangeLog` by other
+    processes to a :class:`~alcohol.rbac.cache.CachedRBAC`.
+
+    Each :meth:`poll` is a single range scan over the primary key of the
+    changelog table. Changed assignments invalidate the cached results of
+    their user, changed permissions those of their role and permission.
+    Changes to the role hierarchy clear the whole cache.
+
+    Generations of concurrent transactions may become visible out of order,
+    a change committed after a poll might have a lower generation than one
+    already seen. To catch these, the last ``lookback`` generations are read
+    again on every poll.
+
+    :param changelog: The :class:`~alcohol.rbac.sqlalchemy.SQLAlchemyChangeLog`
+                      to read.
+    :param cache: The :class:`~alcohol.rbac.cache.CachedRBAC` to
+                  invalidate. Changes recorded before the poller was
+                  created are assumed to be reflected already.
+    :param engine: An :class:`~sqlalchemy.engine.Engine` used for reading,
+                   outside of any session, so new changes are always
+                   visible.
+    :param lookback: Number of generations read again on every poll.
+    """
+
+    def __init__(self, changelog, cache, engine, lookback=100):
+        self.changelog = changelog
+        self.cache = cache
+        self.engine = engine
+        self.lookback = lookback
+
+        self._seen = set()
+        self._listener = None
+
+        # only the lookback window has to be marked as seen, not the whole
+        # table
+        with engine.connect() as conn:
+            self.generation = changelog.generation(conn)
+        self._read()
+
+    def _read(self):
+        c = self.changelog.changes.c
+        key_cols = self.changelog._key_cols
+        widths = [1] + [len(cols) for cols in key_cols]
+        query = select([c.generation] + [col for cols in key_cols
+                                         for col in cols]).where(
+            c.generation > self.generation - self.lookback).order_by(
+                c.generation)
+
+        with self.engine.connect() as conn:
+            rows = [_row_keys(row, *widths) for row in conn.execute(query)
+                    if row[0] not in self._seen]
+
+        for row in rows:
+            self._seen.add(row[0])
+            self.generation = max(self.generation, row[0])
+
+        low = self.generation - self.lookback
+        self._seen = set(gen for gen in self._seen if gen > low)
+
+        return rows
+
+    def poll(self):
+        """Reads new changes and invalidates the affected cache entries.
+
+        :return: The number of new changes.
+        """
+        rows = self._read()
+
+        users, roles, permissions = set(), set(), set()
+        for _, user, role, permission in rows:
+            if user is not None:
+                users.add(user)
+            elif permission is not None:
+                roles.add(role)
+                permissions.add(permission)
+            else:
+                self.cache.clear()
+                return len(rows)
+
+        if rows:
+            self.cache.invalidate(users, roles, permissions)
+        return len(rows)
+
+    def listen(self):
+        """Subscribes to the notification channel of the changelog, see
+        :meth:`wait`. Requires PostgreSQL and psycopg2."""
+        if self.changelog.notify is None:
+            raise TypeError('The changelog has no notification channel.')
+        if self.engine.dialect.name != 'postgresql':
+            raise TypeError('Notifications require PostgreSQL.')
+
+        # a dedicated connection that is never returned to the pool
+        conn = self.engine.raw_connection().detach()
+        dbapi_conn = conn.connection
+        dbapi_conn.autocommit = True
+
+        cursor = dbapi_conn.cursor()
+        cursor.execute('LISTEN ' + self.engine.dialect.identifier_preparer
+                       .quote(self.changelog.notify))
+        cursor.close()
+
+        self._listener = dbapi_conn
+
+    def wait(self, timeout=None):
+        """Blocks until a notification arrives or ``timeout`` seconds have
+        passed, then polls. :meth:`listen` must have been called before.
+
+        :return: The number of new changes, see :meth:`poll`.
+        """
+        if self._listener is None:
+            raise TypeError('Call listen() before waiting for '
+                            'notifications.')
+
+        _select.select([self._listener], [], [], timeout)
+        self._listener.poll()
+        del self._listener.notifies[:]
+
+        return self.poll()
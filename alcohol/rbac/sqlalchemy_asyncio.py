@@ -0,0 +1,260 @@
+"""An :mod:`asyncio` frontend for the SQLAlchemy RBAC backend.
+
+Requires Python 3 and SQLAlchemy 1.4 or later.
+"""
+
+from itertools import islice
+
+from sqlalchemy import inspect, select
+from sqlalchemy.ext.asyncio import async_object_session
+
+from .. import (permission_granted, permission_revoked, role_assigned,
+                role_unassigned)
+from . import FlatRBAC
+from .sqlalchemy import _in, _join, _match, _row_keys
+
+
+class AsyncSQLAlchemyRBAC(object):
+    """Runs the checks and modifications of a
+    :class:`~alcohol.rbac.sqlalchemy.SQLAlchemyRBAC` on an
+    :class:`~sqlalchemy.ext.asyncio.AsyncSession`.
+
+    All methods are coroutines with the semantics of their
+    :class:`~alcohol.rbac.FlatRBAC` counterparts, issuing Core queries on the
+    mapping tables of the wrapped RBAC instead of going through the
+    relationships, which cannot be lazy loaded in asynchronous code. Roles
+    and permissions inherited through a
+    :class:`~alcohol.rbac.sqlalchemy.SQLAlchemyHierarchicalRBAC` are taken
+    into account, but the hierarchy itself can only be modified using the
+    synchronous API.
+
+    Users, roles and permissions may be instances or primary keys. Instances
+    must have their primary key loaded, accessing an expired one would
+    require IO (see ``expire_on_commit``). Changes are recorded in the
+    :attr:`~alcohol.rbac.sqlalchemy.SQLAlchemyRBAC.changelog` of the wrapped
+    RBAC, change signals are sent with this instance as the sender.
+
+    :param rbac: The :class:`~alcohol.rbac.sqlalchemy.SQLAlchemyRBAC` whose
+                 tables are used.
+    :param session: An :class:`~sqlalchemy.ext.asyncio.AsyncSession` (or
+                    :class:`~sqlalchemy.ext.asyncio.async_scoped_session`)
+                    used for queries that are passed primary keys instead of
+                    instances. If instances are passed, their own session is
+                    used instead.
+    """
+
+    version = 0
+    """Incremented for every change signal sent."""
+
+    _notify = FlatRBAC._notify
+
+    def __init__(self, rbac, session=None):
+        self.rbac = rbac
+        self.session = session
+
+        self._user_key = rbac._user_key
+        self._role_key = rbac._role_key
+        self._permission_key = rbac._permission_key
+
+    @property
+    def batch_size(self):
+        return self.rbac.batch_size
+
+    async def _query_session(self, *args):
+        instances = [obj for obj, model in args if isinstance(obj, model)]
+
+        session = None
+        for obj in instances:
+            session = async_object_session(obj)
+            if session is not None:
+                break
+        else:
+            session = self.session
+
+        if session is None:
+            raise TypeError('AsyncSQLAlchemyRBAC requires a session or '
+                            'instances that belong to one.')
+
+        # core statements do not trigger an autoflush
+        if session.autoflush and (session.new or session.dirty or
+                                  session.deleted):
+            await session.flush()
+
+        for obj in instances:
+            state = inspect(obj)
+            if state.transient or state.pending:
+                raise TypeError('{!r} has not been persisted.'.format(obj))
+
+        return session
+
+    # modification
+    async def _modify_many(self, pairs, table, rel, delete, signal):
+        rbac = self.rbac
+        left_type, right_type = rbac._link_types[table]
+        link = rbac._links[table]
+
+        pairs = iter(pairs)
+        while True:
+            chunk = list(islice(pairs, self.batch_size))
+            if not chunk:
+                break
+
+            session = await self._query_session(*[
+                (obj, model) for pair in chunk
+                for obj, model in zip(pair, (left_type, right_type))
+            ])
+
+            keys = set((rbac._pkey(left, left_type),
+                        rbac._pkey(right, right_type))
+                       for left, right in chunk)
+
+            await session.execute(link.delete if delete else link.insert,
+                                  [link.params(l, r) for l, r in keys])
+
+            if rbac.changelog is not None:
+                if table is rbac.user_role_map:
+                    changes = [(l, r, None) for l, r in keys]
+                else:
+                    changes = [(None, l, r) for l, r in keys]
+
+                for stmt, params in rbac.changelog._statements(
+                        session.get_bind(), changes):
+                    await session.execute(stmt, params)
+
+            # loaded collections are stale now. expiring them makes accessing
+            # them fail instead of silently returning outdated results
+            for left_pkey in set(l for l, r in keys):
+                rbac._expire(session, left_type, left_pkey, rel)
+
+            self._notify(signal, chunk)
+
+    async def assign(self, user, role):
+        await self.assign_many([(user, role)])
+
+    async def unassign(self, user, role):
+        await self.unassign_many([(user, role)])
+
+    async def permit(self, role, permission):
+        await self.permit_many([(role, permission)])
+
+    async def revoke(self, role, permission):
+        await self.revoke_many([(role, permission)])
+
+    async def assign_many(self, pairs):
+        """See :meth:`SQLAlchemyRBAC.assign_many()
+        <alcohol.rbac.sqlalchemy.SQLAlchemyRBAC.assign_many>`."""
+        await self._modify_many(pairs, self.rbac.user_role_map,
+                                self.rbac._roles_rel, False, role_assigned)
+
+    async def unassign_many(self, pairs):
+        await self._modify_many(pairs, self.rbac.user_role_map,
+                                self.rbac._roles_rel, True, role_unassigned)
+
+    async def permit_many(self, pairs):
+        await self._modify_many(pairs, self.rbac.role_permission_map,
+                                self.rbac._perms_rel, False,
+                                permission_granted)
+
+    async def revoke_many(self, pairs):
+        await self._modify_many(pairs, self.rbac.role_permission_map,
+                                self.rbac._perms_rel, True,
+                                permission_revoked)
+
+    # checking
+    async def allows(self, role, permission):
+        session = await self._query_session(
+            (role, self.rbac.role_type),
+            (permission, self.rbac.permission_type))
+
+        query = self.rbac._allows_query(self._role_key(role),
+                                        self._permission_key(permission))
+        return bool((await session.execute(query)).scalar())
+
+    async def allowed(self, user, permission):
+        """Checks if ``user`` is allowed ``permission`` using a single
+        ``EXISTS`` query."""
+        session = await self._query_session(
+            (user, self.rbac.user_type),
+            (permission, self.rbac.permission_type))
+
+        query = select([self.rbac._allowed_clause(
+            self._user_key(user), self._permission_key(permission))])
+        return bool((await session.execute(query)).scalar())
+
+    async def allowed_matrix(self, users, permissions):
+        """Like :meth:`SQLAlchemyRBAC.allowed_matrix()
+        <alcohol.rbac.sqlalchemy.SQLAlchemyRBAC.allowed_matrix>`, binding
+        at most :attr:`batch_size` users and permissions per query."""
+        users = list(users)
+        permissions = list(permissions)
+
+        session = await self._query_session(
+            *([(user, self.rbac.user_type) for user in users] +
+              [(perm, self.rbac.permission_type) for perm in permissions]))
+
+        user_objs = {}
+        for user in users:
+            user_objs.setdefault(self._user_key(user), []).append(user)
+        perm_objs = {}
+        for perm in permissions:
+            perm_objs.setdefault(self._permission_key(perm), []).append(perm)
+
+        matrix = dict((user, set()) for user in users)
+        if not perm_objs:
+            return matrix
+
+        widths = (len(self.rbac._user_key_cols),
+                  len(self.rbac._permission_key_cols))
+        for user_pkeys, perm_pkeys in self.rbac._key_batches(
+                list(user_objs), list(perm_objs)):
+            query = self.rbac._user_permissions_query(user_pkeys, perm_pkeys)
+            for row in await session.execute(query):
+                user_pkey, perm_pkey = _row_keys(row, *widths)
+                for user in user_objs[user_pkey]:
+                    matrix[user].update(perm_objs[perm_pkey])
+
+        return matrix
+
+    async def allowed_many(self, user, permissions):
+        return (await self.allowed_matrix([user], permissions))[user]
+
+    async def filter_allowed(self, users, permission):
+        users = list(users)
+        matrix = await self.allowed_matrix(users, [permission])
+        return [user for user in users if matrix[user]]
+
+    # reflection
+    # eager loads configured on the models are applied, joined eager loads
+    # of collections require unique()
+    async def get_assigned_roles(self, user):
+        """Returns a list of the roles assigned to ``user``, loaded in a
+        single query."""
+        rbac = self.rbac
+        session = await self._query_session((user, rbac.user_type))
+        ur_user, ur_role = rbac._cols(rbac.user_role_map)
+
+        query = select([rbac.role_type]).join(
+            rbac.user_role_map, _join(ur_role, rbac._role_key_cols)).where(
+                _match(ur_user, self._user_key(user)))
+        return (await session.execute(query)).unique().scalars().all()
+
+    async def get_role_permissions(self, role):
+        rbac = self.rbac
+        session = await self._query_session((role, rbac.role_type))
+
+        query = select([rbac.permission_type]).where(
+            _in(rbac._permission_key_cols, rbac._permission_keys_query(
+                [self._role_key(role)])))
+        return (await session.execute(query)).unique().scalars().all()
+
+    async def get_permissions(self, user):
+        """Returns a list of all permissions ``user`` is allowed."""
+        rbac = self.rbac
+        session = await self._query_session((user, rbac.user_type))
+        ur_user, ur_role = rbac._cols(rbac.user_role_map)
+
+        query = select([rbac.permission_type]).where(
+            _in(rbac._permission_key_cols, rbac._permission_keys_query(
+                select(ur_role).where(
+                    _match(ur_user, self._user_key(user))))))
+        return (await session.execute(query)).unique().scalars().all()
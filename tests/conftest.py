@@ -0,0 +1,8 @@
+import sys
+
+collect_ignore = []
+
+# these modules use async def and asyncio, which older versions cannot parse
+# or import
+if sys.version_info < (3, 5):
+    collect_ignore.extend(['test_rbac_asyncio.py', 'test_mixins_asyncio.py'])
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# coding=utf8
+
+from alcohol.benchmark import calibrate, create_context, measure, tuned_context
+from alcohol.mixins import PasswordMixin
+import passlib.hash
+import pytest
+
+
+def test_measure():
+    timing = measure('pbkdf2_sha256', 1000, samples=3)
+
+    assert timing.scheme == 'pbkdf2_sha256'
+    assert timing.rounds == 1000
+    assert timing.hash_latency > 0
+    assert timing.verify_latency > 0
+    assert timing.verify_throughput > 0
+
+
+def test_measure_processes():
+    timing = measure('pbkdf2_sha256', 1000, samples=2, processes=2)
+    assert timing.processes == 2
+    assert timing.verify_throughput > 0
+
+
+def test_measure_without_rounds():
+    assert measure('plaintext', samples=1).rounds is None
+
+
+@pytest.mark.parametrize('scheme', ['pbkdf2_sha256', 'bcrypt'])
+def test_calibrate_scales_rounds(scheme):
+    handler = getattr(passlib.hash, scheme)
+
+    # far below the cost of the default rounds
+    timing = calibrate(scheme, target=0.0001, samples=1)
+    assert handler.min_rounds <= timing.rounds < handler.default_rounds
+
+
+def test_create_context():
+    ctx = create_context([('sha512_crypt', 5000), ('sha256_crypt', 2000)],
+                         min_rounds_factor=0.5)
+
+    assert ctx.default_scheme() == 'sha512_crypt'
+    assert ctx.handler('sha512_crypt').default_rounds == 5000
+    assert ctx.needs_update(ctx.handler('sha256_crypt').hash('x'))
+    assert ctx.needs_update(
+        passlib.hash.sha512_crypt.using(rounds=2000).hash('x'))
+    assert not ctx.needs_update(
+        passlib.hash.sha512_crypt.using(rounds=3000).hash('x'))
+
+
+def test_tuned_context_usable():
+    class User(PasswordMixin):
+        crypt_context = tuned_context(0.001, ['pbkdf2_sha256'], samples=1)
+
+    user = User()
+    user.password = 'foo'
+    assert user.check_password('foo')
+    assert user._pwhash.startswith('$pbkdf2-sha256$')
+
+
+@pytest.fixture(params=['joined', 'selectin', 'raise'])
+def rbac_database(request):
+    from alcohol.rbac.benchmark import create_database
+
+    acl, session = create_database(request.param, users=20, roles=5,
+                                   permissions=10, roles_per_user=2,
+                                   permissions_per_role=4)
+    yield request.param, acl, session
+    session.close()
+
+
+def test_count_rows(rbac_database):
+    from alcohol.rbac.benchmark import count_rows
+
+    _, acl, session = rbac_database
+    with count_rows(session.get_bind()) as counter:
+        assert len(session.query(acl.role_type.id).all()) == 5
+        session.execute(acl.user_type.__table__.update().values(id=-1).where(
+            acl.user_type.id == 0))
+
+    assert (counter.queries, counter.rows) == (2, 5)
+
+
+def test_count_rows_of_known_queries(rbac_database):
+    from alcohol.rbac.benchmark import count_rows
+
+    _, acl, session = rbac_database
+    users = acl.user_type.__table__
+    conn = session.connection()
+
+    with count_rows(session.get_bind()) as counter:
+        # 20 users with 2 roles each
+        assert len(conn.execute(acl.user_role_map.select()).fetchall()) == 40
+        assert len(conn.execute(users.select()).fetchmany(7)) == 7
+        assert sum(1 for _ in conn.execute(users.select().limit(3))) == 3
+        assert conn.execute(users.select()).first() is not None
+
+    assert (counter.queries, counter.rows) == (4, 40 + 7 + 3 + 1)
+
+
+def test_count_rows_requires_enabling():
+    from alcohol.rbac.benchmark import count_rows
+    from sqlalchemy import create_engine
+
+    with pytest.raises(TypeError):
+        with count_rows(create_engine('sqlite://')):
+            pass
+
+
+def test_count_rows_executes_once(rbac_database):
+    from alcohol.rbac.benchmark import count_rows
+    from sqlalchemy import func, select
+
+    _, acl, session = rbac_database
+    calls = []
+
+    def tick():
+        calls.append(None)
+        return len(calls)
+
+    session.connection().connection.create_function('tick', 0, tick)
+    with count_rows(session.get_bind()) as counter:
+        assert session.execute(select([func.tick()])).scalar() == 1
+
+    assert len(calls) == 1
+    assert (counter.queries, counter.rows) == (1, 1)
+
+
+def test_count_loading(rbac_database):
+    from alcohol.rbac.benchmark import count_loading
+
+    strategy, acl, session = rbac_database
+    plain = count_loading(acl, session, strategy)
+    checked = count_loading(acl, session, strategy, checks=3)
+    eager = count_loading(acl, session, strategy, with_rbac=True, checks=3)
+
+    # joined loading multiplies rows, raise loads only users until checking
+    rows = {'joined': 20 * 2 * 4, 'selectin': 20 + 20 * 2 + 5 * 4,
+            'raise': 20}
+    assert (plain.queries, plain.rows) == (
+        3 if strategy == 'selectin' else 1, rows[strategy])
+
+    if strategy == 'raise':
+        assert checked.queries == 1 + 20 * 3
+    else:
+        assert checked == plain._replace(checks=3)
+
+    # selectin loading takes one query for users, roles and permissions each
+    assert eager.queries == 3
+    assert eager.rows == 20 + 20 * 2 + 5 * 4
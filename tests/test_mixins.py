@@ -4,12 +4,18 @@
 from datetime import timedelta, datetime
 import time
 
-from sqlalchemy import create_engine, Column, Integer
+from sqlalchemy import create_engine, Column, Integer, select
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm.session import sessionmaker
 
-from alcohol.mixins import EmailMixin, PasswordMixin
+from alcohol import password_rehashed
+from alcohol.cache import LRUCache
+from alcohol.mixins import (EmailMixin, MemoryNonceStore, PasswordMixin,
+                            verify_email_activation_tokens,
+                            verify_password_reset_tokens)
 from alcohol.mixins.sqlalchemy import (SQLAlchemyEmailMixin,
+                                       SQLAlchemyNonceStore,
                                        SQLAlchemyPasswordMixin, TimestampMixin)
 from itsdangerous import want_bytes
 from pytest_extra import group_fixture
@@ -301,3 +307,489 @@ def test_last_modified(gizmo_type, session, db_schema):
     session.query(gizmo_type).filter(gizmo_type.last_modified != None).all()
 
     # FIXME: missing tests for NULL values and server-side tests
+
+
+@pytest.fixture
+def old_ctx():
+    return CryptContext(schemes=['sha256_crypt'],
+                        sha256_crypt__default_rounds=1000)
+
+
+@pytest.fixture
+def new_ctx():
+    return CryptContext(schemes=['sha256_crypt'],
+                        sha256_crypt__default_rounds=2000,
+                        sha256_crypt__min_rounds=2000)
+
+
+def test_rehash_on_login(user_type_vanilla, old_ctx, new_ctx, pw):
+    user_type_vanilla.crypt_context = old_ctx
+    user_type_vanilla.rehash_on_login = True
+    user = user_type_vanilla(password=pw)
+    old_hash = user._pwhash
+
+    user_type_vanilla.crypt_context = new_ctx
+    rehashed = []
+
+    def receiver(sender, old_hash):
+        rehashed.append((sender, old_hash))
+
+    with password_rehashed.connected_to(receiver):
+        assert not user.check_password(pw + 'x')
+        assert user._pwhash == old_hash
+
+        assert user.check_password(pw)
+        assert user._pwhash != old_hash
+        assert rehashed == [(user, old_hash)]
+
+        # already up to date
+        new_hash = user._pwhash
+        assert user.check_password(pw)
+        assert user._pwhash == new_hash
+        assert len(rehashed) == 1
+
+    assert user_type_vanilla.count_password_schemes(
+        [old_hash, new_hash, new_hash, None, 'nonsense']) == {
+        ('sha256_crypt', 1000): 1,
+        ('sha256_crypt', 2000): 2,
+        (None, None): 1,
+    }
+
+
+def test_rehash_on_login_disabled(user_type_vanilla, old_ctx, new_ctx, pw):
+    user_type_vanilla.crypt_context = old_ctx
+    user = user_type_vanilla(password=pw)
+    old_hash = user._pwhash
+
+    user_type_vanilla.crypt_context = new_ctx
+    assert user.check_password(pw)
+    assert user._pwhash == old_hash
+
+
+def test_rehash_flushed(user_type_sqlalchemy, session, db_schema, old_ctx,
+                        new_ctx, pw):
+    user_type_sqlalchemy.crypt_context = old_ctx
+    user_type_sqlalchemy.rehash_on_login = True
+    user_type_sqlalchemy.flush_on_rehash = True
+    session.add_all([user_type_sqlalchemy(password=pw) for _ in range(3)])
+    session.commit()
+
+    assert user_type_sqlalchemy.count_stored_password_schemes(session) == {
+        ('sha256_crypt', 1000): 3,
+    }
+
+    user_type_sqlalchemy.crypt_context = new_ctx
+    user = session.query(user_type_sqlalchemy).first()
+    assert user.check_password(pw)
+    assert not session.dirty
+
+    # visible inside the transaction, before committing
+    assert user_type_sqlalchemy.count_stored_password_schemes(
+        session, batch_size=2) == {
+        ('sha256_crypt', 1000): 2,
+        ('sha256_crypt', 2000): 1,
+    }
+
+
+@pytest.fixture
+def key_cache(user_type_vanilla):
+    cache = LRUCache(maxsize=4)
+    user_type_vanilla.signing_key_cache = cache
+    return cache
+
+
+def test_signing_keys_cached(user_type_vanilla, key_cache, pw, secret_key,
+                             email):
+    user = user_type_vanilla(password=pw)
+
+    tokens = [user.create_reset_password_token(secret_key) for _ in range(3)]
+    for token in tokens:
+        assert user.check_password_reset_token(secret_key, token)
+
+    info = key_cache.cache_info()
+    assert info.misses == 1
+    assert info.hits == 5
+    assert info.currsize == 1
+
+    token = user.create_email_activation_token(secret_key, email)
+    assert user.activate_email(secret_key, token)
+    assert key_cache.cache_info().currsize == 2
+
+
+def test_signing_key_cache_follows_changes(user_type_vanilla, key_cache, pw,
+                                           secret_key, email):
+    user = user_type_vanilla(password=pw, email='old@email.invalid')
+
+    reset_token = user.create_reset_password_token(secret_key)
+    email_token = user.create_email_activation_token(secret_key, email)
+    other_token = user.create_email_activation_token(secret_key,
+                                                     'other@email.invalid')
+
+    user.password = pw + pw
+    assert not user.check_password_reset_token(secret_key, reset_token)
+
+    assert user.activate_email(secret_key, email_token)
+    assert not user.activate_email(secret_key, other_token)
+
+
+def test_signing_key_cache_bounded(user_type_vanilla, key_cache, secret_key):
+    for i in range(10):
+        user = user_type_vanilla(password=str(i))
+        token = user.create_reset_password_token(secret_key)
+        assert user.check_password_reset_token(secret_key, token)
+
+    assert len(key_cache) == 4
+    assert key_cache.cache_info().evictions == 6
+
+
+def test_signing_key_cache_disabled(user_type_vanilla, pw, secret_key):
+    assert user_type_vanilla.signing_key_cache is None
+    user = user_type_vanilla(password=pw)
+
+    token = user.create_reset_password_token(secret_key)
+    assert user.check_password_reset_token(secret_key, token)
+
+
+def test_bulk_reset_token_verification(user_type_vanilla, secret_key):
+    users = dict((i, user_type_vanilla(password=str(i))) for i in range(5))
+    users['name'] = user_type_vanilla(password='name')
+
+    ids = [0, 1, 2, 'name']
+    tokens = [users[i].create_reset_password_token(secret_key, user_id=i)
+              for i in ids]
+    for i, token in zip(ids, tokens):
+        assert users[i].check_password_reset_token(secret_key, token)
+
+    tokens.append(users[3].create_reset_password_token(secret_key))
+    tokens.append(users[4].create_reset_password_token(secret_key,
+                                                       user_id=99))
+    tokens.append(tokens[0][:-1])
+    tokens.append('garbage')
+
+    users[2].password = 'changed'
+
+    requested = []
+
+    def fetch_salts(ids):
+        requested.append(ids)
+        return dict((i, users[i]._pwhash) for i in ids if i in users)
+
+    assert verify_password_reset_tokens(secret_key, tokens, fetch_salts) == [
+        0, 1, None, 'name', None, None, None, None]
+    assert requested == [set([0, 1, 2, 'name', 99])]
+
+
+def test_bulk_email_token_verification(user_type_vanilla, secret_key,
+                                       email):
+    users = [user_type_vanilla(email='{}@old.invalid'.format(i))
+             for i in range(3)]
+
+    tokens = [user.create_email_activation_token(secret_key, email, user_id=i)
+              for i, user in enumerate(users)]
+    users[2].email = 'changed@email.invalid'
+
+    def fetch_salts(ids):
+        return dict((i, users[i].email) for i in ids)
+
+    assert verify_email_activation_tokens(
+        secret_key, tokens + [b'x'], fetch_salts
+    ) == [(0, email), (1, email), None, None]
+
+    # still usable one by one
+    assert users[1].activate_email(secret_key, tokens[1])
+    assert users[1].email == email
+
+
+def test_sqlalchemy_salt_loaders(user_type_sqlalchemy, session, db_schema,
+                                 secret_key, email):
+    users = [user_type_sqlalchemy(id=i, password=str(i), email=str(i))
+             for i in range(1, 6)]
+    session.add_all(users)
+    session.commit()
+
+    reset_tokens = [u.create_reset_password_token(secret_key, user_id=u.id)
+                    for u in users]
+    email_tokens = [u.create_email_activation_token(secret_key, email,
+                                                    user_id=u.id)
+                    for u in users]
+    session.expunge_all()
+
+    assert verify_password_reset_tokens(
+        secret_key, reset_tokens,
+        user_type_sqlalchemy.password_salt_loader(session, batch_size=2)
+    ) == [1, 2, 3, 4, 5]
+    assert verify_email_activation_tokens(
+        secret_key, email_tokens,
+        user_type_sqlalchemy.email_salt_loader(session)
+    ) == [(i, email) for i in range(1, 6)]
+
+    # only the id and salt columns were loaded
+    assert not session.identity_map
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000000000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture(params=['memory', 'sqlalchemy'])
+def nonce_store(request, clock, Base, engine):
+    if request.param == 'memory':
+        return MemoryNonceStore(clock=clock)
+
+    store = SQLAlchemyNonceStore(Base.metadata, engine.connect(),
+                                 purge_interval=3, clock=clock)
+    Base.metadata.create_all(bind=engine)
+    return store
+
+
+def test_nonce_store_expiry(nonce_store, clock):
+    assert nonce_store.use('a', 10)
+    assert not nonce_store.use('a', 10)
+    assert nonce_store.is_used('a')
+
+    clock.now += 5
+    assert nonce_store.use_many(['a', 'b', 'c', 'b'], 10) == [
+        False, True, True, False]
+
+    clock.now += 5
+    assert not nonce_store.is_used('a')
+    assert nonce_store.use_many(['a', 'b'], 10) == [True, False]
+
+
+def test_nonce_store_bounded(nonce_store, clock):
+    for i in range(20):
+        assert nonce_store.use(str(i), 2)
+        clock.now += 1
+
+    nonce_store.purge()
+    if isinstance(nonce_store, MemoryNonceStore):
+        assert len(nonce_store) == 1
+    else:
+        table = nonce_store.nonces
+        assert len(nonce_store.session.execute(table.select()).fetchall()) == 1
+
+
+def test_nonce_store_conflicts_keep_transaction(Base, engine, session,
+                                                clock):
+    store = SQLAlchemyNonceStore(Base.metadata, session, clock=clock)
+    Base.metadata.create_all(bind=engine)
+
+    assert store.use('a', 10)
+    assert store.use_many(['b', 'a', 'c'], 10) == [True, False, True]
+    session.commit()
+
+    nonces = store.nonces.c.nonce
+    assert sorted(session.execute(select([nonces])).scalars()) == [
+        'a', 'b', 'c']
+    assert not store.use('c', 10)
+
+
+def test_reset_token_single_use(user_type_vanilla, nonce_store, pw,
+                                secret_key):
+    user_type_vanilla.nonce_store = nonce_store
+    user = user_type_vanilla(password=pw)
+
+    token1 = user.create_reset_password_token(secret_key)
+    token2 = user.create_reset_password_token(secret_key)
+
+    assert user.check_password_reset_token(secret_key, token1, consume=False)
+    assert user.check_password_reset_token(secret_key, token1)
+    assert not user.check_password_reset_token(secret_key, token1,
+                                               consume=False)
+    assert not user.check_password_reset_token(secret_key, token1)
+
+    assert user.check_password_reset_token(secret_key, token2)
+
+
+def test_email_token_single_use(user_type_vanilla, nonce_store, secret_key,
+                                email):
+    user_type_vanilla.nonce_store = nonce_store
+    user = user_type_vanilla()
+
+    token = user.create_email_activation_token(secret_key, email)
+    user2 = user_type_vanilla()
+    assert user2.activate_email(secret_key, token)
+
+    # the same token for another user with an identical old email
+    assert not user.activate_email(secret_key, token)
+    assert user.email is None
+
+
+def test_bulk_verification_single_use(user_type_vanilla, nonce_store,
+                                      secret_key):
+    users = [user_type_vanilla(password=str(i)) for i in range(3)]
+    tokens = [u.create_reset_password_token(secret_key, user_id=i)
+              for i, u in enumerate(users)]
+
+    def fetch_salts(ids):
+        return dict((i, users[i]._pwhash) for i in ids)
+
+    assert verify_password_reset_tokens(
+        secret_key, tokens[:2] + [tokens[0]], fetch_salts,
+        nonce_store=nonce_store) == [0, 1, None]
+    assert verify_password_reset_tokens(
+        secret_key, tokens, fetch_salts,
+        nonce_store=nonce_store) == [None, None, 2]
+
+
+@pytest.fixture
+def indexed_gizmo_type(Base):
+    class IndexedGizmo(Base, TimestampMixin, SQLAlchemyEmailMixin):
+        __tablename__ = 'indexed_gizmos'
+        timestamp_indexes = True
+        timestamp_server_default = True
+        email_unique = True
+        email_case_insensitive = True
+
+        id = Column(Integer, primary_key=True)
+
+    return IndexedGizmo
+
+
+def query_plan(session, query):
+    sql = query.statement.compile(session.bind,
+                                  compile_kwargs={'literal_binds': True})
+    return ' '.join(row[-1] for row in
+                    session.execute('EXPLAIN QUERY PLAN {}'.format(sql)))
+
+
+def test_no_indexes_by_default(gizmo_type, user_type_sqlalchemy):
+    assert not gizmo_type.__table__.indexes
+    assert not user_type_sqlalchemy.__table__.indexes
+
+
+def test_timestamp_indexes(indexed_gizmo_type, session, db_schema):
+    names = set(ix.name for ix in indexed_gizmo_type.__table__.indexes)
+    assert set(['ix_indexed_gizmos_created', 'ix_indexed_gizmos_modified',
+                'ix_indexed_gizmos_last_modified']) <= names
+
+    since = datetime(2000, 1, 1)
+    assert 'ix_indexed_gizmos_last_modified' in query_plan(
+        session, session.query(indexed_gizmo_type)
+                        .filter(indexed_gizmo_type.last_modified > since))
+
+
+def test_timestamp_server_default(indexed_gizmo_type, session, db_schema):
+    session.execute(indexed_gizmo_type.__table__.insert(), [{'id': 1}])
+    g = session.query(indexed_gizmo_type).get(1)
+
+    assert datetime.utcnow() - g.created < timedelta(seconds=2)
+    assert g.modified is None
+
+    g.email = 'x@email.invalid'
+    session.commit()
+    assert g.modified is not None
+
+
+def test_case_insensitive_email_index(indexed_gizmo_type, session,
+                                      db_schema):
+    session.add(indexed_gizmo_type(email='Some@Email.invalid'))
+    session.commit()
+
+    query = session.query(indexed_gizmo_type).filter(
+        indexed_gizmo_type.email_matches('some@email.INVALID'))
+    assert query.count() == 1
+    assert 'ix_indexed_gizmos_email_lower' in query_plan(session, query)
+
+    session.add(indexed_gizmo_type(email='some@email.invalid'))
+    with pytest.raises(IntegrityError):
+        session.commit()
+
+
+@pytest.fixture
+def sargable_gizmo_type():
+    class SargableGizmo(declarative_base(), TimestampMixin):
+        __tablename__ = 'gizmos'
+        timestamp_indexes = True
+        timestamp_sargable = True
+
+        id = Column(Integer, primary_key=True)
+
+    return SargableGizmo
+
+
+def test_sargable_last_modified(sargable_gizmo_type, engine, session):
+    sargable_gizmo_type.metadata.create_all(bind=engine)
+
+    g = sargable_gizmo_type()
+    session.add(g)
+    session.commit()
+    assert g.modified == g.created
+    assert g.last_modified == g.created
+
+    since = datetime(2000, 1, 1)
+    query = (session.query(sargable_gizmo_type)
+                    .filter(sargable_gizmo_type.last_modified > since)
+                    .order_by(sargable_gizmo_type.last_modified))
+    assert 'CASE' not in str(query.statement)
+    assert 'ix_gizmos_modified' in query_plan(session, query)
+    assert query.all() == [g]
+
+
+def test_backfill_modified(gizmo_type, sargable_gizmo_type, session,
+                           db_schema):
+    session.add_all([gizmo_type() for _ in range(5)])
+    session.commit()
+    assert session.query(gizmo_type).filter(
+        gizmo_type.modified == None).count() == 5
+
+    assert sargable_gizmo_type.backfill_modified(session, batch_size=2) == 5
+    assert sargable_gizmo_type.backfill_modified(session) == 0
+    session.commit()
+
+    assert all(g.modified == g.created
+               for g in session.query(sargable_gizmo_type))
+
+
+@pytest.fixture(params=[None, 'ThreadPoolExecutor'])
+def bulk_executor(request):
+    # hashing uses a ProcessPoolExecutor by default
+    futures = pytest.importorskip('concurrent.futures')
+
+    if request.param is None:
+        yield None
+    else:
+        executor = getattr(futures, request.param)(2)
+        yield executor
+        executor.shutdown()
+
+
+def test_bulk_create(Base, engine, session, bulk_executor):
+    class User(Base, SQLAlchemyPasswordMixin, SQLAlchemyEmailMixin,
+               TimestampMixin):
+        __tablename__ = 'bulk_users'
+        id = Column(Integer, primary_key=True)
+        crypt_context = CryptContext(schemes=['sha256_crypt'],
+                                     sha256_crypt__default_rounds=1000)
+
+    Base.metadata.create_all(bind=engine)
+
+    def rows():
+        for i in range(25):
+            attrs = {'id': i}
+            if i % 5:
+                attrs['email'] = '{}@email.invalid'.format(i)
+            yield attrs, None if i == 3 else str(i)
+
+    assert User.bulk_create(session, rows(), bulk_executor,
+                            chunk_size=7) == 25
+    session.commit()
+
+    users = session.query(User).order_by(User.id).all()
+    assert [user.id for user in users] == list(range(25))
+    for user in users:
+        if user.id == 3:
+            assert user._pwhash is None
+        else:
+            assert user.check_password(str(user.id))
+        assert (user.email is None) == (user.id % 5 == 0)
+        assert user.created is not None
@@ -0,0 +1,105 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import asyncio
+
+from passlib.context import CryptContext
+import pytest
+
+from alcohol.mixins import PasswordMixin
+
+
+def run_async(func, *args):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(func(*args))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+@pytest.fixture
+def pw():
+    return 'foobartestpw'
+
+
+@pytest.fixture
+def old_ctx():
+    return CryptContext(schemes=['sha256_crypt'],
+                        sha256_crypt__default_rounds=1000)
+
+
+@pytest.fixture
+def new_ctx():
+    return CryptContext(schemes=['sha256_crypt'],
+                        sha256_crypt__default_rounds=2000,
+                        sha256_crypt__min_rounds=2000)
+
+
+@pytest.fixture
+def user_type(old_ctx):
+    class User(PasswordMixin):
+        def __init__(self, password=None):
+            if password is not None:
+                self.password = password
+
+    User.crypt_context = old_ctx
+    return User
+
+
+@pytest.fixture(params=[None, ThreadPoolExecutor, ProcessPoolExecutor])
+def password_executor(request, user_type):
+    if request.param is None:
+        yield None
+    else:
+        executor = request.param(2)
+        user_type.password_executor = executor
+        yield executor
+
+        # fall back to the shared executor again
+        del user_type.password_executor
+        executor.shutdown()
+
+
+def test_async_password_check(user_type, password_executor, pw):
+    user = user_type(password=pw)
+
+    assert run_async(user.check_password_async, pw)
+    assert not run_async(user.check_password_async, pw + 'x')
+
+
+def test_async_password_set(user_type, password_executor, pw):
+    user = user_type()
+
+    run_async(user.set_password_async, pw)
+    assert user.check_password(pw)
+
+
+def test_async_password_executor_is_shared(user_type):
+    user = user_type(password='foo')
+    run_async(user.check_password_async, 'foo')
+
+    assert PasswordMixin.password_executor is not None
+    assert user.password_executor is PasswordMixin.password_executor
+
+
+def test_async_rehash_on_login(user_type, password_executor, new_ctx, pw):
+    user_type.rehash_on_login = True
+    user = user_type(password=pw)
+    old_hash = user._pwhash
+
+    user_type.crypt_context = new_ctx
+    assert not run_async(user.check_password_async, pw + 'x')
+    assert user._pwhash == old_hash
+
+    assert run_async(user.check_password_async, pw)
+    assert user._pwhash != old_hash
+    assert not new_ctx.needs_update(user._pwhash)
+
+
+def test_async_rehash_on_login_disabled(user_type, new_ctx, pw):
+    user = user_type(password=pw)
+    old_hash = user._pwhash
+
+    user_type.crypt_context = new_ctx
+    assert run_async(user.check_password_async, pw)
+    assert user._pwhash == old_hash
@@ -1,13 +1,28 @@
-from sqlalchemy import create_engine, Column, Integer
+import datetime
+
+from sqlalchemy import create_engine, event, select, Column, Integer
+from sqlalchemy.exc import InvalidRequestError
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+from alcohol.rbac import DictRBAC, DictHierarchicalRBAC
+from alcohol.rbac.cache import CachedRBAC
+from alcohol.rbac.compact import CompactRBAC
+from alcohol.rbac.snapshot import MappedRBAC, SnapshotWatcher, read_version
+from alcohol.rbac.sqlalchemy import (ChangeLogPoller, SQLAlchemyChangeLog,
+                                     SQLAlchemyRBAC,
+                                     SQLAlchemyHierarchicalRBAC,
+                                     SQLAlchemySessionStore)
 
-from alcohol.rbac import DictRBAC
-from alcohol.rbac.sqlalchemy import SQLAlchemyRBAC
+from alcohol import (permission_granted, permission_revoked, role_assigned,
+                     role_disinherited, role_inherited, role_unassigned)
 
 import pytest
 
 hashables = ('val', 0, -1, -2, 1234, '+@#$@', ('some', 'tuple', 'val'), True,
              False, None)
+# for in-memory backends that store keys the same way DictRBAC does
+few_hashables = ('val', 0, ('some', 'tuple', 'val'), None)
 alt_vals = 'val2', '0'
 
 
@@ -77,8 +92,266 @@ class FlatAclTests(object):
         flat_acl.assign(user_a, role_x)
         assert flat_acl.allowed(user_a, perm_p)
 
+    def test_bulk_modification(self, flat_acl, user_a, role_x, role_y,
+                               perm_p):
+        flat_acl.assign_many([(user_a, role_x), (user_a, role_y),
+                              (user_a, role_x)])
+        flat_acl.permit_many([(role_x, perm_p), (role_y, perm_p)])
+
+        assert role_x in flat_acl.get_assigned_roles(user_a)
+        assert role_y in flat_acl.get_assigned_roles(user_a)
+        assert flat_acl.allows(role_y, perm_p)
+
+        flat_acl.unassign_many([(user_a, role_x)])
+        assert role_x not in flat_acl.get_assigned_roles(user_a)
+        assert flat_acl.allowed(user_a, perm_p)
+
+        flat_acl.revoke_many([(role_y, perm_p)])
+        assert not flat_acl.allowed(user_a, perm_p)
+
+        # no-ops
+        flat_acl.unassign_many([(user_a, role_x)])
+        flat_acl.revoke_many([(role_y, perm_p)])
+        flat_acl.assign_many([])
+
+    def test_freeze(self, flat_acl, user_a, role_x, perm_p):
+        flat_acl.assign(user_a, role_x)
+        flat_acl.permit(role_x, perm_p)
+
+        frozen = flat_acl.freeze()
+        assert frozen.allowed(user_a, perm_p)
+        assert frozen.allows(role_x, perm_p)
+
+        # reflection returns what the source stores
+        role_key = flat_acl._role_key(role_x)
+        assert frozen.get_assigned_roles(user_a) == frozenset([role_key])
+        assert flat_acl._permission_key(perm_p) in \
+            frozen.get_role_permissions(role_x)
+        assert (flat_acl._user_key(user_a), role_key) in \
+            frozen.iter_assignments()
+
+        # snapshots are independent of their source
+        flat_acl.revoke(role_x, perm_p)
+        assert frozen.allowed(user_a, perm_p)
+        assert not flat_acl.freeze().allowed(user_a, perm_p)
+        assert not flat_acl.freeze().allows(role_x, perm_p)
+        assert frozen.freeze().allowed(user_a, perm_p)
+
+        with pytest.raises(TypeError):
+            frozen.assign(user_a, role_x)
+        with pytest.raises(TypeError):
+            frozen.permit_many([(role_x, perm_p)])
+
+
+class SessionAclTests(object):
+    def test_session_permissions(self, flat_acl):
+        user = self.user(0)
+        role_a, role_b = self.role(0), self.role(1)
+        perm_p, perm_q = self.perm(0), self.perm(1)
+
+        flat_acl.assign(user, role_a)
+        flat_acl.assign(user, role_b)
+        flat_acl.permit(role_a, perm_p)
+        flat_acl.permit(role_b, perm_q)
+
+        session = flat_acl.create_session(user)
+        assert not flat_acl.get_active_roles(session)
+        assert not flat_acl.authorized(session, [perm_p])
+        assert flat_acl.authorized(session, [])
+
+        flat_acl.activate(session, [role_a])
+        assert flat_acl.authorized(session, [perm_p])
+        assert not flat_acl.authorized(session, [perm_p, perm_q])
+
+        flat_acl.activate(session)
+        assert flat_acl.authorized(session, [perm_p, perm_q])
+        assert len(flat_acl.get_active_roles(session)) == 2
+
+        flat_acl.deactivate(session, [role_a])
+        assert not flat_acl.authorized(session, [perm_p])
+        assert flat_acl.authorized(session, [perm_q])
+
+        flat_acl.deactivate(session)
+        assert not flat_acl.authorized(session, [perm_q])
+
+        flat_acl.delete_session(session)
+        with pytest.raises(KeyError):
+            flat_acl.activate(session)
+
+    def test_sessions_are_independent(self, flat_acl):
+        user = self.user(0)
+        role_a, role_b = self.role(0), self.role(1)
+        perm = self.perm(0)
+
+        flat_acl.assign(user, role_a)
+        flat_acl.permit(role_a, perm)
+
+        session_a = flat_acl.create_session(user, [role_a])
+        session_b = flat_acl.create_session(user)
+        assert flat_acl.authorized(session_a, [perm])
+        assert not flat_acl.authorized(session_b, [perm])
+
+        with pytest.raises(ValueError):
+            flat_acl.activate(session_b, [role_b])
+
+    def test_get_role_permissions(self, flat_acl):
+        role = self.role(0)
+        perms = [self.perm(i) for i in range(3)]
+
+        assert not flat_acl.get_role_permissions(role)
+
+        flat_acl.permit_many((role, perm) for perm in perms)
+        assert set(flat_acl.get_role_permissions(role)) == set(perms)
+
+
+class BatchAclTests(object):
+    def test_batch_checks(self, flat_acl):
+        users = [self.user(i) for i in range(3)]
+        roles = [self.role(i) for i in range(2)]
+        perms = [self.perm(i) for i in range(3)]
+
+        flat_acl.assign_many([(users[0], roles[0]), (users[0], roles[1]),
+                              (users[1], roles[1])])
+        flat_acl.permit_many([(roles[0], perms[0]), (roles[1], perms[1])])
+
+        assert flat_acl.allowed_many(users[0], perms) == set(perms[:2])
+        assert flat_acl.allowed_many(users[2], perms) == set()
+        assert flat_acl.allowed_many(users[0], []) == set()
+
+        assert flat_acl.filter_allowed(users, perms[1]) == users[:2]
+        assert flat_acl.filter_allowed(users, perms[0]) == users[:1]
+        assert flat_acl.filter_allowed(users, perms[2]) == []
+
+        assert flat_acl.allowed_matrix(users, perms) == {
+            users[0]: set(perms[:2]),
+            users[1]: set([perms[1]]),
+            users[2]: set(),
+        }
+
+
+class ReverseLookupTests(object):
+    def test_reverse_lookups(self, flat_acl):
+        users = [self.user(i) for i in range(3)]
+        roles = [self.role(i) for i in range(3)]
+        perms = [self.perm(i) for i in range(3)]
+
+        flat_acl.assign_many([(users[0], roles[0]), (users[1], roles[0]),
+                              (users[1], roles[1])])
+        flat_acl.permit_many([(roles[0], perms[0]), (roles[1], perms[0]),
+                              (roles[1], perms[1])])
+
+        assert set(flat_acl.get_users_with_role(roles[0])) == set(users[:2])
+        assert list(flat_acl.get_users_with_role(roles[2])) == []
+
+        assert set(flat_acl.get_roles_with_permission(perms[0])) == set(
+            roles[:2])
+        assert list(flat_acl.get_roles_with_permission(perms[2])) == []
 
-class TestDictRbac(FlatAclTests):
+        with_p0 = list(flat_acl.get_users_with_permission(perms[0]))
+        assert sorted(with_p0, key=id) == sorted(users[:2], key=id)
+        assert list(flat_acl.get_users_with_permission(perms[1])) == [
+            users[1]]
+        assert list(flat_acl.get_users_with_permission(perms[2])) == []
+
+        user_perms = list(flat_acl.get_permissions(users[1]))
+        assert sorted(user_perms, key=id) == sorted(perms[:2], key=id)
+        assert list(flat_acl.get_permissions(users[2])) == []
+
+        flat_acl.unassign(users[1], roles[0])
+        flat_acl.revoke(roles[1], perms[0])
+        assert list(flat_acl.get_users_with_role(roles[0])) == [users[0]]
+        assert list(flat_acl.get_roles_with_permission(perms[0])) == [
+            roles[0]]
+
+
+class ChangeFeedTests(object):
+    def test_change_signals(self, flat_acl):
+        users = [self.user(i) for i in range(2)]
+        roles = [self.role(i) for i in range(2)]
+        perms = [self.perm(i) for i in range(2)]
+
+        events = []
+        signals = [role_assigned, role_unassigned, permission_granted,
+                   permission_revoked]
+
+        # blinker does not tell receivers which signal was sent
+        receivers = []
+        for signal in signals:
+            def receive(sender, pairs, version, signal=signal):
+                events.append((signal.name, list(pairs), version, sender))
+            signal.connect(receive)
+            receivers.append(receive)
+
+        try:
+            flat_acl.assign_many([(users[0], roles[0]), (users[1], roles[0])])
+            flat_acl.permit(roles[0], perms[0])
+            flat_acl.permit_many([(roles[1], perms[0]),
+                                  (roles[1], perms[1])])
+            flat_acl.assign_many([])
+            flat_acl.revoke_many([(roles[1], perms[1])])
+            flat_acl.unassign(users[1], roles[0])
+        finally:
+            for signal, receive in zip(signals, receivers):
+                signal.disconnect(receive)
+
+        assert [(name, pairs) for name, pairs, _, _ in events] == [
+            ('role_assigned', [(users[0], roles[0]), (users[1], roles[0])]),
+            ('permission_granted', [(roles[0], perms[0])]),
+            ('permission_granted', [(roles[1], perms[0]),
+                                    (roles[1], perms[1])]),
+            ('permission_revoked', [(roles[1], perms[1])]),
+            ('role_unassigned', [(users[1], roles[0])]),
+        ]
+
+        versions = [version for _, _, version, _ in events]
+        assert versions == list(range(versions[0], versions[0] + 5))
+
+        # receivers see the completed change
+        sender = events[-1][3]
+        assert sender.version == versions[-1]
+        assert sender.allowed(users[0], perms[0])
+        assert not sender.allowed(users[1], perms[0])
+
+
+class StringKeys(object):
+    def user(self, i):
+        return 'user{}'.format(i)
+
+    def role(self, i):
+        return 'role{}'.format(i)
+
+    def perm(self, i):
+        return 'perm{}'.format(i)
+
+
+class FewHashables(StringKeys):
+    @pytest.fixture(params=few_hashables)
+    def user_a(self, request):
+        return request.param
+
+    @pytest.fixture(params=alt_vals)
+    def user_b(self, request):
+        return request.param
+
+    @pytest.fixture(params=few_hashables)
+    def role_x(self, request):
+        return request.param
+
+    @pytest.fixture(params=alt_vals)
+    def role_y(self, request):
+        return request.param
+
+    @pytest.fixture(params=few_hashables)
+    def perm_p(self, request):
+        return request.param
+
+    @pytest.fixture(params=alt_vals)
+    def perm_q(self, request):
+        return request.param
+
+
+class TestDictRbac(StringKeys, FlatAclTests, SessionAclTests, BatchAclTests,
+                   ReverseLookupTests, ChangeFeedTests):
     @pytest.fixture
     def flat_acl(self):
         return DictRBAC()
@@ -109,10 +382,11 @@ class TestDictRbac(FlatAclTests):
 
 
 class TestSqlaRbac(FlatAclTests):
-    @pytest.fixture
-    def flat_acl(self):
+    acl_class = SQLAlchemyRBAC
+    rbac_kwargs = {}
+
+    def create_models(self):
         Base = declarative_base()
-        self.engine = create_engine('sqlite:///:memory:', echo=True)
 
         class User(Base):
             __tablename__ = 'users'
@@ -132,28 +406,1081 @@ class TestSqlaRbac(FlatAclTests):
 
         self.permission_class = Permission
 
-        return SQLAlchemyRBAC(User, Role, Permission)
+        return Base
+
+    def instance(self, model, id):
+        return model(id=id)
+
+    def create_acl(self):
+        self.Base = self.create_models()
+        self.engine = create_engine('sqlite:///:memory:', echo=True)
+
+        return self.acl_class(self.user_class, self.role_class,
+                              self.permission_class, **self.rbac_kwargs)
+
+    @pytest.fixture
+    def flat_acl(self):
+        return self.create_acl()
+
+    def test_freeze(self, flat_acl, user_a, role_x, perm_p):
+        # snapshots are read from the mapping tables
+        flat_acl.assign(user_a, role_x)
+        with pytest.raises(TypeError):
+            flat_acl.freeze()
+
+    def test_primary_keys_require_session(self, flat_acl):
+        flat_acl.session = None
+        with pytest.raises(TypeError):
+            flat_acl.allowed(1, 2)
 
     @pytest.fixture(params=range(3))
-    def user_a(self, request):
-        return self.user_class(id=request.param)
+    def user_a(self, request, flat_acl):
+        return self.instance(self.user_class, request.param)
 
     @pytest.fixture(params=range(3, 6))
-    def user_b(self, request):
-        return self.user_class(id=request.param)
+    def user_b(self, request, flat_acl):
+        return self.instance(self.user_class, request.param)
 
     @pytest.fixture(params=range(3))
-    def role_x(self, request):
-        return self.role_class(id=request.param)
+    def role_x(self, request, flat_acl):
+        return self.instance(self.role_class, request.param)
 
     @pytest.fixture(params=range(3, 6))
-    def role_y(self, request):
-        return self.role_class(id=request.param)
+    def role_y(self, request, flat_acl):
+        return self.instance(self.role_class, request.param)
 
     @pytest.fixture(params=range(3))
-    def perm_p(self, request):
-        return self.permission_class(id=request.param)
+    def perm_p(self, request, flat_acl):
+        return self.instance(self.permission_class, request.param)
 
     @pytest.fixture(params=range(3, 6))
-    def perm_q(self, request):
-        return self.permission_class(id=request.param)
+    def perm_q(self, request, flat_acl):
+        return self.instance(self.permission_class, request.param)
+
+
+class TestSqlaRbacSession(TestSqlaRbac, SessionAclTests, BatchAclTests,
+                          ReverseLookupTests, ChangeFeedTests):
+    """Runs the same tests with all objects persisted in a session, causing
+    queries to be run against the database."""
+
+    def create_acl(self):
+        acl = super(TestSqlaRbacSession, self).create_acl()
+        acl.session_store = SQLAlchemySessionStore(acl)
+        self.Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        acl.session = self.session
+        return acl
+
+    test_freeze = FlatAclTests.test_freeze
+
+    def instance(self, model, id):
+        obj = model(id=id)
+        self.session.add(obj)
+        self.session.flush()
+        return obj
+
+    def key(self, id):
+        return id
+
+    def new(self, model, id):
+        # an instance that has not been added to the session
+        return model(id=id)
+
+    def user(self, i):
+        return self.instance(self.user_class, 100 + i)
+
+    def role(self, i):
+        return self.instance(self.role_class, 100 + i)
+
+    def perm(self, i):
+        return self.instance(self.permission_class, 100 + i)
+
+    def test_allowed_accepts_primary_keys(self, flat_acl, user_a, role_x,
+                                          perm_p, perm_q):
+        flat_acl.permit(role_x, perm_p)
+        flat_acl.assign(user_a, role_x)
+
+        assert flat_acl.allowed(self.key(user_a.id), self.key(perm_p.id))
+        assert flat_acl.allowed(user_a, self.key(perm_p.id))
+        assert not flat_acl.allowed(self.key(user_a.id), self.key(perm_q.id))
+
+    def test_allowed_does_not_load_objects(self, flat_acl, user_a, role_x,
+                                           perm_p):
+        flat_acl.permit(role_x, perm_p)
+        flat_acl.assign(user_a, role_x)
+        user_id, perm_id = self.key(user_a.id), self.key(perm_p.id)
+        self.session.commit()
+        self.session.expunge_all()
+
+        assert flat_acl.allowed(user_id, perm_id)
+        assert not list(self.session)
+
+    def test_checks_flush_only_pending_changes(self, flat_acl, monkeypatch):
+        user, role, perm = self.user(0), self.role(0), self.perm(0)
+        flat_acl.permit(role, perm)
+        self.session.commit()
+        self.session.refresh(user)
+        self.session.refresh(perm)
+
+        flushes = []
+        flush = self.session.flush
+        monkeypatch.setattr(self.session, 'flush',
+                            lambda *args: flushes.append(args) or flush())
+
+        perm_id = self.key(perm.id)
+        assert not flat_acl.allowed(user, perm_id)
+        assert not flushes
+
+        user.id = user.id
+        assert not flat_acl.allowed(user, perm_id)
+        assert len(flushes) == 1
+
+    def test_assign_and_permit_do_not_duplicate(self, flat_acl, user_a,
+                                                role_x, perm_p):
+        for i in range(3):
+            flat_acl.assign(user_a, role_x)
+            flat_acl.permit(role_x, perm_p)
+
+        assert flat_acl.get_assigned_roles(user_a) == [role_x]
+
+        for table in (flat_acl.user_role_map, flat_acl.role_permission_map):
+            rows = self.session.execute(table.select()).fetchall()
+            assert len(rows) == 1
+
+    def test_bulk_modification_mixes_keys_and_new_instances(self, flat_acl):
+        user, role = self.user(0), self.role(0)
+        new_user = self.new(self.user_class, 101)
+        new_role = self.new(self.role_class, 101)
+
+        flat_acl.assign_many([(self.key(user.id), self.key(role.id)),
+                              (new_user, role), (new_user, new_role)])
+        self.session.add(new_user)
+        self.session.commit()
+
+        assert flat_acl.get_assigned_roles(user) == [role]
+        assert set(flat_acl.get_assigned_roles(new_user)) == set([role,
+                                                                  new_role])
+
+        # nothing is written if a pair cannot be
+        with pytest.raises(TypeError):
+            flat_acl.assign_many([
+                (user, new_role),
+                (self.key(user.id), self.new(self.role_class, 102))])
+        assert flat_acl.get_assigned_roles(user) == [role]
+
+    def test_freeze_stores_primary_keys(self, flat_acl):
+        users = [self.user(i) for i in range(2)]
+        role, perm = self.role(0), self.perm(0)
+        flat_acl.assign_many((user, role) for user in users)
+        flat_acl.permit(role, perm)
+
+        frozen = flat_acl.freeze()
+        user_ids = [self.key(user.id) for user in users]
+        role_id, perm_id = self.key(role.id), self.key(perm.id)
+
+        assert frozen.allowed(users[0], perm)
+        assert frozen.allowed(user_ids[1], perm_id)
+        assert frozen.get_assigned_roles(users[1]) == frozenset([role_id])
+        assert frozen.get_role_permissions(role_id) == frozenset([perm_id])
+        assert sorted(frozen.iter_assignments()) == [(user_id, role_id)
+                                                     for user_id in user_ids]
+        assert list(frozen.iter_permissions()) == [(role_id, perm_id)]
+
+    def test_mapping_tables_are_indexed(self, flat_acl):
+        ur = flat_acl.user_role_map
+        rp = flat_acl.role_permission_map
+
+        assert list(ur.primary_key.columns) == [ur.c.user_pkey,
+                                                ur.c.role_pkey]
+        assert list(rp.primary_key.columns) == [rp.c.role_pkey,
+                                                rp.c.permission_pkey]
+
+        # reverse lookups are covered by an index on both columns
+        assert [list(idx.columns) for idx in ur.indexes] == [
+            [ur.c.role_pkey, ur.c.user_pkey]]
+        assert [list(idx.columns) for idx in rp.indexes] == [
+            [rp.c.permission_pkey, rp.c.role_pkey]]
+
+    def test_batch_checks_by_primary_key(self, flat_acl):
+        users = [self.user(i) for i in range(3)]
+        role = self.role(0)
+        perm = self.perm(0)
+
+        flat_acl.assign_many([(users[0], role), (users[2], role)])
+        flat_acl.permit(role, perm)
+        flat_acl.batch_size = 2
+
+        ids = [self.key(user.id) for user in users]
+        perm_id = self.key(perm.id)
+        assert flat_acl.filter_allowed(ids + users, perm_id) == [
+            ids[0], ids[2], users[0], users[2]]
+        assert flat_acl.allowed_many(ids[0], [perm_id, self.key(-1)]) == set(
+            [perm_id])
+
+    def test_batch_checks_bound_keys_per_query(self, flat_acl):
+        users = [self.user(i) for i in range(5)]
+        roles = [self.role(i) for i in range(2)]
+        perms = [self.perm(i) for i in range(5)]
+
+        flat_acl.assign_many((user, roles[i % 2])
+                             for i, user in enumerate(users))
+        flat_acl.permit_many((roles[i % 2], perm)
+                             for i, perm in enumerate(perms))
+        self.session.flush()
+        flat_acl.batch_size = 4
+
+        bound = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters,
+                                  context, executemany):
+            bound.append(set(parameters))
+
+        event.listen(self.engine, 'before_cursor_execute',
+                     before_cursor_execute)
+        try:
+            matrix = flat_acl.allowed_matrix(users, perms)
+        finally:
+            event.remove(self.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+
+        assert matrix == dict((user, set(perms[i % 2::2]))
+                              for i, user in enumerate(users))
+
+        # distinct values, composite keys share their tenant
+        width = len(flat_acl._user_key_cols)
+        assert len(bound) == 9
+        assert max(len(values) for values in bound) <= 4 * width
+
+    def test_bulk_modification_by_primary_key(self, flat_acl):
+        users = [self.instance(self.user_class, i) for i in range(10)]
+        roles = [self.instance(self.role_class, i) for i in range(5)]
+        self.session.commit()
+
+        # load a collection, it must be expired by the bulk operation
+        assert flat_acl.get_assigned_roles(users[0]) == []
+
+        flat_acl.batch_size = 7
+        flat_acl.assign_many((self.key(u), self.key(r))
+                             for u in range(10) for r in range(5))
+
+        rows = self.session.execute(flat_acl.user_role_map.select())
+        assert len(rows.fetchall()) == 50
+        assert set(flat_acl.get_assigned_roles(users[0])) == set(roles)
+
+        flat_acl.unassign_many((self.key(u), self.key(0)) for u in range(10))
+        assert roles[0] not in flat_acl.get_assigned_roles(users[0])
+
+
+class TestSqlaRbacComposite(TestSqlaRbacSession):
+    """Models with composite primary keys, passed as tuples."""
+
+    def create_models(self):
+        Base = declarative_base()
+
+        class User(Base):
+            __tablename__ = 'users'
+            tenant_id = Column(Integer, primary_key=True)
+            id = Column(Integer, primary_key=True)
+
+        self.user_class = User
+
+        class Role(Base):
+            __tablename__ = 'roles'
+            tenant_id = Column(Integer, primary_key=True)
+            id = Column(Integer, primary_key=True)
+
+        self.role_class = Role
+
+        class Permission(Base):
+            __tablename__ = 'permissions'
+            tenant_id = Column(Integer, primary_key=True)
+            id = Column(Integer, primary_key=True)
+
+        self.permission_class = Permission
+
+        return Base
+
+    def key(self, id):
+        return (1, id)
+
+    def new(self, model, id):
+        return model(tenant_id=1, id=id)
+
+    def instance(self, model, id):
+        obj = model(tenant_id=1, id=id)
+        self.session.add(obj)
+        self.session.flush()
+        return obj
+
+    def test_mapping_tables_are_indexed(self, flat_acl):
+        ur = flat_acl.user_role_map
+
+        assert [col.name for col in ur.primary_key.columns] == [
+            'user_pkey_tenant_id', 'user_pkey_id',
+            'role_pkey_tenant_id', 'role_pkey_id']
+        assert [[col.name for col in idx.columns] for idx in ur.indexes] == [
+            ['role_pkey_tenant_id', 'role_pkey_id',
+             'user_pkey_tenant_id', 'user_pkey_id']]
+
+    def test_keys_of_other_tenants_do_not_match(self, flat_acl):
+        role = self.role(0)
+        flat_acl.assign(self.user(0), role)
+        flat_acl.permit(role, self.perm(0))
+
+        assert flat_acl.allowed((1, 100), (1, 100))
+        assert not flat_acl.allowed((2, 100), (1, 100))
+        assert not flat_acl.allowed((1, 100), (2, 100))
+        assert list(flat_acl.iter_assignments()) == [((1, 100), (1, 100))]
+
+    def test_sessions_store_composite_keys(self, flat_acl):
+        store = flat_acl.session_store
+        self.user(0), self.role(0), self.role(1), self.perm(0)
+        session = store.create((1, 100))
+
+        store.set_roles(session, [(1, 100), (1, 101)], [(1, 100)])
+        assert store.get_user(session) == (1, 100)
+        assert store.get_roles(session) == set([(1, 100), (1, 101)])
+        assert store.has_permissions(session, [(1, 100)])
+        assert not store.has_permissions(session, [(1, 100), (1, 101)])
+
+
+class TestSqlaRbacRaiseload(TestSqlaRbacSession):
+    """With relationships that raise when lazy loaded, all checks must be
+    answered by queries on the mapping tables."""
+
+    rbac_kwargs = {'roles_lazy': 'raise', 'permissions_lazy': 'raise'}
+
+    def test_with_rbac_loads_collections(self, flat_acl):
+        users = [self.user(i) for i in range(3)]
+        role, perm = self.role(0), self.perm(0)
+        flat_acl.assign_many((user, role) for user in users)
+        flat_acl.permit(role, perm)
+        self.session.commit()
+        self.session.expunge_all()
+
+        queries = []
+        event.listen(self.engine, 'before_cursor_execute',
+                     lambda *args: queries.append(args[2]))
+
+        for strategy in ('selectin', 'joined', 'subquery'):
+            users = self.session.query(self.user_class).options(
+                flat_acl.with_rbac(strategy=strategy)).all()
+            perm = self.session.query(self.permission_class).one()
+
+            del queries[:]
+            for user in users:
+                role, = flat_acl.get_assigned_roles(user)
+                assert flat_acl.allows(role, perm)
+            assert not queries
+
+            self.session.expunge_all()
+
+        with pytest.raises(ValueError):
+            flat_acl.with_rbac(strategy='dynamic')
+
+    def test_with_rbac_roles_only(self, flat_acl):
+        user, role, perm = self.user(0), self.role(0), self.perm(0)
+        flat_acl.assign(user, role)
+        flat_acl.permit(role, perm)
+        perm_id = perm.id
+        self.session.commit()
+        self.session.expunge_all()
+
+        user = self.session.query(self.user_class).options(
+            flat_acl.with_rbac(permissions=False)).one()
+        role, = flat_acl.get_assigned_roles(user)
+        with pytest.raises(InvalidRequestError):
+            getattr(role, '_rbac_permissions')
+        assert flat_acl.allows(role, perm_id)
+        assert flat_acl.allows(role, self.session.query(
+            self.permission_class).get(perm_id))
+        assert flat_acl.allowed(user, perm_id)
+
+
+def test_sqla_rbac_dynamic_relationships():
+    models = TestSqlaRbac()
+    Base = models.create_models()
+    acl = SQLAlchemyRBAC(models.user_class, models.role_class,
+                         models.permission_class, roles_lazy='dynamic',
+                         permissions_lazy='dynamic')
+    engine = create_engine('sqlite:///:memory:')
+    Base.metadata.create_all(engine)
+    session = acl.session = sessionmaker(bind=engine)()
+
+    user, role = models.user_class(id=1), models.role_class(id=1)
+    perm = models.permission_class(id=1)
+    session.add_all([user, role, perm])
+
+    acl.assign(user, role)
+    acl.permit(role, perm)
+    assert acl.get_assigned_roles(user) == [role]
+    assert acl.allows(role, perm)
+    assert acl.allowed(user, perm)
+    assert user._rbac_roles.all() == [role]
+
+    acl.unassign(user, role)
+    assert acl.get_assigned_roles(user) == []
+    assert not acl.allowed(user, perm)
+
+
+class TestCachedRbac(FewHashables, FlatAclTests, SessionAclTests,
+                     BatchAclTests, ReverseLookupTests, ChangeFeedTests):
+    @pytest.fixture
+    def flat_acl(self):
+        return CachedRBAC(DictRBAC())
+
+    @pytest.mark.parametrize('method, pair, allowed', [
+        ('assign', ('bob', 'ceo'), (True, True)),
+        ('unassign', ('bob', 'programmer'), (False, True)),
+        ('permit', ('programmer', 'hire_and_fire'), (True, True)),
+        ('revoke', ('programmer', 'run_unittests'), (False, True)),
+    ])
+    @pytest.mark.parametrize('bulk', [False, True])
+    def test_invalidates_on_writes(self, flat_acl, method, pair, allowed,
+                                   bulk):
+        flat_acl.assign_many([('bob', 'programmer'), ('alice', 'ceo')])
+        flat_acl.permit_many([('programmer', 'run_unittests'),
+                              ('ceo', 'hire_and_fire')])
+
+        checks = [('bob', 'run_unittests'), ('alice', 'hire_and_fire')]
+        for user, perm in checks:
+            assert flat_acl.allowed(user, perm)
+
+        if bulk:
+            getattr(flat_acl, method + '_many')([pair])
+        else:
+            getattr(flat_acl, method)(*pair)
+
+        # exactly one of the cached results is affected
+        assert flat_acl.cache_info().currsize == 1
+        assert tuple(flat_acl.allowed(user, perm)
+                     for user, perm in checks) == allowed
+        if method == 'assign':
+            assert flat_acl.allowed('bob', 'hire_and_fire')
+
+
+class TestCompactRbac(FewHashables, FlatAclTests, SessionAclTests,
+                      BatchAclTests, ReverseLookupTests, ChangeFeedTests):
+    @pytest.fixture
+    def flat_acl(self):
+        return CompactRBAC()
+
+    def test_checks_every_role(self, flat_acl):
+        roles = [self.role(i) for i in range(5)]
+        flat_acl.assign_many(('bob', role) for role in roles)
+        flat_acl.permit(roles[-1], 'deploy')
+        flat_acl.permit(roles[0], 'run_unittests')
+
+        assert flat_acl.allowed('bob', 'deploy')
+        assert flat_acl.allowed('bob', 'run_unittests')
+        assert flat_acl.allows(roles[-1], 'deploy')
+        assert not flat_acl.allows(roles[0], 'deploy')
+
+        flat_acl.revoke(roles[-1], 'deploy')
+        assert not flat_acl.allowed('bob', 'deploy')
+        assert flat_acl.allowed('bob', 'run_unittests')
+
+    def test_unknown_objects(self, flat_acl):
+        flat_acl.assign('bob', 'programmer')
+        flat_acl.permit('programmer', 'run_unittests')
+
+        assert not flat_acl.allowed('alice', 'run_unittests')
+        assert not flat_acl.allowed('bob', 'deploy')
+        assert not flat_acl.allows('admin', 'run_unittests')
+        assert flat_acl.allowed_many('alice', ['run_unittests']) == set()
+        assert flat_acl.filter_allowed(['alice'], 'run_unittests') == []
+        assert flat_acl.get_assigned_roles('alice') == set()
+
+        # unknown objects are not interned by removals
+        flat_acl.unassign('alice', 'admin')
+        flat_acl.revoke('admin', 'deploy')
+        assert 'alice' not in flat_acl._users.ids
+        assert 'admin' not in flat_acl._roles.ids
+        assert 'deploy' not in flat_acl._permissions.ids
+
+    def test_bulk_assignment_merges_roles(self, flat_acl):
+        flat_acl.assign('bob', self.role(3))
+        flat_acl.assign_many([('bob', self.role(1)), ('bob', self.role(3)),
+                              ('alice', self.role(2)), ('bob', self.role(0)),
+                              ('bob', self.role(1))])
+
+        assert flat_acl.get_assigned_roles('bob') == set(
+            [self.role(0), self.role(1), self.role(3)])
+        uid = flat_acl._users.ids['bob']
+        assert list(flat_acl._user_roles[uid]) == sorted(
+            flat_acl._user_roles[uid])
+
+        flat_acl.unassign('bob', self.role(1))
+        flat_acl.unassign('bob', self.role(1))
+        assert sorted(flat_acl.iter_assignments()) == [
+            ('alice', self.role(2)), ('bob', self.role(0)),
+            ('bob', self.role(3))]
+
+    def test_hashables(self, flat_acl):
+        for val in hashables:
+            flat_acl.assign(val, val)
+            flat_acl.permit(val, val)
+
+        for val in hashables:
+            assert flat_acl.allowed(val, val)
+            assert flat_acl.get_assigned_roles(val) == set([val])
+            assert set(flat_acl.get_permissions(val)) == set([val])
+
+
+def test_compact_rbac_pickles():
+    import pickle
+
+    acl = CompactRBAC()
+    acl.assign_many([('bob', 'programmer'), ('bob', 'admin'),
+                     ('alice', 'programmer')])
+    acl.permit_many([('programmer', 'run_unittests'), ('admin', 'deploy')])
+    acl.unassign('bob', 'programmer')
+
+    copy = pickle.loads(pickle.dumps(acl))
+    assert sorted(copy.iter_assignments()) == sorted(acl.iter_assignments())
+    assert copy.allowed('bob', 'deploy')
+    assert not copy.allowed('bob', 'run_unittests')
+    assert copy.allowed('alice', 'run_unittests')
+
+
+def test_snapshot_roundtrip(tmpdir):
+    path = str(tmpdir.join('rbac.snapshot'))
+
+    acl = DictRBAC()
+    for i, val in enumerate(hashables):
+        acl.assign(val, 'role{}'.format(i % 3))
+        acl.assign('user', val)
+        acl.permit(val, val)
+        acl.permit('role{}'.format(i % 3), val)
+    acl.permit('unassigned', 'perm')
+    acl.dump(path, version=7)
+
+    mapped = MappedRBAC(path)
+    assert mapped.version == 7 == read_version(path)
+
+    # True and False come back as 1 and 0, which compare equal
+    assert set(mapped.iter_assignments()) == set(acl.iter_assignments())
+    assert set(mapped.iter_permissions()) == set(acl.iter_permissions())
+
+    for val in hashables:
+        assert mapped.allows(val, val)
+        assert mapped.allowed(val, val)
+        assert mapped.allowed('user', val)
+        assert mapped.get_assigned_roles(val) == acl.get_assigned_roles(val)
+        assert (mapped.get_role_permissions(val) ==
+                acl.get_role_permissions(val))
+        assert not mapped.allowed(val, 'perm')
+
+    assert mapped.allows('unassigned', 'perm')
+    assert not mapped.allowed('nobody', 'perm')
+    assert not mapped.allowed(object(), 'perm')
+    assert not mapped.allows('role0', 'missing')
+
+    with pytest.raises(TypeError):
+        mapped.assign('user', 'role0')
+    with pytest.raises(TypeError):
+        mapped.permit_many([('role0', 'perm')])
+
+    acl.permit('role0', object())
+    with pytest.raises(TypeError):
+        acl.dump(path)
+
+
+def test_snapshot_dump_uses_unique_temporary_files(tmpdir):
+    path = str(tmpdir.join('rbac.snapshot'))
+    other = tmpdir.join('rbac.snapshot.tmp')
+    other.write('written by someone else')
+
+    acl = DictRBAC()
+    acl.assign('bob', 'programmer')
+    acl.dump(path, version=1)
+    acl.dump(path, version=2)
+
+    assert read_version(path) == 2
+    assert other.read() == 'written by someone else'
+    assert sorted(f.basename for f in tmpdir.listdir()) == [
+        'rbac.snapshot', 'rbac.snapshot.tmp']
+
+
+def test_snapshot_hot_swap(tmpdir):
+    path = str(tmpdir.join('rbac.snapshot'))
+
+    acl = DictRBAC()
+    acl.assign('bob', 'programmer')
+    acl.dump(path, version=1)
+
+    watcher = SnapshotWatcher(path)
+    old = watcher.rbac
+    assert not watcher.refresh()
+
+    acl.permit('programmer', 'run_unittests')
+    acl.dump(path, version=2)
+
+    assert not old.allowed('bob', 'run_unittests')
+    assert watcher.refresh()
+    assert watcher.rbac.version == 2
+    assert watcher.rbac.allowed('bob', 'run_unittests')
+
+    # the old mapping stays usable
+    assert not old.allowed('bob', 'run_unittests')
+
+    # older snapshots are ignored
+    acl.dump(path, version=1)
+    assert not watcher.refresh()
+    assert watcher.rbac.version == 2
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_cached_rbac_counts_hits_and_misses():
+    acl = CachedRBAC(DictRBAC())
+    acl.assign('bob', 'programmer')
+    acl.permit('programmer', 'run_unittests')
+
+    assert acl.allowed('bob', 'run_unittests')
+    assert acl.allowed('bob', 'run_unittests')
+    assert not acl.allowed('bob', 'hire_and_fire')
+
+    info = acl.cache_info()
+    assert (info.hits, info.misses, info.currsize) == (1, 2, 2)
+
+
+def test_cached_rbac_invalidates_precisely():
+    acl = CachedRBAC(DictRBAC())
+    acl.assign('bob', 'programmer')
+    acl.assign('alice', 'ceo')
+    acl.permit('programmer', 'run_unittests')
+    acl.permit('ceo', 'hire_and_fire')
+
+    assert acl.allowed('bob', 'run_unittests')
+    assert acl.allowed('alice', 'hire_and_fire')
+    assert acl.allows('ceo', 'hire_and_fire')
+
+    acl.unassign('bob', 'programmer')
+    assert acl.cache_info().currsize == 2
+    assert not acl.allowed('bob', 'run_unittests')
+
+    acl.revoke('ceo', 'hire_and_fire')
+    assert acl.cache_info().currsize == 1
+    assert not acl.allowed('alice', 'hire_and_fire')
+    assert not acl.allows('ceo', 'hire_and_fire')
+
+
+def test_cached_rbac_activates_junior_roles():
+    rbac = DictHierarchicalRBAC()
+    rbac.add_inheritance('senior', 'junior')
+    rbac.permit('junior', 'perm')
+    rbac.assign('bob', 'senior')
+
+    acl = CachedRBAC(rbac)
+    assert acl.get_authorized_roles('bob') == set(['senior', 'junior'])
+
+    session = acl.create_session('bob', ['junior'])
+    assert acl.authorized(session, ['perm'])
+
+
+def test_cached_rbac_evicts_and_expires():
+    clock = FakeClock()
+    acl = CachedRBAC(DictRBAC(), maxsize=2, ttl=10, clock=clock)
+    acl.permit('programmer', 'run_unittests')
+
+    for user in ('alice', 'bob', 'cecille'):
+        acl.allowed(user, 'run_unittests')
+
+    info = acl.cache_info()
+    assert (info.evictions, info.currsize) == (1, 2)
+
+    # the index does not keep evicted entries around
+    assert ('u', 'alice') not in acl._index
+
+    acl.allowed('cecille', 'run_unittests')
+    assert acl.cache_info().hits == 1
+
+    clock.now = 10
+    acl.rbac.assign('cecille', 'programmer')
+    assert acl.allowed('cecille', 'run_unittests')
+    assert acl.cache_info().hits == 1
+
+
+def changelog_process(url, acl_class=SQLAlchemyRBAC):
+    # every process has its own models, rbac and engine
+    models = TestSqlaRbac()
+    Base = models.create_models()
+    acl = acl_class(models.user_class, models.role_class,
+                    models.permission_class)
+    acl.changelog = SQLAlchemyChangeLog(acl)
+
+    engine = create_engine(url)
+    Base.metadata.create_all(engine)
+    acl.session = sessionmaker(bind=engine)()
+    return acl, engine
+
+
+def test_changelog_invalidates_other_processes(tmpdir):
+    url = 'sqlite:///' + str(tmpdir.join('rbac.db'))
+    writer, _ = changelog_process(url)
+    reader, engine = changelog_process(url)
+
+    writer.assign_many([(1, 1), (2, 1)])
+    writer.permit_many([(1, 1), (1, 2)])
+    writer.session.commit()
+
+    cache = CachedRBAC(reader)
+    poller = ChangeLogPoller(reader.changelog, cache, engine)
+    assert poller.generation == 4
+    assert poller.poll() == 0
+
+    for user in (1, 2):
+        for perm in (1, 2):
+            assert cache.allowed(user, perm)
+
+    writer.revoke(1, 1)
+    assert cache.allowed(1, 1)  # not committed yet
+    writer.session.commit()
+    assert cache.allowed(1, 1)  # not polled yet
+
+    assert poller.poll() == 1
+    assert poller.generation == 5
+    assert cache.cache_info().currsize == 2
+    assert not cache.allowed(1, 1)
+    assert cache.allowed(2, 2)
+
+    writer.unassign(2, 1)
+    writer.session.commit()
+    assert poller.poll() == 1
+    assert not cache.allowed(2, 2)
+    assert cache.allowed(1, 2)
+
+
+def test_changelog_records_unsaved_instances(tmpdir):
+    url = 'sqlite:///' + str(tmpdir.join('rbac.db'))
+    acl, _ = changelog_process(url)
+    session = acl.session
+    session.autoflush = False
+
+    User, Role = acl.user_type, acl.role_type
+    user, role = User(id=1), Role(id=2)
+    session.add(user)
+    acl.assign(user, role)
+    acl.permit(role, acl.permission_type(id=3))
+    session.commit()
+
+    log = acl.changelog.changes
+    rows = session.execute(select([log.c.user_pkey, log.c.role_pkey,
+                                   log.c.permission_pkey])).fetchall()
+    assert set(tuple(row) for row in rows) == set([(1, 2, None),
+                                                   (None, 2, 3)])
+
+    # rolled back changes are forgotten
+    other = User(id=4)
+    session.add(other)
+    acl.assign(other, role)
+    session.rollback()
+    session.commit()
+    assert acl.changelog.generation(session) == 2
+
+    with pytest.raises(TypeError):
+        acl.assign(User(id=5), role)
+
+
+def test_changelog_poller_reads_only_lookback_on_start(tmpdir):
+    url = 'sqlite:///' + str(tmpdir.join('rbac.db'))
+    writer, engine = changelog_process(url)
+    writer.assign_many((user, 1) for user in range(10))
+    writer.session.commit()
+
+    ranges = []
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if 'generation >' in statement:
+            ranges.append(tuple(parameters))
+
+    poller = ChangeLogPoller(writer.changelog, CachedRBAC(writer), engine,
+                             lookback=3)
+    event.remove(engine, 'before_cursor_execute', record)
+
+    assert poller.generation == 10
+    assert ranges == [(7, )]
+    assert poller.poll() == 0
+
+
+def test_changelog_poll_catches_late_commits(tmpdir):
+    url = 'sqlite:///' + str(tmpdir.join('rbac.db'))
+    writer, engine = changelog_process(url)
+    cache = CachedRBAC(writer)
+    poller = ChangeLogPoller(writer.changelog, cache, engine, lookback=10)
+
+    cache.allowed(1, 1)
+    cache.allowed(2, 1)
+
+    # simulate generation 2 becoming visible before generation 1
+    log = writer.changelog.changes
+    with engine.begin() as conn:
+        conn.execute(log.insert(), {'generation': 2, 'user_pkey': 2})
+    assert poller.poll() == 1
+    assert cache.cache_info().currsize == 1
+
+    with engine.begin() as conn:
+        conn.execute(log.insert(), {'generation': 1, 'user_pkey': 1})
+    assert poller.poll() == 1
+    assert cache.cache_info().currsize == 0
+    assert poller.poll() == 0
+
+
+def test_changelog_hierarchy_changes_clear_cache(tmpdir):
+    url = 'sqlite:///' + str(tmpdir.join('rbac.db'))
+    acl, engine = changelog_process(url, SQLAlchemyHierarchicalRBAC)
+    for i in (1, 2):
+        acl.session.add(acl.role_type(id=i))
+    acl.session.commit()
+
+    cache = CachedRBAC(acl)
+    poller = ChangeLogPoller(acl.changelog, cache, engine)
+    cache.allowed(1, 1)
+
+    acl.add_inheritance(1, 2)
+    acl.session.commit()
+    assert poller.poll() == 1
+    assert cache.cache_info().currsize == 0
+
+
+def test_changelog_prune(tmpdir):
+    url = 'sqlite:///' + str(tmpdir.join('rbac.db'))
+    acl, engine = changelog_process(url)
+    log = acl.changelog
+
+    acl.assign_many([(1, 1), (1, 2)])
+    assert log.generation(acl.session) == 2
+    assert log.prune(acl.session, datetime.datetime(2000, 1, 1)) == 0
+    assert log.prune(acl.session, datetime.datetime(3000, 1, 1)) == 2
+
+    # generations are never reused
+    acl.assign(2, 1)
+    assert log.generation(acl.session) == 3
+
+
+def test_changelog_listen_requires_postgres(tmpdir):
+    url = 'sqlite:///' + str(tmpdir.join('rbac.db'))
+    acl, engine = changelog_process(url)
+    poller = ChangeLogPoller(acl.changelog, CachedRBAC(acl), engine)
+
+    with pytest.raises(TypeError):
+        poller.listen()
+    with pytest.raises(TypeError):
+        poller.wait(0)
+
+    acl.changelog.notify = 'rbac'
+    with pytest.raises(TypeError):
+        poller.listen()
+
+
+class HierarchicalAclTests(object):
+    @pytest.fixture
+    def roles(self, flat_acl):
+        return [self.role(i) for i in range(4)]
+
+    def test_inherits_transitively(self, flat_acl, roles):
+        senior, middle, junior, other = roles
+        user = self.user(0)
+        perm, other_perm = self.perm(0), self.perm(1)
+
+        flat_acl.add_inheritance(senior, middle)
+        flat_acl.add_inheritance(middle, junior)
+        flat_acl.permit(junior, perm)
+        flat_acl.permit(other, other_perm)
+        flat_acl.assign(user, senior)
+
+        assert flat_acl.allows(senior, perm)
+        assert flat_acl.allows(middle, perm)
+        assert not flat_acl.allows(senior, other_perm)
+        assert flat_acl.allowed(user, perm)
+        assert not flat_acl.allowed(user, other_perm)
+
+        assert set(flat_acl.get_junior_roles(senior)) == set([middle, junior])
+        assert set(flat_acl.get_authorized_roles(user)) == set(roles[:3])
+        assert flat_acl.freeze().allowed(user, perm)
+
+        # permissions granted after setting up inheritance work as well
+        flat_acl.permit(middle, other_perm)
+        assert flat_acl.allowed(user, other_perm)
+        assert not flat_acl.allows(junior, other_perm)
+
+    def test_hierarchy_signals(self, flat_acl, roles):
+        senior, middle, junior, _ = roles
+        events = []
+
+        def receive(sender, pairs, version):
+            events.append((list(pairs), version))
+
+        role_inherited.connect(receive)
+        role_disinherited.connect(receive)
+        try:
+            flat_acl.assign(self.user(0), senior)
+            flat_acl.add_inheritance(senior, middle)
+            flat_acl.add_inheritance(middle, junior)
+            flat_acl.remove_inheritance(senior, middle)
+        finally:
+            role_inherited.disconnect(receive)
+            role_disinherited.disconnect(receive)
+
+        assert [pairs for pairs, _ in events] == [
+            [(senior, middle)], [(middle, junior)], [(senior, middle)]]
+
+        # versions are shared with the other change signals
+        versions = [version for _, version in events]
+        assert versions == list(range(versions[0], versions[0] + 3))
+        assert versions[0] >= 2
+        assert flat_acl.version == versions[-1]
+
+    def test_rejects_cycles(self, flat_acl, roles):
+        a, b, c, _ = roles
+
+        flat_acl.add_inheritance(a, b)
+        flat_acl.add_inheritance(b, c)
+
+        for senior, junior in ((c, a), (b, a), (a, a)):
+            with pytest.raises(ValueError):
+                flat_acl.add_inheritance(senior, junior)
+
+    def test_removing_inheritance(self, flat_acl, roles):
+        a, b, c, d = roles
+        perm = self.perm(0)
+
+        # a diamond, with a inheriting from d through b and c
+        flat_acl.add_inheritance(a, b)
+        flat_acl.add_inheritance(a, c)
+        flat_acl.add_inheritance(b, d)
+        flat_acl.add_inheritance(c, d)
+        flat_acl.permit(d, perm)
+
+        flat_acl.remove_inheritance(a, b)
+        assert flat_acl.allows(a, perm)
+        assert set(flat_acl.get_junior_roles(a)) == set([c, d])
+
+        flat_acl.remove_inheritance(a, c)
+        assert not flat_acl.allows(a, perm)
+        assert flat_acl.allows(b, perm)
+        assert not flat_acl.get_junior_roles(a)
+
+        # removing twice is a no-op, so is removing a non-existant one
+        flat_acl.remove_inheritance(a, c)
+        flat_acl.remove_inheritance(d, a)
+
+        # no longer a cycle
+        flat_acl.add_inheritance(d, a)
+
+    def test_reverse_lookups_include_seniors(self, flat_acl, roles):
+        senior, junior, _, _ = roles
+        user = self.user(0)
+        perm = self.perm(0)
+
+        flat_acl.add_inheritance(senior, junior)
+        flat_acl.permit(junior, perm)
+        flat_acl.assign(user, senior)
+
+        assert set(flat_acl.get_roles_with_permission(perm)) == set(
+            [senior, junior])
+        assert list(flat_acl.get_users_with_permission(perm)) == [user]
+        assert list(flat_acl.get_permissions(user)) == [perm]
+
+    def test_session_activates_junior_roles(self, flat_acl, roles):
+        senior, junior, _, _ = roles
+        user = self.user(0)
+        perm = self.perm(0)
+
+        flat_acl.add_inheritance(senior, junior)
+        flat_acl.permit(junior, perm)
+        flat_acl.assign(user, senior)
+
+        session = flat_acl.create_session(user, [junior])
+        assert flat_acl.authorized(session, [perm])
+
+        flat_acl.deactivate(session)
+        flat_acl.activate(session, [senior])
+        assert flat_acl.authorized(session, [perm])
+
+    def test_revoking_inherited(self, flat_acl, roles):
+        a, b, c, _ = roles
+        perm = self.perm(0)
+
+        flat_acl.add_inheritance(a, b)
+        flat_acl.add_inheritance(a, c)
+        flat_acl.permit(b, perm)
+        flat_acl.permit(c, perm)
+
+        flat_acl.revoke(c, perm)
+        assert flat_acl.allows(a, perm)
+
+        flat_acl.revoke(b, perm)
+        assert not flat_acl.allows(a, perm)
+
+
+class TestDictHierarchicalRbac(StringKeys, HierarchicalAclTests):
+    @pytest.fixture
+    def flat_acl(self):
+        return DictHierarchicalRBAC()
+
+    def test_flat_operations(self, flat_acl):
+        flat_acl.assign_many([('bob', 'programmer'), ('alice', 'ceo')])
+        flat_acl.permit_many([('programmer', 'run_unittests'),
+                              ('ceo', 'hire_and_fire')])
+
+        assert flat_acl.allowed('bob', 'run_unittests')
+        assert not flat_acl.allowed('bob', 'hire_and_fire')
+        assert flat_acl.get_assigned_roles('alice') == set(['ceo'])
+        assert flat_acl.allowed_many('alice', ['run_unittests',
+                                               'hire_and_fire']) == set(
+            ['hire_and_fire'])
+        assert list(flat_acl.get_users_with_permission('run_unittests')) == [
+            'bob']
+
+        flat_acl.unassign('bob', 'programmer')
+        flat_acl.revoke('ceo', 'hire_and_fire')
+        assert not flat_acl.allowed('bob', 'run_unittests')
+        assert not flat_acl.allowed('alice', 'hire_and_fire')
+        assert not flat_acl.allows('ceo', 'hire_and_fire')
+
+
+class TestSqlaHierarchicalRbac(TestSqlaRbacSession, HierarchicalAclTests):
+    acl_class = SQLAlchemyHierarchicalRBAC
+
+    def test_removing_reads_only_reachable_edges(self, flat_acl, roles):
+        a, b, c, d = roles
+        x, y = self.role(4), self.role(5)
+
+        flat_acl.add_inheritance(a, b)
+        flat_acl.add_inheritance(a, c)
+        flat_acl.add_inheritance(c, d)
+        flat_acl.add_inheritance(x, y)
+
+        table = flat_acl.role_inheritance.name
+        params = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters,
+                                  context, executemany):
+            if statement.startswith('SELECT') and table in statement:
+                params.extend(parameters)
+
+        event.listen(self.engine, 'before_cursor_execute',
+                     before_cursor_execute)
+        try:
+            flat_acl.remove_inheritance(a, b)
+        finally:
+            event.remove(self.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+
+        assert set(params) == set([a.id, c.id, d.id])
+        assert set(flat_acl.get_junior_roles(a)) == set([c, d])
+        assert set(flat_acl.get_junior_roles(x)) == set([y])
+
+
+class TestSqlaHierarchicalRbacComposite(TestSqlaRbacComposite,
+                                        HierarchicalAclTests):
+    acl_class = SQLAlchemyHierarchicalRBAC
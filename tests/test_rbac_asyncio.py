@@ -0,0 +1,171 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('aiosqlite')
+
+from sqlalchemy import Column, Integer, create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+from alcohol import permission_granted, role_assigned
+from alcohol.rbac.sqlalchemy import (SQLAlchemyChangeLog,
+                                     SQLAlchemyHierarchicalRBAC,
+                                     SQLAlchemyRBAC)
+from alcohol.rbac.sqlalchemy_asyncio import AsyncSQLAlchemyRBAC
+
+
+def run_async(func, *args):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(func(*args))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+@pytest.fixture(params=[SQLAlchemyRBAC, SQLAlchemyHierarchicalRBAC])
+def setup(request, tmpdir):
+    Base = declarative_base()
+
+    class User(Base):
+        __tablename__ = 'users'
+        id = Column(Integer, primary_key=True)
+
+    class Role(Base):
+        __tablename__ = 'roles'
+        id = Column(Integer, primary_key=True)
+
+    class Permission(Base):
+        __tablename__ = 'permissions'
+        id = Column(Integer, primary_key=True)
+
+    rbac = request.param(User, Role, Permission)
+    rbac.changelog = SQLAlchemyChangeLog(rbac)
+
+    path = str(tmpdir.join('rbac.db'))
+    engine = create_engine('sqlite:///' + path)
+    Base.metadata.create_all(engine)
+
+    async_engine = create_async_engine('sqlite+aiosqlite:///' + path)
+    yield rbac, engine, async_engine
+    run_async(async_engine.dispose)
+
+
+def test_async_checks_and_modifications(setup):
+    rbac, _, async_engine = setup
+
+    async def check():
+        async with AsyncSession(async_engine,
+                                expire_on_commit=False) as session:
+            acl = AsyncSQLAlchemyRBAC(rbac, session)
+            User, Role, Perm = (rbac.user_type, rbac.role_type,
+                                rbac.permission_type)
+
+            bob, alice = User(id=1), User(id=2)
+            programmer, ceo = Role(id=1), Role(id=2)
+            run_tests, hire = Perm(id=1), Perm(id=2)
+            session.add_all([bob, alice, programmer, ceo, run_tests, hire])
+
+            await acl.assign(bob, programmer)
+            await acl.assign_many([(alice, ceo), (2, 1)])
+            await acl.permit(programmer, run_tests)
+            await acl.permit_many([(2, 2)])
+            await session.commit()
+
+            assert await acl.allowed(bob, run_tests)
+            assert await acl.allowed(1, 1)
+            assert not await acl.allowed(bob, hire)
+            assert await acl.allows(ceo, 2)
+            assert not await acl.allows(1, 2)
+
+            assert await acl.allowed_many(2, [1, 2, 3]) == set([1, 2])
+            assert await acl.filter_allowed([bob, 2], hire) == [2]
+            assert await acl.allowed_matrix([1, 2], [run_tests]) == {
+                1: set([run_tests]), 2: set([run_tests])}
+
+            assert await acl.get_assigned_roles(bob) == [programmer]
+            assert set(await acl.get_assigned_roles(2)) == set([programmer,
+                                                                ceo])
+            assert await acl.get_role_permissions(ceo) == [hire]
+            assert set(await acl.get_permissions(alice)) == set([run_tests,
+                                                                 hire])
+
+            await acl.unassign(alice, programmer)
+            await acl.revoke_many([(ceo, hire)])
+            assert not await acl.allowed(alice, run_tests)
+            assert not await acl.allowed(alice, hire)
+
+    run_async(check)
+
+
+def test_async_requires_session(setup):
+    rbac, _, async_engine = setup
+
+    async def check():
+        acl = AsyncSQLAlchemyRBAC(rbac)
+        with pytest.raises(TypeError):
+            await acl.allowed(1, 1)
+
+        async with AsyncSession(async_engine) as session:
+            acl.session = session
+            with pytest.raises(TypeError):
+                await acl.allowed(rbac.user_type(id=1), 1)
+
+    run_async(check)
+
+
+def test_async_signals_and_changelog(setup):
+    rbac, engine, async_engine = setup
+    received = []
+
+    def receiver(sender, pairs, version):
+        received.append((sender, pairs, version))
+
+    async def modify(acl):
+        async with AsyncSession(async_engine) as session:
+            acl.session = session
+            await acl.assign_many([(1, 1), (2, 1)])
+            await acl.permit(1, 1)
+            await session.commit()
+
+    acl = AsyncSQLAlchemyRBAC(rbac)
+    rbac.batch_size = 1
+    with role_assigned.connected_to(receiver), \
+            permission_granted.connected_to(receiver):
+        run_async(modify, acl)
+
+    assert received == [(acl, [(1, 1)], 1), (acl, [(2, 1)], 2),
+                        (acl, [(1, 1)], 3)]
+
+    with engine.connect() as conn:
+        assert rbac.changelog.generation(conn) == 3
+        rows = conn.execute(rbac.changelog.changes.select()).fetchall()
+    assert [tuple(row)[1:4] for row in rows] == [(1, 1, None), (2, 1, None),
+                                                 (None, 1, 1)]
+
+
+def test_async_checks_inherited_permissions(setup):
+    rbac, engine, async_engine = setup
+    if not isinstance(rbac, SQLAlchemyHierarchicalRBAC):
+        pytest.skip('requires a role hierarchy')
+
+    rbac.session = sessionmaker(bind=engine)()
+    rbac.session.add_all([rbac.role_type(id=1), rbac.role_type(id=2),
+                          rbac.user_type(id=1), rbac.permission_type(id=1)])
+    rbac.add_inheritance(1, 2)
+    rbac.permit(2, 1)
+    rbac.assign(1, 1)
+    rbac.session.commit()
+
+    async def check():
+        async with AsyncSession(async_engine) as session:
+            acl = AsyncSQLAlchemyRBAC(rbac, session)
+            assert await acl.allows(1, 1)
+            assert await acl.allowed(1, 1)
+            assert await acl.allowed_many(1, [1]) == set([1])
+            assert [p.id for p in await acl.get_role_permissions(1)] == [1]
+
+    run_async(check)